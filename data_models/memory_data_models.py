@@ -483,7 +483,7 @@ class Visibility:
                     ('integration_time', '>f8'),
                     ('antenna1', '>i8'),
                     ('antenna2', '>i8'),
-                    ('vis', '>c16', (npol,)),
+                    ('vis', '>c8' if vis.dtype == numpy.complex64 else '>c16', (npol,)),
                     ('weight', '>f8', (npol,)),
                     ('imaging_weight', '>f8', (npol,))]
             data = numpy.zeros(shape=[nvis], dtype=desc)
@@ -639,7 +639,7 @@ class BlockVisibility:
                     ('uvw', '>f8', (nants, nants, 3)),
                     ('time', '>f8'),
                     ('integration_time', '>f8'),
-                    ('vis', '>c16', (nants, nants, nchan, npol)),
+                    ('vis', '>c8' if vis.dtype == numpy.complex64 else '>c16', (nants, nants, nchan, npol)),
                     ('weight', '>f8', (nants, nants, nchan, npol))]
             data = numpy.zeros(shape=[ntimes], dtype=desc)
             data['index'] = list(range(ntimes))
@@ -0,0 +1,70 @@
+""" Benchmark of visibility presorting for the vectorised gridder and degridder.
+
+Visibilities are generated along elliptical uv tracks in time and baseline order, as they arrive from a
+telescope, and then gridded and degridded with and without the tile order given by convolutional_grid_sort.
+
+    python presort_gridding.py [npixel] [nvis]
+
+The default is npixel=4096 with padding 2 i.e. an 8192 x 8192 grid (1GB).
+"""
+import sys
+import time
+
+import numpy
+
+from processing_library.fourier_transforms.convolutional_gridding import anti_aliasing_calculate_separable, \
+    convolutional_grid_vectorised, convolutional_degrid_vectorised, convolutional_grid_coordinates, \
+    convolutional_grid_sort
+
+
+def uv_tracks(nvis, nbaselines=8128, maxuv=0.2, seed=1781):
+    """ Make uv coordinates (as grid fractions) along elliptical tracks, ordered by time and then baseline
+    """
+    rng = numpy.random.RandomState(seed)
+    ntimes = max(1, nvis // nbaselines)
+    ha = numpy.linspace(-numpy.pi / 3, numpy.pi / 3, ntimes)[:, numpy.newaxis]
+    radius = maxuv * numpy.sqrt(rng.uniform(0.0, 1.0, nbaselines))
+    angle = rng.uniform(0.0, 2.0 * numpy.pi, nbaselines)
+    u = radius * numpy.cos(angle + ha)
+    v = 0.6 * radius * numpy.sin(angle + ha)
+    return numpy.stack([u.ravel(), v.ravel()], axis=1)
+
+
+if __name__ == '__main__':
+    npixel = int(sys.argv[1]) if len(sys.argv) > 1 else 4096
+    nvis = int(sys.argv[2]) if len(sys.argv) > 2 else 2000000
+    padding = 2
+    npol = 1
+    
+    shape = [1, npol, padding * npixel, padding * npixel]
+    _, kernel = anti_aliasing_calculate_separable((padding * npixel, padding * npixel), 8)
+    uvcoords = uv_tracks(nvis)
+    nvis = uvcoords.shape[0]
+    kernel_list = (numpy.zeros([nvis], dtype='int'), [kernel])
+    frequencymap = numpy.zeros([nvis], dtype='int')
+    vis = numpy.ones([nvis, npol], dtype='complex')
+    visweights = numpy.ones([nvis, npol])
+    print("Grid %d x %d, %d visibilities" % (shape[2], shape[3], nvis))
+    
+    coords = convolutional_grid_coordinates(kernel_list, shape, uvcoords, frequencymap)
+    start = time.time()
+    order = convolutional_grid_sort(shape, coords[0], coords[2], coords[4])
+    print("Sort: %.2f s" % (time.time() - start))
+    
+    results = dict()
+    for name, gorder in [('unsorted', None), ('presorted', order)]:
+        uvgrid = numpy.zeros(shape, dtype='complex')
+        start = time.time()
+        uvgrid, _ = convolutional_grid_vectorised(kernel_list, uvgrid, vis, visweights, uvcoords, frequencymap,
+                                                  coordinates=coords, order=gorder)
+        grid_time = time.time() - start
+        start = time.time()
+        dvis = convolutional_degrid_vectorised(kernel_list, vis.shape, uvgrid, uvcoords, frequencymap,
+                                               coordinates=coords, order=gorder)
+        degrid_time = time.time() - start
+        results[name] = (uvgrid[0, 0, ::64, ::64].copy(), dvis)
+        print("%s: grid %.2f s, degrid %.2f s" % (name, grid_time, degrid_time))
+        del uvgrid
+    
+    assert numpy.allclose(results['unsorted'][0], results['presorted'][0])
+    assert numpy.allclose(results['unsorted'][1], results['presorted'][1])
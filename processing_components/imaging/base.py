@@ -33,36 +33,47 @@ from data_models.memory_data_models import Visibility, BlockVisibility, Image, S
 from data_models.parameters import get_parameter
 from data_models.polarisation import convert_pol_frame, PolarisationFrame
 
-from processing_library.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid
-from processing_library.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
+from processing_library.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid, \
+    convolutional_grid_vectorised, convolutional_degrid_vectorised, convolutional_grid_coordinates, \
+    convolutional_grid_sort, convolutional_grid_coordinates_hermitian
+from processing_library.fourier_transforms.direct_fourier_transform import dft_point_sources, \
+    dft_point_sources_block
+from processing_library.fourier_transforms.fft_backend import configure_fft_backend
+from processing_library.fourier_transforms.fft_support import pad_fft, ifft_extract, extract_mid, fft_hermitian, \
+    ifft_hermitian, hermitian_half_width
 from processing_library.image.operations import create_image_from_array
-from processing_library.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_kernel_list
-from processing_library.util.coordinate_support import simulate_point, skycoord_to_lmn
+from processing_library.imaging.imaging_params import get_frequency_map, get_uvw_map, get_kernel_list, \
+    get_padding, get_precision_dtypes, GriddingPlan, gridding_plan_key
+from processing_library.util.coordinate_support import simulate_point, simulate_point_block, skycoord_to_lmn, \
+    skycoords_to_lmn
 
-from ..visibility.base import copy_visibility, phaserotate_visibility
+from ..visibility.base import copy_visibility, phaserotate_visibility, phaserotate_blockvisibility
 from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility, convert_blockvisibility_to_visibility
 
 log = logging.getLogger(__name__)
 
 
-def shift_vis_to_image(vis: Visibility, im: Image, tangent: bool = True, inverse: bool = False) \
-        -> Visibility:
+def shift_vis_to_image(vis: Union[Visibility, BlockVisibility], im: Image, tangent: bool = True,
+                       inverse: bool = False) -> Union[Visibility, BlockVisibility]:
     """Shift visibility to the FFT phase centre of the image in place
 
-    :param vis: Visibility data
+    A BlockVisibility is shifted by phaserotate_blockvisibility, without coalescing.
+
+    :param vis: Visibility or BlockVisibility data
     :param im: Image model used to determine phase centre
     :param tangent: Is the shift purely on the tangent plane True|False
     :param inverse: Do the inverse operation True|False
     :return: visibility with phase shift applied and phasecentre updated
 
     """
-    assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
+    assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), \
+        "vis is not a Visibility or a BlockVisibility: %r" % vis
     
     nchan, npol, ny, nx = im.data.shape
     
     # Convert the FFT definition of the phase center to world coordinates (1 relative)
-    # This is the only place in ARL where the relationship between the image and visibility
-    # frames is defined.
+    # This and image_phase_shift are the only places in ARL where the relationship between the image
+    # and visibility frames is defined.
     
     image_phasecentre = pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, im.wcs, origin=1)
     if vis.phasecentre.separation(image_phasecentre).rad > 1e-15:
@@ -72,14 +83,38 @@ def shift_vis_to_image(vis: Visibility, im: Image, tangent: bool = True, inverse
         else:
             log.debug("shift_vis_from_image: shifting phasecentre from vis phasecentre %s to image phasecentre %s" %
                       (vis.phasecentre, image_phasecentre))
-        vis = phaserotate_visibility(vis, image_phasecentre, tangent=tangent, inverse=inverse)
-        vis.phasecentre = im.phasecentre
-    
-    assert isinstance(vis, Visibility), "after phase_rotation, vis is not a Visibility"
+        if isinstance(vis, BlockVisibility):
+            vis = phaserotate_blockvisibility(vis, image_phasecentre, tangent=tangent, inverse=inverse)
+        else:
+            vis = phaserotate_visibility(vis, image_phasecentre, tangent=tangent, inverse=inverse)
+        if inverse:
+            vis.phasecentre = im.phasecentre
+        else:
+            # The image phase centre differs from im.phasecentre for a facet
+            vis.phasecentre = image_phasecentre
     
     return vis
 
 
+def image_phase_shift(vis: Visibility, im: Image):
+    """ Direction cosines of the FFT phase centre of the image relative to the visibility phase centre
+
+    The visibility is shifted to the image by multiplying by numpy.conjugate(simulate_point(vis.uvw, l, m)), as
+    done by shift_vis_to_image.
+
+    :param vis: Visibility data
+    :param im: Image model used to determine phase centre
+    :return: (l, m), or None if no shift is needed
+    """
+    nchan, npol, ny, nx = im.data.shape
+    image_phasecentre = pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, im.wcs, origin=1)
+    if vis.phasecentre.separation(image_phasecentre).rad > 1e-15:
+        l, m, n = skycoord_to_lmn(image_phasecentre, vis.phasecentre)
+        if numpy.abs(n) > 1e-15:
+            return l, m
+    return None
+
+
 def normalize_sumwt(im: Image, sumwt) -> Image:
     """Normalize out the sum of weights
 
@@ -100,6 +135,90 @@ def normalize_sumwt(im: Image, sumwt) -> Image:
     return im
 
 
+def create_gridding_plan(vis: Union[BlockVisibility, Visibility], im: Image, **kwargs) -> GriddingPlan:
+    """ Precompute the gridding information used by predict_2d and invert_2d
+
+    The frequency map, uvw map, kernels, gcf and grid coordinates depend only on the uvw sampling, the image
+    geometry and the kernel parameters. Pass the plan to predict_2d and invert_2d as gridding_plan to avoid
+    recalculating them on every call e.g. in every major cycle.
+
+    :param vis: Visibility or BlockVisibility to be gridded
+    :param im: Image template
+    :param kwargs: Gridding parameters as for predict_2d and invert_2d
+    :param presort: Grid the visibilities in order of uv tile and kernel (True)
+    :param presort_tile_size: Size of the uv tiles in grid cells (32)
+    :param precision: 'double' or 'single': precision of the gcf ('double')
+    :param real_fft: Also calculate the coordinates on the u >= 0 half of the grid (False)
+    :return: GriddingPlan
+    """
+    if isinstance(vis, BlockVisibility):
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+    
+    assert isinstance(avis, Visibility), avis
+    
+    padding = {'padding': get_padding(**kwargs)}
+    spectral_mode, vfrequencymap = get_frequency_map(avis, im)
+    vfrequencymap = numpy.array(vfrequencymap, dtype='int')
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, im, **padding)
+    kernel_name, gcf, kernel_list = get_kernel_list(avis, im, **kwargs)
+    gcf = gcf.astype(get_precision_dtypes(**kwargs)[1], copy=False)
+    
+    nchan, npol, ny, nx = im.data.shape
+    gridshape = [nchan, npol, int(round(padding * ny)), int(round(padding * nx))]
+    coordinates = convolutional_grid_coordinates(kernel_list, gridshape, vuvwmap, vfrequencymap)
+    
+    # Grid the visibilities tile by tile rather than in time and baseline order
+    order = None
+    if get_parameter(kwargs, "presort", True):
+        chan, kind, y, _, x, _ = coordinates
+        if len(kernel_list[1]) == 1:
+            kind = None
+        order = convolutional_grid_sort(gridshape, chan, y, x, kind,
+                                        tile_size=get_parameter(kwargs, "presort_tile_size", 32))
+    
+    # Coordinates on the u >= 0 half of the grid, for real images made with real to complex FFTs
+    hermitian = None
+    if get_parameter(kwargs, "real_fft", False):
+        if len(kernel_list[1]) == 1:
+            hcoordinates, mirrored, x0 = convolutional_grid_coordinates_hermitian(kernel_list, gridshape, vuvwmap,
+                                                                                  vfrequencymap)
+            horder = None
+            if get_parameter(kwargs, "presort", True):
+                chan, _, y, _, x, _ = hcoordinates
+                hshape = gridshape[:3] + [hermitian_half_width(gridshape[3], x0)]
+                horder = convolutional_grid_sort(hshape, chan, y, x,
+                                                 tile_size=get_parameter(kwargs, "presort_tile_size", 32))
+            hermitian = (hcoordinates, mirrored, x0, horder)
+        else:
+            log.warning("create_gridding_plan: real_fft needs a single convolution kernel, using the full grid")
+    
+    return GriddingPlan(key=gridding_plan_key(avis, im, **kwargs), spectral_mode=spectral_mode,
+                        vfrequencymap=vfrequencymap, uvw_mode=uvw_mode, shape=shape, padding=padding,
+                        vuvwmap=vuvwmap, kernel_name=kernel_name, gcf=gcf, kernel_list=kernel_list,
+                        coordinates=coordinates, order=order, hermitian=hermitian)
+
+
+def get_gridding_plan(vis: Visibility, im: Image, **kwargs) -> GriddingPlan:
+    """ Get the gridding plan for a visibility and image
+
+    The plan given as gridding_plan is used if it was made for the same visibility sampling, image geometry and
+    kernel parameters, otherwise a new plan is made.
+
+    :param vis: Visibility
+    :param im: Image template
+    :param gridding_plan: GriddingPlan from create_gridding_plan (optional)
+    :return: GriddingPlan
+    """
+    plan = get_parameter(kwargs, "gridding_plan", None)
+    if plan is not None:
+        if plan.key == gridding_plan_key(vis, im, **kwargs):
+            return plan
+        log.warning("get_gridding_plan: gridding plan does not match visibility, image or parameters, recalculating")
+    return create_gridding_plan(vis, im, **kwargs)
+
+
 def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
                     **kwargs) -> Union[BlockVisibility, Visibility]:
     """ Predict using convolutional degridding.
@@ -109,6 +228,16 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
 
     :param vis: Visibility to be predicted
     :param model: model image
+    :param vectorised: Use the vectorised degridder (True), otherwise loop over visibilities. Separable and ES
+        kernels are always degridded by the vectorised degridder
+    :param kernel: 'es' to use the exponential of semicircle kernel, with kernel_accuracy (1e-6)
+    :param presort: Degrid the visibilities in order of uv tile and kernel (True)
+    :param precision: 'double' or 'single': precision of the FFT and the uv grid ('double')
+    :param real_fft: Degrid from the u >= 0 half of the uv grid, made by a real to complex FFT (False). Only for a
+        single convolution kernel i.e. not w projection
+    :param fft_backend: FFT backend 'numpy', 'scipy', 'pyfftw' or 'auto' (see
+        :py:mod:`processing_library.fourier_transforms.fft_backend`), with fft_workers threads
+    :param gridding_plan: GriddingPlan from create_gridding_plan, reused if it applies (optional)
     :return: resulting visibility (in place works)
     """
     if isinstance(vis, BlockVisibility):
@@ -121,26 +250,40 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
     
     _, _, ny, nx = model.data.shape
     
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(avis, model)
-    polarisation_mode, vpolarisationmap = get_polarisation_map(avis, model)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, model, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(avis, model, **kwargs)
+    plan = get_gridding_plan(avis, model, **kwargs)
+    configure_fft_backend(**kwargs)
     
-    uvgrid = fft((pad_mid(model.data, int(round(padding * nx))) * gcf).astype(dtype=complex))
+    # Only the unpadded model is multiplied by the gcf. The padding is done within the transforms
+    npixel = int(round(plan.padding * nx))
+    model_gcf = model.data * extract_mid(plan.gcf, nx)
+    model_gcf = model_gcf.astype(get_precision_dtypes(**kwargs)[1], copy=False)
     
-    avis.data['vis'] = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap)
-    
-    # Now we can shift the visibility from the image frame to the original visibility frame
-    svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
+    if plan.hermitian is not None:
+        # The model is real so its grid is Hermitian and only the u >= 0 half is needed
+        hcoordinates, mirrored, x0, horder = plan.hermitian
+        uvgrid = fft_hermitian(model_gcf, x0, npixel)
+        newvis = convolutional_degrid_vectorised(plan.kernel_list, avis.data['vis'].shape, uvgrid, plan.vuvwmap,
+                                                 plan.vfrequencymap, coordinates=hcoordinates, order=horder)
+        newvis[mirrored] = numpy.conjugate(newvis[mirrored])
+        avis.data['vis'] = newvis
+    else:
+        uvgrid = pad_fft(model_gcf, npixel)
+        
+        if plan.kernel_name in ['2d_separable', 'es'] or get_parameter(kwargs, "vectorised", True):
+            avis.data['vis'] = convolutional_degrid_vectorised(plan.kernel_list, avis.data['vis'].shape, uvgrid,
+                                                               plan.vuvwmap, plan.vfrequencymap,
+                                                               coordinates=plan.coordinates, order=plan.order)
+        else:
+            avis.data['vis'] = convolutional_degrid(plan.kernel_list, avis.data['vis'].shape, uvgrid,
+                                                    plan.vuvwmap, plan.vfrequencymap)
     
-    if isinstance(vis, BlockVisibility) and isinstance(svis, Visibility):
+    # Now we can shift the visibility from the image frame to the original visibility frame. The phase rotation
+    # of a BlockVisibility factorises by antenna, so it is shifted after decoalescing
+    if isinstance(vis, BlockVisibility):
         log.debug("imaging.predict decoalescing post prediction")
-        return decoalesce_visibility(svis)
+        return shift_vis_to_image(decoalesce_visibility(avis), model, tangent=True, inverse=True)
     else:
-        return svis
+        return shift_vis_to_image(avis, model, tangent=True, inverse=True)
 
 
 def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True, **kwargs) \
@@ -152,48 +295,44 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms
     of this function. . Any shifting needed is performed here.
 
+    A Visibility is not copied: the phase rotation to the image phase centre is applied to one block of
+    rows at a time as the rows are gridded (see invert_2d_data). A BlockVisibility is phase rotated by
+    phaserotate_blockvisibility before it is coalesced.
+
     :param vis: Visibility to be inverted
     :param im: image template (not changed)
     :param dopsf: Make the psf instead of the dirty image
     :param normalize: Normalize by the sum of weights (True)
+    :param vectorised: Use the vectorised gridder (True), otherwise loop over visibilities. Separable and ES
+        kernels are always gridded by the vectorised gridder
+    :param kernel: 'es' to use the exponential of semicircle kernel, with kernel_accuracy (1e-6)
+    :param nthreads: Number of threads used by the vectorised gridder (1)
+    :param presort: Grid the visibilities in order of uv tile and kernel (True)
+    :param precision: 'double' or 'single': precision of the uv grid, the FFT and the resulting image. The sum
+        of weights is always accumulated in double precision ('double')
+    :param real_fft: Grid onto the u >= 0 half of the uv grid and make the image by a complex to real FFT
+        (False). Only for a single convolution kernel i.e. not w projection, and not with imaginary=True
+    :param fft_backend: FFT backend 'numpy', 'scipy', 'pyfftw' or 'auto' (see
+        :py:mod:`processing_library.fourier_transforms.fft_backend`), with fft_workers threads
+    :param gridding_plan: GriddingPlan from create_gridding_plan, reused if it applies (optional)
+    :param gridding_block_size: Number of visibilities shifted and gridded at a time (65536)
     :return: resulting image
 
     """
     if not isinstance(vis, Visibility):
-        svis = coalesce_visibility(vis, **kwargs)
+        if not dopsf:
+            # The phase rotation of a BlockVisibility factorises by antenna, so it is shifted before coalescing
+            vis = shift_vis_to_image(vis, im, tangent=True, inverse=False)
+        avis = coalesce_visibility(vis, **kwargs)
     else:
-        svis = copy_visibility(vis)
-    
-    if dopsf:
-        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
-    
-    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
-    
-    nchan, npol, ny, nx = im.data.shape
-    
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(svis, im)
-    polarisation_mode, vpolarisationmap = get_polarisation_map(svis, im)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(svis, im, **kwargs)
-    
-    # Optionally pad to control aliasing
-    imgridpad = numpy.zeros([nchan, npol, int(round(padding * ny)), int(round(padding * nx))], dtype='complex')
-    imgridpad, sumwt = convolutional_grid(vkernellist, imgridpad, svis.data['vis'], svis.data['imaging_weight'],
-                                          vuvwmap, vfrequencymap)
-    
-    # Fourier transform the padded grid to image, multiply by the gridding correction
-    # function, and extract the unpadded inner part.
+        avis = vis
     
-    # Normalise weights for consistency with transform
-    sumwt /= float(padding * int(round(padding * nx)) * ny)
+    plan = get_gridding_plan(avis, im, **kwargs)
     
     imaginary = get_parameter(kwargs, "imaginary", False)
+    result, sumwt = invert_2d_data(avis, im, plan, dirty=not dopsf, psf=dopsf, **kwargs)
     if imaginary:
         log.debug("invert_2d: retaining imaginary part of dirty image")
-        result = extract_mid(ifft(imgridpad) * gcf, npixel=nx)
         resultreal = create_image_from_array(result.real, im.wcs, im.polarisation_frame)
         resultimag = create_image_from_array(result.imag, im.wcs, im.polarisation_frame)
         if normalize:
@@ -201,61 +340,423 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
             resultimag = normalize_sumwt(resultimag, sumwt)
         return resultreal, sumwt, resultimag
     else:
-        result = extract_mid(numpy.real(ifft(imgridpad)) * gcf, npixel=nx)
         resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
         if normalize:
             resultimage = normalize_sumwt(resultimage, sumwt)
         return resultimage, sumwt
 
 
+def invert_2d_data(vis: Visibility, im: Image, plan: GriddingPlan, dirty=True, psf=False, model_uvgrid=None,
+                   **kwargs) -> (numpy.ndarray, numpy.ndarray):
+    """ Grid a visibility using a gridding plan and transform to the unpadded image
+
+    The visibility is gridded a block of rows at a time. Each block is formed in a scratch buffer from the
+    visibilities (dirty) and/or unit visibilities (psf), side by side if both, shifted to the image phase centre
+    and, if model_uvgrid is given, with the model degridded from it subtracted. The visibility is not changed.
+
+    :param vis: Visibility (not changed)
+    :param im: image template (not changed)
+    :param plan: GriddingPlan for the visibility and im
+    :param dirty: Grid the visibilities (True)
+    :param psf: Grid unit visibilities (False)
+    :param model_uvgrid: Padded uv grid of the model to subtract, the u >= 0 half if plan.hermitian (optional)
+    :param imaginary: Keep the imaginary part of the image (False)
+    :param gridding_block_size: Number of visibilities shifted and gridded at a time (65536)
+    :return: image data [nchan, npol, ny, nx] (complex if imaginary), sumwt [nchan, npol], where npol is twice
+        that of the visibility if both dirty and psf
+    """
+    assert dirty or psf, "invert_2d_data: nothing to grid"
+    assert model_uvgrid is None or not psf, "invert_2d_data: cannot subtract a model from the psf"
+    nchan, _, ny, nx = im.data.shape
+    npol = vis.npol
+    
+    configure_fft_backend(**kwargs)
+    padding = plan.padding
+    
+    griddtype, _ = get_precision_dtypes(**kwargs)
+    
+    imaginary = get_parameter(kwargs, "imaginary", False)
+    hermitian = plan.hermitian is not None and not imaginary
+    nthreads = get_parameter(kwargs, "nthreads", 1)
+    
+    # Optionally pad to control aliasing
+    if hermitian:
+        # Only the real part of the image is wanted so grid onto the u >= 0 half of the grid
+        coordinates, mirrored, x0, order = plan.hermitian
+        nu = hermitian_half_width(int(round(padding * nx)), x0)
+    else:
+        coordinates, order = plan.coordinates, plan.order
+        nu = int(round(padding * nx))
+    vectorised = hermitian or plan.kernel_name in ['2d_separable', 'es'] or get_parameter(kwargs, "vectorised",
+                                                                                         True)
+    ngridpol = npol * (int(dirty) + int(psf))
+    imgridpad = numpy.zeros([nchan, ngridpol, int(round(padding * ny)), nu], dtype=griddtype)
+    
+    lm = image_phase_shift(vis, im)
+    if order is None:
+        order = numpy.arange(vis.nvis)
+    block_size = get_parameter(kwargs, "gridding_block_size", 2 ** 16)
+    sumwt = numpy.zeros([nchan, ngridpol])
+    for start in range(0, len(order), block_size):
+        rows = order[start:start + block_size]
+        kernel_list = (plan.kernel_list[0][rows], plan.kernel_list[1])
+        vuvwmap = plan.vuvwmap[rows]
+        vfrequencymap = plan.vfrequencymap[rows]
+        
+        # Form the block in a scratch buffer
+        parts = list()
+        if lm is not None:
+            phasor = numpy.conjugate(simulate_point(vis.uvw[rows], *lm))[:, numpy.newaxis]
+        if dirty:
+            block = vis.data['vis'][rows]
+            if lm is not None:
+                block *= phasor
+            parts.append(block)
+        if psf:
+            if lm is not None:
+                parts.append(numpy.repeat(phasor, npol, axis=1))
+            else:
+                parts.append(numpy.ones([len(rows), npol], dtype='complex'))
+        block = parts[0] if len(parts) == 1 else numpy.concatenate(parts, axis=1)
+        weights = vis.data['imaging_weight'][rows]
+        if len(parts) > 1:
+            weights = numpy.concatenate([weights, weights], axis=1)
+        if hermitian:
+            block[mirrored[rows]] = numpy.conjugate(block[mirrored[rows]])
+        
+        if vectorised:
+            bcoordinates = tuple(c[rows] for c in coordinates)
+            if model_uvgrid is not None:
+                block -= convolutional_degrid_vectorised(kernel_list, block.shape, model_uvgrid, vuvwmap,
+                                                         vfrequencymap, coordinates=bcoordinates)
+            imgridpad, bsumwt = convolutional_grid_vectorised(kernel_list, imgridpad, block, weights, vuvwmap,
+                                                              vfrequencymap, nthreads=nthreads,
+                                                              coordinates=bcoordinates)
+        else:
+            if model_uvgrid is not None:
+                block -= convolutional_degrid(kernel_list, block.shape, model_uvgrid, vuvwmap, vfrequencymap)
+            imgridpad, bsumwt = convolutional_grid(kernel_list, imgridpad, block, weights, vuvwmap, vfrequencymap)
+        sumwt += bsumwt
+    
+    return invert_2d_grid(imgridpad, sumwt, im, padding, plan.gcf, hermitian=hermitian, imaginary=imaginary)
+
+
+def invert_2d_grid(imgridpad, sumwt, im: Image, padding, gcf, hermitian=False, imaginary=False) \
+        -> (numpy.ndarray, numpy.ndarray):
+    """ Transform a padded uv grid to the unpadded image and apply the gridding correction function
+
+    :param imgridpad: Padded uv grid [nchan, npol, ny, nx], or its u >= 0 half if hermitian (destroyed)
+    :param sumwt: Sum of weights from gridding [nchan, npol]
+    :param im: image template (not changed)
+    :param padding: Padding factor of the grid
+    :param gcf: Gridding correction function of the padded grid
+    :param hermitian: imgridpad is the u >= 0 half of the grid of a real image (False)
+    :param imaginary: Keep the imaginary part of the image (False)
+    :return: image data [nchan, npol, ny, nx] (complex if imaginary), sumwt [nchan, npol]
+    """
+    _, _, ny, nx = im.data.shape
+    
+    # Fourier transform the padded grid to image, multiply by the gridding correction
+    # function, and extract the unpadded inner part.
+    
+    # Normalise weights for consistency with transform
+    sumwt /= float(padding * int(round(padding * nx)) * ny)
+    
+    # Only the unpadded image is calculated and multiplied by the gcf
+    gcf = extract_mid(gcf, nx)
+    if imaginary:
+        return ifft_extract(imgridpad, nx) * gcf, sumwt
+    elif hermitian:
+        return ifft_hermitian(imgridpad, int(round(padding * nx)), nextract=nx) * gcf, sumwt
+    else:
+        return numpy.real(ifft_extract(imgridpad, nx)) * gcf, sumwt
+
+
+def invert_2d_dirty_psf(vis: Visibility, im: Image, normalize: bool = True, **kwargs) \
+        -> ((Image, numpy.ndarray), (Image, numpy.ndarray)):
+    """ Invert to both the dirty image and the PSF in one pass over the visibility
+
+    The visibilities and unit visibilities are gridded side by side, so the coordinates are calculated and the
+    visibility shifted only once. The parameters are as for invert_2d, apart from imaginary which is not
+    supported.
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param normalize: Normalize by the sum of weights (True)
+    :param gridding_plan: GriddingPlan from create_gridding_plan, reused if it applies (optional)
+    :return: (dirty image, sum of weights), (psf, sum of weights)
+    """
+    assert not get_parameter(kwargs, "imaginary", False), "invert_2d_dirty_psf: imaginary is not supported"
+    
+    if not isinstance(vis, Visibility):
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+    
+    plan = get_gridding_plan(avis, im, **kwargs)
+    result, sumwt = invert_2d_data(avis, im, plan, dirty=True, psf=True, **kwargs)
+    
+    npol = avis.npol
+    results = list()
+    for pols in [slice(0, npol), slice(npol, 2 * npol)]:
+        resultimage = create_image_from_array(result[:, pols, ...], im.wcs, im.polarisation_frame)
+        if normalize:
+            resultimage = normalize_sumwt(resultimage, sumwt[:, pols])
+        results.append((resultimage, sumwt[:, pols]))
+    return results[0], results[1]
+
+
+def residual_2d(vis: Union[BlockVisibility, Visibility], model: Image, normalize: bool = True, **kwargs) \
+        -> (Image, numpy.ndarray):
+    """ Residual image using convolutional gridding, without making the model visibility
+
+    For each block of rows the model is degridded, subtracted from the visibility and the residual gridded
+    straight away, so only one block of model visibilities exists at a time. Apart from the visibility, the
+    memory needed is that of the model and residual uv grids. The parameters are as for predict_2d and
+    invert_2d, and the image is the same as from residual_image with predict_2d and invert_2d.
+
+    :param vis: Visibility (not changed)
+    :param model: model image
+    :param normalize: Normalize by the sum of weights (True)
+    :param gridding_block_size: Number of visibilities to degrid, subtract and grid at a time (65536)
+    :param gridding_plan: GriddingPlan from create_gridding_plan, reused if it applies (optional)
+    :return: residual image, sum of weights
+    """
+    assert not get_parameter(kwargs, "imaginary", False), "residual_2d: imaginary is not supported"
+    
+    if not isinstance(vis, Visibility):
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+    
+    _, _, ny, nx = model.data.shape
+    
+    plan = get_gridding_plan(avis, model, **kwargs)
+    configure_fft_backend(**kwargs)
+    
+    npixel = int(round(plan.padding * nx))
+    model_gcf = model.data * extract_mid(plan.gcf, nx)
+    model_gcf = model_gcf.astype(get_precision_dtypes(**kwargs)[1], copy=False)
+    
+    if plan.hermitian is not None:
+        uvgrid = fft_hermitian(model_gcf, plan.hermitian[2], npixel)
+    else:
+        uvgrid = pad_fft(model_gcf, npixel)
+    
+    result, sumwt = invert_2d_data(avis, model, plan, model_uvgrid=uvgrid, **kwargs)
+    resultimage = create_image_from_array(result, model.wcs, model.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    return resultimage, sumwt
+
+
+def blockvisibility_uvw_map(vis: BlockVisibility, im: Image, times: slice, baselines=None):
+    """ uvw in wavelengths, and its map to grid fractions, for a range of times of a BlockVisibility
+
+    The uvw of each channel is calculated from the uvw in metres as uvw * frequency / c. The rows are in the order
+    of vis.data['vis'][times][:, antenna2, antenna1, ...] flattened over time, baseline and channel.
+
+    :param vis: BlockVisibility
+    :param im: Image template
+    :param times: slice of the times
+    :param baselines: (antenna2, antenna1) of the baselines (default all pairs of antennas)
+    :return: uvw [nrows, 3] (wavelengths), vuvwmap [nrows, 3]
+    """
+    uvw = vis.data['uvw'][times]
+    if baselines is not None:
+        uvw = uvw[:, baselines[0], baselines[1], :]
+    scale = vis.frequency / constants.c.value
+    uvw = (uvw.reshape([-1, 1, 3]) * scale[numpy.newaxis, :, numpy.newaxis]).reshape([-1, 3])
+    uvwscale = numpy.zeros([3])
+    uvwscale[0:2] = im.wcs.wcs.cdelt[0:2] * numpy.pi / 180.0
+    return uvw, uvwscale * uvw
+
+
+def blockvisibility_kernel_list(vis: BlockVisibility, im: Image, **kwargs):
+    """ Kernel and gcf for gridding a BlockVisibility directly
+
+    :param vis: BlockVisibility
+    :param im: Image template
+    :return: kernel name, gcf, kernels, padding
+    """
+    kernel_name, gcf, kernel_list = get_kernel_list(vis, im, **kwargs)
+    assert kernel_name != 'wprojection', "BlockVisibility gridding does not support w projection"
+    gcf = gcf.astype(get_precision_dtypes(**kwargs)[1], copy=False)
+    return kernel_name, gcf, kernel_list[1], get_padding(**kwargs)
+
+
+def predict_2d_blockvisibility(vis: BlockVisibility, model: Image, **kwargs) -> BlockVisibility:
+    """ Predict a BlockVisibility using convolutional degridding, without coalescing it to a Visibility
+
+    The visibilities of all pairs of antennas are degridded a block of times at a time, with the uvw of
+    each channel calculated on the fly, shifted by phasors factorised by antenna (see simulate_point_block) and
+    written into vis.data['vis']. The parameters are as for predict_2d,
+    apart from w projection and real_fft which are not supported.
+
+    :param vis: BlockVisibility to be predicted
+    :param model: model image
+    :param gridding_block_size: Approximate number of visibilities degridded at a time (65536)
+    :return: resulting BlockVisibility (in place works)
+    """
+    assert isinstance(vis, BlockVisibility), vis
+    
+    _, _, ny, nx = model.data.shape
+    kernel_name, gcf, kernels, padding = blockvisibility_kernel_list(vis, model, **kwargs)
+    configure_fft_backend(**kwargs)
+    
+    # Only the unpadded model is multiplied by the gcf. The padding is done within the transforms
+    npixel = int(round(padding * nx))
+    model_gcf = model.data * extract_mid(gcf, nx)
+    model_gcf = model_gcf.astype(get_precision_dtypes(**kwargs)[1], copy=False)
+    uvgrid = pad_fft(model_gcf, npixel)
+    vectorised = kernel_name in ['2d_separable', 'es'] or get_parameter(kwargs, "vectorised", True)
+    
+    _, chanmap = get_frequency_map(vis, model)
+    chanmap = numpy.array(chanmap, dtype='int')
+    lm = image_phase_shift(vis, model)
+    ntimes, nants, _, nchan, npol = vis.data['vis'].shape
+    block_times = max(1, get_parameter(kwargs, "gridding_block_size", 2 ** 16) // (nants * nants * nchan))
+    for start in range(0, ntimes, block_times):
+        times = slice(start, min(start + block_times, ntimes))
+        uvw, vuvwmap = blockvisibility_uvw_map(vis, model, times)
+        vfrequencymap = numpy.tile(chanmap, len(uvw) // nchan)
+        kernel_list = (numpy.zeros(len(uvw), dtype='int'), kernels)
+        if vectorised:
+            newvis = convolutional_degrid_vectorised(kernel_list, (len(uvw), npol), uvgrid, vuvwmap, vfrequencymap)
+        else:
+            newvis = convolutional_degrid(kernel_list, (len(uvw), npol), uvgrid, vuvwmap, vfrequencymap)
+        newvis = newvis.reshape(vis.data['vis'][times].shape)
+        if lm is not None:
+            # Shift from the image phase centre to the visibility phase centre
+            newvis *= simulate_point_block(vis.data['uvw'][times], vis.frequency, *lm)[..., numpy.newaxis]
+        vis.data['vis'][times] = newvis
+    
+    return vis
+
+
+def invert_2d_blockvisibility(vis: BlockVisibility, im: Image, dopsf: bool = False, normalize: bool = True,
+                              **kwargs) -> (Image, numpy.ndarray):
+    """ Invert a BlockVisibility using convolutional gridding, without coalescing it to a Visibility
+
+    The baselines antenna2 > antenna1 are gridded a block of times at a time, with the uvw of each channel
+    calculated on the fly and the phasors of the shift factorised by antenna (see simulate_point_block). As for a coalesced BlockVisibility, the imaging weights are one. The parameters are as
+    for invert_2d, apart from w projection, real_fft and imaginary which are not supported.
+
+    :param vis: BlockVisibility to be inverted (not changed)
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param gridding_block_size: Approximate number of visibilities gridded at a time (65536)
+    :return: resulting image, sum of weights
+    """
+    assert isinstance(vis, BlockVisibility), vis
+    
+    nchan, _, ny, nx = im.data.shape
+    kernel_name, gcf, kernels, padding = blockvisibility_kernel_list(vis, im, **kwargs)
+    configure_fft_backend(**kwargs)
+    
+    griddtype, _ = get_precision_dtypes(**kwargs)
+    vectorised = kernel_name in ['2d_separable', 'es'] or get_parameter(kwargs, "vectorised", True)
+    presort = get_parameter(kwargs, "presort", True)
+    nthreads = get_parameter(kwargs, "nthreads", 1)
+    
+    ntimes, nants, _, vnchan, npol = vis.data['vis'].shape
+    gridshape = [nchan, npol, int(round(padding * ny)), int(round(padding * nx))]
+    imgridpad = numpy.zeros(gridshape, dtype=griddtype)
+    sumwt = numpy.zeros([nchan, npol])
+    
+    _, chanmap = get_frequency_map(vis, im)
+    chanmap = numpy.array(chanmap, dtype='int')
+    lm = image_phase_shift(vis, im)
+    antenna2, antenna1 = numpy.tril_indices(nants, -1)
+    block_times = max(1, get_parameter(kwargs, "gridding_block_size", 2 ** 16) // (len(antenna1) * vnchan))
+    for start in range(0, ntimes, block_times):
+        times = slice(start, min(start + block_times, ntimes))
+        uvw, vuvwmap = blockvisibility_uvw_map(vis, im, times, (antenna2, antenna1))
+        vfrequencymap = numpy.tile(chanmap, len(uvw) // vnchan)
+        kernel_list = (numpy.zeros(len(uvw), dtype='int'), kernels)
+        
+        # Form the block in a scratch buffer
+        if dopsf:
+            block = numpy.ones([len(uvw), npol], dtype='complex')
+        else:
+            block = vis.data['vis'][times][:, antenna2, antenna1, ...].reshape([-1, npol])
+        if lm is not None:
+            phasor = simulate_point_block(vis.data['uvw'][times], vis.frequency, *lm)[:, antenna2, antenna1, :]
+            block *= numpy.conjugate(phasor).reshape([-1, 1])
+        weights = numpy.ones([len(uvw), npol])
+        
+        if vectorised:
+            coordinates = convolutional_grid_coordinates(kernel_list, gridshape, vuvwmap, vfrequencymap)
+            order = None
+            if presort:
+                chan, _, y, _, x, _ = coordinates
+                order = convolutional_grid_sort(gridshape, chan, y, x,
+                                                tile_size=get_parameter(kwargs, "presort_tile_size", 32))
+            imgridpad, bsumwt = convolutional_grid_vectorised(kernel_list, imgridpad, block, weights, vuvwmap,
+                                                              vfrequencymap, nthreads=nthreads,
+                                                              coordinates=coordinates, order=order)
+        else:
+            imgridpad, bsumwt = convolutional_grid(kernel_list, imgridpad, block, weights, vuvwmap, vfrequencymap)
+        sumwt += bsumwt
+    
+    result, sumwt = invert_2d_grid(imgridpad, sumwt, im, padding, gcf)
+    resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    return resultimage, sumwt
+
+
 def predict_skycomponent_visibility(vis: Union[Visibility, BlockVisibility],
-                                    sc: Union[Skycomponent, List[Skycomponent]]) -> Union[Visibility, BlockVisibility]:
+                                    sc: Union[Skycomponent, List[Skycomponent]], **kwargs) \
+        -> Union[Visibility, BlockVisibility]:
     """Predict the visibility from a Skycomponent, add to existing visibility, for Visibility or BlockVisibility
 
+    All the components are predicted together by a DFT (see
+    :py:mod:`processing_library.fourier_transforms.direct_fourier_transform`), in chunks of components and
+    visibilities. For a BlockVisibility the phasors are factorised by antenna.
+
     :param vis: Visibility or BlockVisibility
     :param sc: Skycomponent or list of SkyComponents
+    :param dft_block_size: Approximate number of phasors evaluated at a time (1048576)
+    :param nthreads: Number of threads predicting chunks of visibilities (1)
     :return: Visibility or BlockVisibility
     """
     if not isinstance(sc, collections.Iterable):
         sc = [sc]
+    if len(sc) == 0:
+        return vis
+    
+    for comp in sc:
+        assert_same_chan_pol(vis, comp)
+    
+    l, m, _ = skycoords_to_lmn([comp.direction for comp in sc], vis.phasecentre)
+    block_size = get_parameter(kwargs, "dft_block_size", 2 ** 20)
+    nthreads = get_parameter(kwargs, "nthreads", 1)
 
     if isinstance(vis, Visibility):
     
         _, im_nchan = list(get_frequency_map(vis, None))
-        npol = vis.polarisation_frame.npol
         
         for comp in sc:
             assert isinstance(comp, Skycomponent), comp
-
-            assert_same_chan_pol(vis, comp)
-            
-            l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
-            phasor = simulate_point(vis.uvw, l, m)
-            for ivis in range(vis.nvis):
-                for pol in range(npol):
-                    vis.data['vis'][ivis, pol] += comp.flux[im_nchan[ivis], pol] * phasor[ivis]
+        flux = numpy.array([comp.flux for comp in sc])
+        
+        vis.data['vis'] += dft_point_sources(vis.uvw, im_nchan, flux, l, m, block_size=block_size,
+                                             nthreads=nthreads)
                 
     elif isinstance(vis, BlockVisibility):
         
-        ntimes, nant, _, nchan, npol = vis.vis.shape
-    
-        k = numpy.array(vis.frequency) / constants.c.to('m s^-1').value
-    
+        flux = list()
         for comp in sc:
-#            assert isinstance(comp, Skycomponent), comp
-            assert_same_chan_pol(vis, comp)
-    
-            flux = comp.flux
             if comp.polarisation_frame != vis.polarisation_frame:
-                flux = convert_pol_frame(flux, comp.polarisation_frame, vis.polarisation_frame)
+                flux.append(convert_pol_frame(comp.flux, comp.polarisation_frame, vis.polarisation_frame))
+            else:
+                flux.append(comp.flux)
+        flux = numpy.array(flux)
         
-            l, m, n = skycoord_to_lmn(comp.direction, vis.phasecentre)
-            uvw = vis.uvw[..., numpy.newaxis] * k
-            phasor = numpy.ones([ntimes, nant, nant, nchan, npol], dtype='complex')
-            for chan in range(nchan):
-                phasor[:,:,:,chan,:] = simulate_point(uvw[...,chan], l, m)[...,numpy.newaxis]
-                
-            vis.data['vis'][..., :, :] += flux[:, :] * phasor[..., :]
+        vis.data['vis'] += dft_point_sources_block(vis.uvw, vis.frequency, flux, l, m, block_size=block_size,
+                                                   nthreads=nthreads)
 
     return vis
 
@@ -274,6 +775,7 @@ def create_image_from_visibility(vis, **kwargs) -> Image:
     :param frame: Coordinate frame for WCS (ICRS)
     :param equinox: Equinox for WCS (2000.0)
     :param nchan: Number of image channels (Default is 1 -> MFS)
+    :param precision: 'double' or 'single': precision of the image data ('double')
     :return: image
     """
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), \
@@ -356,13 +858,16 @@ def create_image_from_visibility(vis, **kwargs) -> Image:
     w.wcs.radesys = get_parameter(kwargs, 'frame', 'ICRS')
     w.wcs.equinox = get_parameter(kwargs, 'equinox', 2000.0)
     
-    return create_image_from_array(numpy.zeros(shape), wcs=w, polarisation_frame=pol_frame)
+    _, imagedtype = get_precision_dtypes(**kwargs)
+    return create_image_from_array(numpy.zeros(shape, dtype=imagedtype), wcs=w, polarisation_frame=pol_frame)
 
 
 def residual_image(vis: Visibility, model: Image, invert_residual=invert_2d, predict_residual=predict_2d,
                    **kwargs) -> Tuple[Visibility, Image, numpy.ndarray]:
     """Calculate residual image and visibility
 
+    See residual_2d for the residual image alone, without making the model and residual visibilities.
+
     :param vis: Visibility to be inverted
     :param im: image template (not changed)
     :param invert: invert to be used (default invert_2d)
@@ -496,6 +1001,95 @@ def advise_wide_field(vis: Visibility, delA=0.02, oversampling_synthesised_beam=
     return locals()
 
 
+def advise_wstack_wprojection(advice, npixel=None, cellsize=None, padding=2, oversampling=8, kernel_reuse=1,
+                              relative_gridding_cost=5.0, max_kernelwidth=64):
+    """ Advise on the split between w stacking and w projection for the wstack_wprojection context
+
+    The w range is divided into vis_slices stacks, each needing a full size FFT, and the residual w within each
+    stack is corrected by w projection kernels, whose support grows with the width of the stack. The number of
+    stacks is chosen to minimise the estimated number of operations::
+
+        vis_slices * 5 N**2 log2(N**2) + nkernels * 5 M log2(M) (N + oversampling * (kernelwidth + 2)) / kernel_reuse
+            + relative_gridding_cost * nvis * 8 kernelwidth**2
+
+    where N is the padded image size and M = oversampling * N. The middle term is the calculation of the w
+    kernels, which are cached and so shared by kernel_reuse calls of invert and predict. If w stacking alone is
+    cheapest, wstep is zero so that no w kernels are needed.
+
+    The kernel width for a stack of half width w is the spread 2 w F tan(F/2) of the w screen over the padded
+    field of view F, added in quadrature to the 8 pixel support of the anti-aliasing function. This is close to
+    the support holding all but 1e-4 of the energy of the kernel (see :py:func:`energy_kernel_support`).
+
+    For example::
+
+        advice = advise_wide_field(vis, delA)
+        hybrid = advise_wstack_wprojection(advice)
+        dirty = invert_list_serial_workflow(vis_list, model_list, context='wstack_wprojection', **hybrid)
+
+    :param advice: Advice from advise_wide_field
+    :param npixel: Number of pixels on image axis (default from advice)
+    :param cellsize: Cellsize (radians) (default from advice)
+    :param padding: Padding of the image (2)
+    :param oversampling: Oversampling of the w kernels (8)
+    :param kernel_reuse: Number of calls of invert and predict sharing the w kernels e.g. 2 * number of major
+        cycles (1)
+    :param relative_gridding_cost: Cost of a gridding operation relative to an FFT operation (5.0, about right for
+        the numpy gridders)
+    :param max_kernelwidth: Maximum w projection kernel width allowed (64)
+    :return: dict of vis_slices, wstep and kernelwidth
+    """
+    svis = advice['svis']
+    if npixel is None:
+        npixel = advice['npixels2']
+    if cellsize is None:
+        cellsize = advice['cellsize']
+    wstep = advice['wstep']
+    wabsmax = numpy.max(numpy.abs(svis.w))
+    
+    padded_npixel = padding * npixel
+    padded_fov = cellsize * padded_npixel
+    fft_cost = 5.0 * padded_npixel ** 2 * numpy.log2(padded_npixel ** 2)
+    oversampled_npixel = oversampling * padded_npixel
+    
+    def gridding_cost(kernelwidth):
+        return relative_gridding_cost * svis.nvis * 8.0 * kernelwidth ** 2
+    
+    def wprojection_kernelwidth(w):
+        # The w screen over the padded image has frequencies up to w tan(padded_fov / 2) and the uv cells are
+        # 1 / padded_fov wavelengths. This spread adds in quadrature to the support of the anti-aliasing function.
+        wwidth = 2.0 * w * padded_fov * numpy.tan(0.5 * padded_fov)
+        return max(8, 2 * int(numpy.ceil(0.5 * numpy.sqrt(wwidth ** 2 + 8.0 ** 2))))
+    
+    # Pure w stacking needs this number of stacks
+    max_slices = max(1, advice['vis_slices'] * advice['wprojection_planes'])
+    best = (max_slices * fft_cost + gridding_cost(8), max_slices, 0.0, 8)
+    for vis_slices in range(1, max_slices):
+        # vis_wslice_iter places the centres of the stacks from -wabsmax to +wabsmax
+        half_width = wabsmax / max(vis_slices - 1, 1)
+        kernelwidth = wprojection_kernelwidth(half_width)
+        if kernelwidth > max_kernelwidth:
+            continue
+        nkernels = vis_slices * (2.0 * half_width / wstep + 1.0)
+        kernel_cost = nkernels * 5.0 * oversampled_npixel * numpy.log2(oversampled_npixel) * \
+            (padded_npixel + oversampling * (kernelwidth + 2)) / kernel_reuse
+        cost = vis_slices * fft_cost + kernel_cost + gridding_cost(kernelwidth)
+        if cost < best[0]:
+            best = (cost, vis_slices, wstep, kernelwidth)
+    
+    cost, vis_slices, wstep, kernelwidth = best
+    log.info('advise_wstack_wprojection: Number of planes in w stack %d (pure w stacking needs %d)' %
+             (vis_slices, max_slices))
+    if wstep > 0.0:
+        log.info('advise_wstack_wprojection: W projection kernel width %d pixels, wstep %.1f (wavelengths)' %
+                 (kernelwidth, wstep))
+    else:
+        log.info('advise_wstack_wprojection: W projection is not needed')
+    log.info('advise_wstack_wprojection: Estimated cost %.3g operations (%.3g for w stacking only)' %
+             (cost, max_slices * fft_cost + gridding_cost(8)))
+    
+    return {'vis_slices': vis_slices, 'wstep': wstep, 'kernelwidth': kernelwidth}
+
+
 def rad_and_deg(x):
     """ Stringify x in radian and degress forms
     
@@ -0,0 +1,158 @@
+"""
+Image domain gridding (IDG) applies the w term and the anti-aliasing taper to the visibilities in the image
+domain of small uv subgrids, rather than by convolution in the uv plane as w projection does:
+
+.. math::
+
+    V(u,v,w) =\\int I(l,m) e^{-2 \\pi j (ul+vm + w(\\sqrt{1-l^2-m^2}-1))} dl dm
+
+is evaluated exactly for every visibility on a coarse image of the field for each subgrid. The cost per
+visibility depends only on the subgrid size, not on w, so this suits wide fields with large w. See
+:py:mod:`processing_library.fourier_transforms.image_domain_gridding`.
+"""
+
+import logging
+
+import numpy
+
+from data_models.memory_data_models import Visibility, BlockVisibility, Image
+from data_models.parameters import get_parameter
+
+from processing_library.fourier_transforms.convolutional_gridding import anti_aliasing_calculate, w_beam
+from processing_library.fourier_transforms.fft_backend import configure_fft_backend
+from processing_library.fourier_transforms.fft_support import fft_checkerboard, ifft_checkerboard, pad_mid, \
+    extract_mid
+from processing_library.fourier_transforms.image_domain_gridding import idg_grid, idg_degrid, idg_w_layers
+from processing_library.image.operations import create_image_from_array
+from processing_library.imaging.imaging_params import get_frequency_map, get_uvw_map
+
+from ..imaging.base import shift_vis_to_image, normalize_sumwt
+from ..visibility.base import copy_visibility
+from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
+
+log = logging.getLogger(__name__)
+
+
+def predict_idg(vis, model: Image, **kwargs):
+    """ Predict using image domain gridding
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param padding: Padding factor of the uv grid (2)
+    :param subgrid_size: Size of the uv subgrids (32)
+    :param subgrid_support: Number of cells at the edges of each subgrid not used for visibility positions (16)
+    :param idg_wstep: Separation in w of the layers whose w is applied in the image (default is the largest
+        separation allowed by the subgrid support)
+    :return: resulting visibility (in place works)
+    """
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_idg: coalescing prior to prediction")
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+
+    assert isinstance(avis, Visibility), avis
+
+    _, _, ny, nx = model.data.shape
+    padding = {'padding': get_parameter(kwargs, "padding", 2)}
+    spectral_mode, vfrequencymap = get_frequency_map(avis, model)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, model, **padding)
+    npixel = int(round(padding * nx))
+    gcf, _ = anti_aliasing_calculate((npixel, npixel))
+    field_of_view = npixel * numpy.abs(model.wcs.wcs.cdelt[1]) * numpy.pi / 180.0
+
+    subgrid_size = get_parameter(kwargs, "subgrid_size", 32)
+    support = get_parameter(kwargs, "subgrid_support", 16)
+    configure_fft_backend(**kwargs)
+    layer, layer_w = idg_w_layers(avis.w, field_of_view, support, get_parameter(kwargs, "idg_wstep", None))
+    log.debug("predict_idg: using %d w layers" % len(layer_w))
+
+    padded_model = (pad_mid(model.data, npixel) * gcf).astype(dtype=complex)
+    newvis = numpy.zeros_like(avis.data['vis'])
+    for ilayer, w_offset in enumerate(layer_w):
+        rows = layer == ilayer
+        if numpy.sum(rows) > 0:
+            if w_offset != 0.0:
+                uvgrid = fft_checkerboard(padded_model * numpy.conjugate(w_beam(npixel, field_of_view, w_offset)),
+                                          overwrite=True)
+            else:
+                uvgrid = fft_checkerboard(padded_model)
+            newvis[rows] = idg_degrid(newvis[rows].shape, uvgrid, vuvwmap[rows], vfrequencymap[rows],
+                                      avis.w[rows], field_of_view, subgrid_size=subgrid_size, support=support,
+                                      w_offset=w_offset)
+    avis.data['vis'] = newvis
+
+    # Now we can shift the visibility from the image frame to the original visibility frame
+    svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
+
+    if isinstance(vis, BlockVisibility) and isinstance(svis, Visibility):
+        log.debug("predict_idg: decoalescing post prediction")
+        return decoalesce_visibility(svis)
+    else:
+        return svis
+
+
+def invert_idg(vis, im: Image, dopsf: bool = False, normalize: bool = True, **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using image domain gridding
+
+    Use the image im as a template. Do PSF in a separate call.
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param padding: Padding factor of the uv grid (2)
+    :param subgrid_size: Size of the uv subgrids (32)
+    :param subgrid_support: Number of cells at the edges of each subgrid not used for visibility positions (16)
+    :param idg_wstep: Separation in w of the layers whose w is applied in the image (default is the largest
+        separation allowed by the subgrid support)
+    :return: resulting image, sum of weights
+    """
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = copy_visibility(vis)
+
+    if dopsf:
+        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
+
+    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+
+    nchan, npol, ny, nx = im.data.shape
+    padding = {'padding': get_parameter(kwargs, "padding", 2)}
+    spectral_mode, vfrequencymap = get_frequency_map(svis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, **padding)
+    npixel = int(round(padding * nx))
+    gcf, _ = anti_aliasing_calculate((npixel, npixel))
+    field_of_view = npixel * numpy.abs(im.wcs.wcs.cdelt[1]) * numpy.pi / 180.0
+
+    subgrid_size = get_parameter(kwargs, "subgrid_size", 32)
+    support = get_parameter(kwargs, "subgrid_support", 16)
+    configure_fft_backend(**kwargs)
+    layer, layer_w = idg_w_layers(svis.w, field_of_view, support, get_parameter(kwargs, "idg_wstep", None))
+    log.debug("invert_idg: using %d w layers" % len(layer_w))
+
+    # Each w layer is gridded and transformed separately, and the w term of the layer applied to its image
+    sumwt = numpy.zeros([nchan, npol])
+    result = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+    for ilayer, w_offset in enumerate(layer_w):
+        rows = layer == ilayer
+        if numpy.sum(rows) > 0:
+            uvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+            uvgrid, layer_sumwt = idg_grid(uvgrid, svis.data['vis'][rows], svis.data['imaging_weight'][rows],
+                                           vuvwmap[rows], vfrequencymap[rows], svis.w[rows], field_of_view,
+                                           subgrid_size=subgrid_size, support=support, w_offset=w_offset)
+            sumwt += layer_sumwt
+            if w_offset != 0.0:
+                result += ifft_checkerboard(uvgrid, overwrite=True) * w_beam(npixel, field_of_view, w_offset)
+            else:
+                result += ifft_checkerboard(uvgrid, overwrite=True)
+
+    # Normalise weights for consistency with transform
+    sumwt /= float(padding * npixel * ny)
+
+    result = extract_mid(numpy.real(result) * gcf, npixel=nx)
+    resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    return resultimage, sumwt
@@ -13,25 +13,49 @@ from processing_library.util.array_functions import tukey_filter
 from data_models.memory_data_models import Visibility, Image
 from data_models.parameters import get_parameter
 
-from processing_library.fourier_transforms.convolutional_gridding import weight_gridding
+from processing_library.fourier_transforms.convolutional_gridding import weight_gridding, density_gridding
 from processing_library.imaging.imaging_params import get_polarisation_map, get_uvw_map
 from processing_library.imaging.imaging_params import get_frequency_map
 
-def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
+def weight_density_grid(vis: Visibility, im: Image, **kwargs) -> numpy.ndarray:
+    """ Grid the visibility weights onto the density grid used for weighting
+
+    The density grids of parts of the data can be added and passed to weight_visibility to weight each part
+    consistently with all of the data.
+
+    :param vis:
+    :param im:
+    :return: density grid with the shape of im
+    """
+    assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
+    
+    assert get_parameter(kwargs, "padding", False) is False
+    spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im)
+    
+    return density_gridding(im.data.shape, vis.data['weight'], vuvwmap, vfrequencymap,
+                            presort=get_parameter(kwargs, "presort", True))
+
+
+def weight_visibility(vis: Visibility, im: Image, densitygrid=None, **kwargs) -> Visibility:
     """ Reweight the visibility data using a selected algorithm
 
     Imaging uses the column "imaging_weight" when imaging. This function sets that column using a
     variety of algorithms
     
     Options are:
-        - Natural: by visibility weight (optimum for noise in final image)
-        - Uniform: weight of sample divided by sum of weights in cell (optimum for sidelobes)
-        - Super-uniform: As uniform, by sum of weights is over extended box region
-        - Briggs: Compromise between natural and uniform
-        - Super-briggs: As Briggs, by sum of weights is over extended box region
+        - natural: by visibility weight (optimum for noise in final image)
+        - uniform: weight of sample divided by sum of weights in cell (optimum for sidelobes)
+        - super-uniform: As uniform, by sum of weights is over extended box region
+        - briggs: Compromise between natural and uniform
+        - super-briggs: As Briggs, by sum of weights is over extended box region
 
     :param vis:
     :param im:
+    :param weighting: Weighting algorithm: 'natural' | 'uniform' | 'super-uniform' | 'briggs' | 'super-briggs'
+    :param robustness: Briggs robustness, -2 is close to uniform, 2 is close to natural (0.0)
+    :param super_uniform_box: Size of box in cells for super-uniform and super-briggs (3)
+    :param densitygrid: Density grid e.g. summed from weight_density_grid over all parts of the data (optional)
     :return: visibility with imaging_weights column added and filled
     """
     assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
@@ -41,12 +65,15 @@ def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
     polarisation_mode, vpolarisationmap = get_polarisation_map(vis, im)
     uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im)
     
-    density = None
-    densitygrid = None
-    
     weighting = get_parameter(kwargs, "weighting", "uniform")
+    presort = get_parameter(kwargs, "presort", True)
+    robustness = get_parameter(kwargs, "robustness", 0.0)
+    super_uniform_box = get_parameter(kwargs, "super_uniform_box", 3)
     vis.data['imaging_weight'], density, densitygrid = weight_gridding(im.data.shape, vis.data['weight'], vuvwmap,
-                                                                       vfrequencymap, vpolarisationmap, weighting)
+                                                                       vfrequencymap, vpolarisationmap, weighting,
+                                                                       presort=presort, robustness=robustness,
+                                                                       super_uniform_box=super_uniform_box,
+                                                                       densitygrid=densitygrid)
     
     return vis, density, densitygrid
 
@@ -69,8 +96,7 @@ def taper_visibility_gaussian(vis: Visibility, beam=None) -> Visibility:
     # See http://mathworld.wolfram.com/FourierTransformGaussian.html
     scale_factor = numpy.pi ** 2 * beam ** 2 / (4.0 * numpy.log(2.0))
     wt = numpy.exp(-scale_factor * uvdistsq)
-    for row in range(vis.nvis):
-        vis.data['imaging_weight'][row, ...] = vis.imaging_weight[row, ...] * wt[row]
+    vis.data['imaging_weight'] = vis.imaging_weight * wt[:, numpy.newaxis]
 
     return vis
 
@@ -97,9 +123,8 @@ def taper_visibility_tukey(vis: Visibility, tukey=0.1) -> Visibility:
     uvdist = numpy.sqrt(vis.u ** 2 + vis.v ** 2)
     uvdistmax = numpy.max(uvdist)
     uvdist /= uvdistmax
-    wt = numpy.array([tukey_filter(uv, tukey) for uv in uvdist])
-    for row in range(vis.nvis):
-        vis.data['imaging_weight'][row, ...] = vis.imaging_weight[row, ...] * wt[row]
+    wt = tukey_filter(uvdist, tukey)
+    vis.data['imaging_weight'] = vis.imaging_weight * wt[:, numpy.newaxis]
    
     return vis
 
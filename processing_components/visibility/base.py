@@ -13,7 +13,9 @@ from astropy.coordinates import SkyCoord
 
 from data_models.memory_data_models import Visibility, BlockVisibility, Configuration
 from data_models.polarisation import PolarisationFrame, ReceptorFrame, correlate_polarisation
-from processing_library.util.coordinate_support import xyz_to_uvw, uvw_to_xyz, skycoord_to_lmn, simulate_point
+from processing_library.imaging.imaging_params import get_precision_dtypes
+from processing_library.util.coordinate_support import xyz_to_uvw, uvw_to_xyz, skycoord_to_lmn, simulate_point, \
+    simulate_point_block
 
 log = logging.getLogger(__name__)
 
@@ -46,7 +48,7 @@ def create_visibility(config: Configuration, times: numpy.array, frequency: nump
                       channel_bandwidth, phasecentre: SkyCoord,
                       weight: float, polarisation_frame=PolarisationFrame('stokesI'),
                       integration_time=1.0,
-                      zerow=False) -> Visibility:
+                      zerow=False, precision='double') -> Visibility:
     """ Create a Visibility from Configuration, hour angles, and direction of source
 
     Note that we keep track of the integration time for BDA purposes
@@ -59,6 +61,7 @@ def create_visibility(config: Configuration, times: numpy.array, frequency: nump
     :param channel_bandwidth: channel bandwidths: (Hz] [nchan]
     :param integration_time: Integration time ('auto' or value in s)
     :param polarisation_frame: PolarisationFrame('stokesI')
+    :param precision: 'double' or 'single': precision of the visibility values ('double')
     :return: Visibility
     """
     assert phasecentre is not None, "Must specify phase centre"
@@ -75,7 +78,7 @@ def create_visibility(config: Configuration, times: numpy.array, frequency: nump
     nrows = nbaselines * ntimes * nch
     nrowsperintegration = nbaselines * nch
     row = 0
-    rvis = numpy.zeros([nrows, npol], dtype='complex')
+    rvis = numpy.zeros([nrows, npol], dtype=get_precision_dtypes(precision=precision)[0])
     rweight = weight * numpy.ones([nrows, npol])
     rtimes = numpy.zeros([nrows])
     rfrequency = numpy.zeros([nrows])
@@ -131,7 +134,7 @@ def create_blockvisibility(config: Configuration,
                            polarisation_frame: PolarisationFrame = None,
                            integration_time=1.0,
                            channel_bandwidth=1e6,
-                           zerow=False, **kwargs) -> BlockVisibility:
+                           zerow=False, precision='double', **kwargs) -> BlockVisibility:
     """ Create a BlockVisibility from Configuration, hour angles, and direction of source
 
     Note that we keep track of the integration time for BDA purposes
@@ -144,6 +147,7 @@ def create_blockvisibility(config: Configuration,
     :param channel_bandwidth: channel bandwidths: (Hz] [nchan]
     :param integration_time: Integration time ('auto' or value in s)
     :param polarisation_frame:
+    :param precision: 'double' or 'single': precision of the visibility values ('double')
     :return: BlockVisibility
     """
     assert phasecentre is not None, "Must specify phase centre"
@@ -157,7 +161,7 @@ def create_blockvisibility(config: Configuration,
     ntimes = len(times)
     npol = polarisation_frame.npol
     visshape = [ntimes, nants, nants, nch, npol]
-    rvis = numpy.zeros(visshape, dtype='complex')
+    rvis = numpy.zeros(visshape, dtype=get_precision_dtypes(precision=precision)[0])
     rweight = weight * numpy.ones(visshape)
     rtimes = numpy.zeros([ntimes])
     ruvw = numpy.zeros([ntimes, nants, nants, 3])
@@ -288,6 +292,49 @@ def phaserotate_visibility(vis: Visibility, newphasecentre: SkyCoord, tangent=Tr
         return vis
 
 
+def phaserotate_blockvisibility(vis: BlockVisibility, newphasecentre: SkyCoord, tangent=True, inverse=False) \
+        -> BlockVisibility:
+    """
+    Phase rotate a BlockVisibility from the current phase centre to a new phase centre
+
+    As phaserotate_visibility but without coalescing. The phasors are formed from one phasor per antenna,
+    time and channel (see simulate_point_block), and applied one time at a time.
+
+    :param vis: BlockVisibility to be rotated
+    :param newphasecentre:
+    :param tangent: Stay on the same tangent plane? (True)
+    :param inverse: Actually do the opposite
+    :return: BlockVisibility
+    """
+    assert isinstance(vis, BlockVisibility), "vis is not a BlockVisibility: %r" % vis
+
+    l, m, n = skycoord_to_lmn(newphasecentre, vis.phasecentre)
+
+    # No significant change?
+    if numpy.abs(n) > 1e-15:
+
+        # Make a new copy
+        newvis = copy_visibility(vis)
+
+        for itime in range(len(newvis.time)):
+            phasor = simulate_point_block(vis.data['uvw'][itime:itime + 1], vis.frequency, l, m)[0]
+            if inverse:
+                newvis.data['vis'][itime] *= phasor[..., numpy.newaxis]
+            else:
+                newvis.data['vis'][itime] *= numpy.conj(phasor)[..., numpy.newaxis]
+
+        # See phaserotate_visibility
+        if not tangent:
+            xyz = uvw_to_xyz(vis.data['uvw'].reshape([-1, 3]), ha=-newvis.phasecentre.ra.rad,
+                             dec=newvis.phasecentre.dec.rad)
+            newvis.data['uvw'][...] = xyz_to_uvw(xyz, ha=-newphasecentre.ra.rad,
+                                                 dec=newphasecentre.dec.rad).reshape(vis.data['uvw'].shape)
+            newvis.phasecentre = newphasecentre
+        return newvis
+    else:
+        return vis
+
+
 def create_blockvisibility_from_ms(msname, channum=None, ack=False):
     """ Minimal MS to BlockVisibility converter
 
@@ -9,6 +9,7 @@ This module contains functions for performing the gridding process and the inver
 """
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 
@@ -104,6 +105,35 @@ def anti_aliasing_calculate(shape, oversampling=1, support=3):
     return gcf, (kernel4d / numpy.sum(kernel4d[0, 0, :, :])).astype('complex')
 
 
+def anti_aliasing_calculate_separable(shape, oversampling=1, support=3):
+    """
+    Compute the prolate spheroidal anti-aliasing function in separable form
+
+    The 2D kernel returned by :py:func:`anti_aliasing_calculate` is the outer product of two copies of
+    the 1D kernel returned here i.e. kernel[yf, xf, :, :] = numpy.outer(kernel1d[yf, :], kernel1d[xf, :]).
+    The 1D kernel is real and has shape [oversampling, 2*support+2].
+
+    :param shape: (height, width) pair
+    :param oversampling: Number of sub-samples per grid pixel
+    :param support: Support of kernel (in pixels) width is 2*support+2
+    :return: gcf, kernel1d
+    """
+    ny, nx = shape
+    nu = numpy.abs(2.0 * coordinates(nx))
+    gcf1d, _ = grdsf(nu)
+    gcf = numpy.outer(gcf1d, gcf1d)
+    gcf[gcf > 0.0] = gcf.max() / gcf[gcf > 0.0]
+
+    s1d = 2 * support + 2
+    nu = numpy.arange(-support, +support, 1.0 / oversampling)
+    kernel1d = grdsf(nu / support)[1]
+    l1d = len(kernel1d)
+    kernel2d = numpy.zeros((oversampling, s1d))
+    for f in range(oversampling):
+        kernel2d[f, 2:] = kernel1d[range(f, l1d, oversampling)[::-1]]
+    return gcf, kernel2d / numpy.sum(kernel2d[0, :])
+
+
 def grdsf(nu):
     """Calculate PSWF using an old SDE routine re-written in Python
 
@@ -152,6 +182,114 @@ def grdsf(nu):
     return grdsf, (1 - nu ** 2) * grdsf
 
 
+class ExponentialSemicircleKernel:
+    """ Exponential of semicircle (ES) gridding kernel
+
+    The kernel is phi(z) = exp(beta * (sqrt(1 - z**2) - 1)) for abs(z) <= 1 where z is the distance from the
+    sample in units of half the support. It is evaluated directly at the kernel taps of every visibility so no
+    oversampled table is needed. For a given accuracy it needs fewer taps than the prolate spheroidal kernel.
+    It is separable and is applied only by the vectorised gridders.
+
+    See Barnett, Magland and af Klinteberg, SIAM J. Sci. Comput. 41, C479 (2019).
+    """
+
+    def __init__(self, support, beta):
+        """ Create an ES kernel
+
+        :param support: Number of taps along each axis (even)
+        :param beta: Shape parameter
+        """
+        assert support % 2 == 0, "Convolution kernel must have even number of pixels"
+        self.support = support
+        self.beta = beta
+        # Normalise the kernel to unit sum of taps, equal to its transform at zero frequency
+        self.norm = 1.0
+        self.norm = self.transform(numpy.zeros([1]))[0]
+
+    @property
+    def shape(self):
+        return (self.support,)
+
+    def __call__(self, z):
+        """ Kernel values
+
+        :param z: Distance from the sample in units of half the support
+        :return: kernel values, zero outside abs(z) <= 1
+        """
+        z2 = numpy.minimum(z ** 2, 1.0)
+        values = numpy.exp(self.beta * (numpy.sqrt(1.0 - z2) - 1.0)) / self.norm
+        values[numpy.abs(z) > 1.0] = 0.0
+        return values
+
+    def evaluate(self, frac):
+        """ Kernel values at the taps of samples
+
+        The first tap of a sample at grid coordinate y is at floor(y) - support // 2 + 1.
+
+        :param frac: Fractional part of the grid coordinate of each sample
+        :return: kernel values [nsamples, support]
+        """
+        taps = numpy.arange(self.support) - (self.support // 2 - 1)
+        return self((taps[numpy.newaxis, :] - numpy.asarray(frac)[:, numpy.newaxis]) / (0.5 * self.support))
+
+    def transform(self, nu, npoints=None):
+        """ Fourier transform of the kernel, calculated by Gauss-Legendre quadrature
+
+        :param nu: Frequencies (cycles per grid cell)
+        :param npoints: Number of quadrature points (default 4 * support + 16)
+        :return: transform at nu
+        """
+        if npoints is None:
+            npoints = 4 * self.support + 16
+        z, weights = numpy.polynomial.legendre.leggauss(npoints)
+        halfwidth = 0.5 * self.support
+        return halfwidth * numpy.sum((weights * self(z))[numpy.newaxis, :] *
+                                     numpy.cos(2.0 * numpy.pi * numpy.outer(nu, halfwidth * z)), axis=1)
+
+
+def es_kernel_parameters(accuracy=1e-6, upsampling=None):
+    """ Support, shape parameter and upsampling of the ES kernel needed for a given accuracy
+
+    The support and beta follow Barnett et al. (2019), rounded up to an even support. If the upsampling (i.e.
+    the padding of the grid) is not given, it is chosen from 1.25, 1.5, 1.75 and 2.0 to minimise
+    support**2 * upsampling**2, balancing the gridding cost against the size of the FFT.
+
+    :param accuracy: Required relative accuracy (1e-6)
+    :param upsampling: Upsampling factor (optional)
+    :return: support, beta, upsampling
+    """
+    def parameters(sigma):
+        support = int(numpy.ceil(-numpy.log(accuracy) / (numpy.pi * numpy.sqrt(1.0 - 1.0 / sigma))))
+        support = max(2, support + support % 2)
+        return support, 0.97 * numpy.pi * support * (1.0 - 0.5 / sigma), sigma
+
+    if upsampling is not None:
+        return parameters(upsampling)
+    return min([parameters(sigma) for sigma in [1.25, 1.5, 1.75, 2.0]], key=lambda p: (p[0] * p[2]) ** 2)
+
+
+def anti_aliasing_calculate_es(shape, accuracy=1e-6, upsampling=2.0):
+    """ Compute the exponential of semicircle anti-aliasing kernel and its gridding correction function
+
+    The gcf is the reciprocal of the Fourier transform of the kernel, normalised to unity at the centre, and is
+    calculated numerically since the transform has no closed form.
+
+    :param shape: (height, width) pair of the padded grid
+    :param accuracy: Required relative accuracy (1e-6)
+    :param upsampling: Upsampling factor i.e. the padding of the grid (2.0)
+    :return: gcf, ExponentialSemicircleKernel
+    """
+    ny, nx = shape
+    support, beta, _ = es_kernel_parameters(accuracy, upsampling)
+    kernel = ExponentialSemicircleKernel(support, beta)
+    gcfy = kernel.transform(coordinates(ny))
+    gcfx = kernel.transform(coordinates(nx))
+    gcf = numpy.outer(gcfy, gcfx)
+    gcf[gcf > 0.0] = 1.0 / gcf[gcf > 0.0]
+    gcf[gcf <= 0.0] = 0.0
+    return gcf, kernel
+
+
 def w_beam(npixel, field_of_view, w, cx=None, cy=None, remove_shift=False):
     """ W beam, the fresnel diffraction pattern arising from non-coplanar baselines
     
@@ -226,20 +364,25 @@ def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
     
     # uvw -> fraction of grid mapping
     y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
-    y -= gh // 2
     x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
-    x -= gw // 2
     
     if len(kernels) > 1:
+        # The kernels may have different supports
+        ksupport = numpy.array([kernel.shape[-1] for kernel in kernels])
+        y -= ksupport[kernel_indices] // 2
+        x -= ksupport[kernel_indices] // 2
         coords = kernel_indices, list(vfrequencymap), x, y, xf, yf
-        ckernels = numpy.conjugate(kernels)
+        ckernels = [numpy.conjugate(kernel) for kernel in kernels]
         for pol in range(vnpol):
             vis[..., pol] = [
-                numpy.sum(uvgrid[chan, pol, yy: yy + gh, xx:xx + gw] * ckernels[kind][yyf, xxf, :, :])
+                numpy.sum(uvgrid[chan, pol, yy: yy + ksupport[kind], xx:xx + ksupport[kind]] *
+                          ckernels[kind][yyf, xxf, :, :])
                 for kind, chan, xx, yy, xxf, yyf in zip(*coords)
             ]
     else:
         # This is the usual case. We trim a bit of time by avoiding the kernel lookup
+        y -= gh // 2
+        x -= gw // 2
         coords = list(vfrequencymap), x, y, xf, yf
         ckernel0 = numpy.conjugate(kernels[0])
         for pol in range(vnpol):
@@ -251,6 +394,254 @@ def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
     return numpy.array(vis)
 
 
+def vectorised_kernel_shape(kernelstack):
+    """ Find the oversampling and support of a stack of kernels used by the vectorised gridders
+
+    Kernels are either full [nkernels, oversampling, oversampling, support, support] or separable
+    [nkernels, oversampling, support], in which case the same 1D kernel is applied along u and v. For
+    separable kernels the number of kernel values looked up per sample is 2*support instead of support**2.
+    An :py:class:`ExponentialSemicircleKernel` is separable and is evaluated rather than looked up.
+
+    :param kernelstack: Stacked kernels
+    :return: oversampling, support in v, support in u, separable
+    """
+    if isinstance(kernelstack, ExponentialSemicircleKernel):
+        return 1, kernelstack.support, kernelstack.support, True
+    if kernelstack.ndim == 3:
+        _, kernel_oversampling, gw = kernelstack.shape
+        return kernel_oversampling, gw, gw, True
+    else:
+        _, kernel_oversampling, _, gh, gw = kernelstack.shape
+        return kernel_oversampling, gh, gw, False
+
+
+def vectorised_kernel_groups(kernels, dtype=None):
+    """ Stack the kernels for the vectorised gridders, one stack per kernel shape
+
+    The kernels may have different supports, e.g. w kernels with support depending on w. Each group of kernels
+    with the same shape is stacked so that the gridders can process the visibilities using those kernels
+    together, with the cost per visibility set by the support of its own kernel.
+
+    :param kernels: List of kernels
+    :param dtype: Convert the stacked kernels to this type (optional)
+    :return: list of kernel stacks, group of each kernel, position of each kernel within its stack
+    """
+    if isinstance(kernels[0], ExponentialSemicircleKernel):
+        assert len(kernels) == 1, "Only one ExponentialSemicircleKernel may be used"
+        return [kernels[0]], numpy.zeros(1, dtype='int'), numpy.zeros(1, dtype='int')
+    shapes = list()
+    kgroup = numpy.zeros(len(kernels), dtype='int')
+    kposition = numpy.zeros(len(kernels), dtype='int')
+    members = list()
+    for k, kernel in enumerate(kernels):
+        if kernel.shape not in shapes:
+            shapes.append(kernel.shape)
+            members.append(list())
+        kgroup[k] = shapes.index(kernel.shape)
+        kposition[k] = len(members[kgroup[k]])
+        members[kgroup[k]].append(k)
+    stacks = list()
+    for group in members:
+        stack = numpy.array([kernels[k] for k in group])
+        if dtype is not None:
+            stack = stack.astype(dtype)
+        stacks.append(stack)
+    return stacks, kgroup, kposition
+
+
+def separable_kernel_values(kernelstack, kpos, frac):
+    """ Values of separable kernels for the vectorised gridders
+
+    :param kernelstack: Stacked separable kernels [nkernels, oversampling, support] or an
+        :py:class:`ExponentialSemicircleKernel`
+    :param kpos: Position of the kernel of each sample in the stack
+    :param frac: Fractional grid coordinate of each sample, as returned by
+        :py:func:`convolutional_grid_coordinates`
+    :return: kernel values [nsamples, support]
+    """
+    if isinstance(kernelstack, ExponentialSemicircleKernel):
+        return kernelstack.evaluate(frac)
+    return kernelstack[kpos, frac]
+
+
+def convolutional_grid_coordinates(kernel_list, shape, vuvwmap, vfrequencymap):
+    """ Calculate the grid coordinates of all visibilities for the vectorised gridders
+
+    The coordinates depend only on the kernels, the grid shape and the uvw and frequency maps, so they can be
+    calculated once and reused for gridding and degridding the same visibilities many times.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: channel, kernel index, y, y fraction, x, x fraction; y and x are those of the first tap of the
+        kernel of each visibility. The fractions are indices into the oversampled kernels, or the fractional
+        grid coordinates for an :py:class:`ExponentialSemicircleKernel`
+    """
+    kernel_indices, kernels = kernel_list
+    _, _, ny, nx = shape
+    chan = numpy.array(vfrequencymap, dtype='int')
+    if isinstance(kernels[0], ExponentialSemicircleKernel):
+        assert numpy.array(vuvwmap[:, 0:2] >= -0.5).all() and numpy.array(vuvwmap[:, 0:2] < 0.5).all(), \
+            "Cellsize is too large: uv overflows grid"
+        support = kernels[0].support
+        yc = ny // 2 + vuvwmap[:, 1] * ny
+        y = numpy.floor(yc).astype('int')
+        xc = nx // 2 + vuvwmap[:, 0] * nx
+        x = numpy.floor(xc).astype('int')
+        return chan, numpy.zeros_like(chan), y - (support // 2 - 1), yc - y, x - (support // 2 - 1), xc - x
+    kernel_oversampling, _, _, _ = vectorised_kernel_shape(numpy.array(kernels[0:1]))
+    if len(kernels) > 1:
+        kind = numpy.array(kernel_indices, dtype='int')
+    else:
+        kind = numpy.zeros_like(chan)
+    supports = numpy.array([vectorised_kernel_shape(kernel[numpy.newaxis, ...])[1:3] for kernel in kernels])
+    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
+    y -= supports[kind, 0] // 2
+    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
+    x -= supports[kind, 1] // 2
+    return chan, kind, y, yf, x, xf
+
+
+def convolutional_grid_coordinates_hermitian(kernel_list, shape, vuvwmap, vfrequencymap):
+    """ Calculate the grid coordinates of all visibilities for gridding onto the u >= 0 half of the grid
+
+    Visibilities with u < 0 are moved to (-u, -v) and must be conjugated before gridding, or after degridding.
+    This is only correct for a single kernel that is symmetric, as the kernels of
+    :py:func:`anti_aliasing_calculate` and :py:func:`anti_aliasing_calculate_es` are, and if only the real part
+    of the image is wanted. See :py:func:`processing_library.fourier_transforms.fft_support.ifft_hermitian` and
+    :py:func:`processing_library.fourier_transforms.fft_support.fft_hermitian` for the transforms.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param shape: Shape of the full grid [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :return: coordinates as :py:func:`convolutional_grid_coordinates` but relative to column x0 of the full
+        grid, boolean array of the visibilities to conjugate, first column x0 of the full grid in the half grid
+    """
+    assert len(kernel_list[1]) == 1, "Half grid needs a single convolution kernel"
+    mirrored = vuvwmap[:, 0] < 0.0
+    hvuvwmap = numpy.array(vuvwmap)
+    hvuvwmap[mirrored, :] *= -1.0
+    chan, kind, y, yf, x, xf = convolutional_grid_coordinates(kernel_list, shape, hvuvwmap, vfrequencymap)
+    x0 = min(numpy.min(x), shape[3] // 2) if len(x) > 0 else shape[3] // 2
+    assert x0 >= 1, "Cellsize is too large: uv overflows half grid"
+    return (chan, kind, y, yf, x - x0, xf), mirrored, x0
+
+
+def convolutional_grid_sort(shape, chan, y, x, kernel_indices=None, tile_size=32):
+    """ Find an order of the visibilities that visits the grid tile by tile
+
+    Visibilities usually arrive in time and baseline order so consecutive samples touch distant parts of the
+    grid. Gridding in this order instead keeps the grid cells being updated, and the kernels being used, in
+    cache. The rows are ordered by image channel, then by tile of tile_size x tile_size grid cells and then
+    by kernel index. The visibilities themselves are not moved: the gridders take the order and write
+    degridded values back to the original rows.
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param chan: Image channel of each visibility
+    :param y: Grid coordinate in v of each visibility
+    :param x: Grid coordinate in u of each visibility
+    :param kernel_indices: Kernel index of each visibility (optional)
+    :param tile_size: Size of tile in grid cells (32)
+    :return: Row numbers in gridding order
+    """
+    _, _, ny, nx = shape
+    ntx = nx // tile_size + 2
+    nty = ny // tile_size + 2
+    tile = (numpy.asarray(chan) * nty + y // tile_size) * ntx + x // tile_size
+    if kernel_indices is None:
+        return numpy.argsort(tile, kind='stable')
+    return numpy.lexsort((kernel_indices, tile))
+
+
+def convolutional_degrid_vectorised(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap, block_size=None,
+                                    coordinates=None, order=None):
+    """Convolutional degridding with frequency and polarisation independent gcf, vectorised over visibilities
+
+    This gives the same result as :py:func:`convolutional_degrid` but, for a block of visibilities at a time,
+    gathers the grid values under all kernel taps in one indexing operation and reduces them against the
+    conjugated kernels using numpy.einsum. All polarisations are degridded in the same pass.
+
+    Separable kernels (see :py:func:`anti_aliasing_calculate_separable` and
+    :py:func:`anti_aliasing_calculate_es`) are applied by contracting first along u and then along v. The
+    kernels may have different supports, in which case the visibilities are degridded in groups sharing the
+    same kernel shape (see :py:func:`vectorised_kernel_groups`).
+
+    If uvgrid is complex64 the kernels are converted to single precision.
+
+    :param kernel_list: list of oversampled convolution kernel
+    :param vshape: Shape of visibility
+    :param uvgrid:   The uv plane to de-grid from
+    :param vuvwmap: function to map uvw to grid fractions
+    :param vfrequencymap: function to map frequency to image channels
+    :param block_size: Number of visibilities to process per block (default is about 4M taps per block)
+    :param coordinates: Grid coordinates from :py:func:`convolutional_grid_coordinates` (optional)
+    :param order: Order in which to degrid the visibilities e.g. from :py:func:`convolutional_grid_sort` (optional)
+    :return: Array of visibilities.
+    """
+    kernel_indices, kernels = kernel_list
+    dtype = None
+    if uvgrid.dtype == numpy.complex64:
+        # Single precision grid so use single precision kernels
+        dtype = 'complex64' if numpy.iscomplexobj(kernels[0]) else 'float32'
+    stacks, kgroup, kposition = vectorised_kernel_groups(kernels, dtype)
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis, vnpol = vshape[0], vshape[1]
+    vis = numpy.zeros(vshape, dtype='complex')
+
+    # uvw -> fraction of grid mapping
+    if coordinates is None:
+        coordinates = convolutional_grid_coordinates(kernel_list, uvgrid.shape, vuvwmap, vfrequencymap)
+    chan, kind, y, yf, x, xf = coordinates
+
+    if order is None:
+        order = numpy.arange(nvis)
+
+    flatgrid = uvgrid.reshape(-1)
+    # Kernels with different shapes are applied to their visibilities in turn
+    for group, kernelstack in enumerate(stacks):
+        if isinstance(kernelstack, ExponentialSemicircleKernel):
+            # The ES kernel is real
+            ckernelstack = kernelstack
+        else:
+            ckernelstack = numpy.conjugate(kernelstack)
+        kernel_oversampling, gh, gw, separable = vectorised_kernel_shape(ckernelstack)
+        assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+        assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+        if len(stacks) > 1:
+            grows = order[kgroup[kind[order]] == group]
+        else:
+            grows = order
+
+        # Offsets of the kernel taps and polarisations relative to the first tap in the flattened grid
+        taps = (numpy.arange(gh)[:, numpy.newaxis] * nx + numpy.arange(gw)[numpy.newaxis, :]).ravel()
+        poloffsets = numpy.arange(vnpol) * ny * nx
+        offsets = (poloffsets[:, numpy.newaxis] + taps[numpy.newaxis, :])[numpy.newaxis, ...]
+
+        gblock_size = block_size
+        if gblock_size is None:
+            gblock_size = max(1, 2 ** 22 // (gh * gw * vnpol))
+
+        for start in range(0, len(grows), gblock_size):
+            rows = grows[start:start + gblock_size]
+            nrows = len(rows)
+            kpos = kposition[kind[rows]]
+            index = (chan[rows] * inpol * ny * nx + y[rows] * nx + x[rows])[:, numpy.newaxis, numpy.newaxis] + \
+                offsets
+            if separable:
+                # Contract along u and then along v
+                values = flatgrid[index].reshape([nrows, vnpol, gh, gw])
+                values = numpy.einsum('rpyx,rx->rpy', values, separable_kernel_values(ckernelstack, kpos, xf[rows]))
+                vis[rows, ...] = numpy.einsum('rpy,ry->rp', values,
+                                              separable_kernel_values(ckernelstack, kpos, yf[rows]))
+            else:
+                ckvalues = ckernelstack[kpos, yf[rows], xf[rows]].reshape([nrows, gh * gw])
+                vis[rows, ...] = numpy.einsum('rpt,rt->rp', flatgrid[index], ckvalues)
+
+    return vis
+
+
 def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap):
     """Grid after convolving with frequency and polarisation independent gcf
 
@@ -276,9 +667,7 @@ def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequency
     
     # uvw -> fraction of grid mapping
     y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
-    y -= gh // 2
     x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
-    x -= gw // 2
     
     # About 228k samples per second for standard kernel so about 10 million CMACs per second
     
@@ -288,12 +677,19 @@ def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequency
     npol = vis.shape[-1]
 
     if len(kernels) > 1:
+        # The kernels may have different supports
+        ksupport = numpy.array([kernel.shape[-1] for kernel in kernels])
+        y -= ksupport[kernel_indices] // 2
+        x -= ksupport[kernel_indices] // 2
         coords = kernel_indices, list(vfrequencymap), x, y, xf, yf
         for pol in range(npol):
             for v, vwt, kind, chan, xx, yy, xxf, yyf in zip(viswt[..., pol], wts[..., pol], *coords):
-                uvgrid[chan, pol, yy: yy + gh, xx: xx + gw] += kernels[kind][yyf, xxf, :, :] * v
+                uvgrid[chan, pol, yy: yy + ksupport[kind], xx: xx + ksupport[kind]] += \
+                    kernels[kind][yyf, xxf, :, :] * v
                 sumwt[chan, pol] += vwt
     else:
+        y -= gh // 2
+        x -= gw // 2
         kernel0 = kernels[0]
         coords = list(vfrequencymap), x, y, xf, yf
         for pol in range(npol):
@@ -304,49 +700,266 @@ def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequency
     return uvgrid, sumwt
 
 
-def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform'):
+def convolutional_grid_vectorised(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap, block_size=None,
+                                  nthreads=1, coordinates=None, order=None):
+    """Grid after convolving with frequency and polarisation independent gcf, vectorised over visibilities
+
+    This gives the same result as :py:func:`convolutional_grid` but instead of looping over visibilities
+    in Python, the grid indices of all kernel taps for a block of visibilities are calculated at once and the
+    weighted kernel values are accumulated onto the grid. All polarisations are gridded in the same pass. If the
+    taps of a block are dense in the range of the grid they touch, they are accumulated over that range of each
+    polarisation plane using numpy.bincount. Otherwise, e.g. for unsorted visibilities on a large grid, the taps
+    falling on each cell are summed by numpy.add.reduceat and added to the cells touched, so that the work is
+    proportional to the number of taps rather than to the size of the grid.
+
+    Separable kernels (see :py:func:`anti_aliasing_calculate_separable` and
+    :py:func:`anti_aliasing_calculate_es`) are applied by weighting the visibilities by the v kernel and then
+    taking the outer product with the u kernel. The kernels may have different supports, in which case the
+    visibilities are gridded in groups sharing the same kernel shape (see :py:func:`vectorised_kernel_groups`).
+
+    If nthreads > 1 the grid is split into nthreads bands in v holding roughly equal numbers of visibilities.
+    Each thread grids the visibilities of one band onto its own sub-grid, which spans the band plus the
+    kernel support, and the sub-grids are then added into uvgrid. Only the overlap of neighbouring bands is
+    summed in a different order so the result does not depend on nthreads beyond rounding. The accumulation
+    (numpy.bincount, fancy indexing and the arithmetic on the taps) does not hold the GIL, but the Python work
+    per block does, so the bands only run concurrently for blocks large enough to amortise it.
+
+    If uvgrid is complex64 the kernels and weighted visibilities are converted to single precision. The sum
+    of weights is always accumulated in double precision.
+
+    :param kernel_list: List of oversampled convolution kernels
+    :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param block_size: Number of visibilities to process per block (default is about 4M taps per block)
+    :param nthreads: Number of threads to grid with (1)
+    :param coordinates: Grid coordinates from :py:func:`convolutional_grid_coordinates` (optional)
+    :param order: Order in which to grid the visibilities e.g. from :py:func:`convolutional_grid_sort` (optional)
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    kernel_indices, kernels = kernel_list
+    dtype = None
+    if uvgrid.dtype == numpy.complex64:
+        # Single precision grid so use single precision kernels
+        dtype = 'complex64' if numpy.iscomplexobj(kernels[0]) else 'float32'
+    stacks, kgroup, kposition = vectorised_kernel_groups(kernels, dtype)
+    shapes = [vectorised_kernel_shape(kernelstack) for kernelstack in stacks]
+    for _, gh, gw, _ in shapes:
+        assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+        assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    maxgh = max([gh for _, gh, _, _ in shapes])
+    assert uvgrid.flags['C_CONTIGUOUS'], "Grid must be contiguous"
+    inchan, inpol, ny, nx = uvgrid.shape
+    nvis, npol = vis.shape[0], vis.shape[-1]
+
+    sumwt = numpy.zeros([inchan, inpol])
+
+    # uvw -> fraction of grid mapping
+    if coordinates is None:
+        coordinates = convolutional_grid_coordinates(kernel_list, uvgrid.shape, vuvwmap, vfrequencymap)
+    chan, kind, y, yf, x, xf = coordinates
+
+    viswt = (vis[...] * visweights[...]).astype(uvgrid.dtype)
+    for pol in range(npol):
+        sumwt[:, pol] += numpy.bincount(chan, weights=visweights[..., pol], minlength=inchan)
+
+    def grid_rows(subgrid, rows, ylow):
+        """ Grid the selected rows onto subgrid, which starts at row ylow of uvgrid
+        """
+        sny = subgrid.shape[2]
+        flatgrid = subgrid.reshape(-1)
+        # Kernels with different shapes are applied to their visibilities in turn
+        for group, kernelstack in enumerate(stacks):
+            _, gh, gw, separable = shapes[group]
+            if len(stacks) > 1:
+                grows = rows[kgroup[kind[rows]] == group]
+            else:
+                grows = rows
+            # Offsets of the kernel taps relative to the first tap in the flattened grid
+            taps = (numpy.arange(gh)[:, numpy.newaxis] * nx + numpy.arange(gw)[numpy.newaxis, :]).ravel()
+            gblock_size = block_size
+            if gblock_size is None:
+                gblock_size = max(1, 2 ** 22 // (gh * gw * npol))
+            for start in range(0, len(grows), gblock_size):
+                brows = grows[start:start + gblock_size]
+                # Index of the first tap of each row in the first polarisation plane of the flattened grid
+                base = chan[brows] * inpol * sny * nx + (y[brows] - ylow) * nx + x[brows]
+                low = numpy.min(base)
+                high = numpy.max(base) + taps[-1] + 1
+                dense = high - low <= 4 * len(brows) * len(taps)
+                if not dense:
+                    # Taps sparse in the range of the grid touched e.g. for unsorted rows on a large grid.
+                    # Sorting the rows makes the taps almost sorted, so they are cheap to reduce by cell.
+                    border = numpy.argsort(base)
+                    brows = brows[border]
+                    base = base[border]
+                kpos = kposition[kind[brows]]
+                if separable:
+                    # Apply the v kernel to the visibilities and then form the outer product with the u kernel
+                    ky = separable_kernel_values(kernelstack, kpos, yf[brows])
+                    kx = separable_kernel_values(kernelstack, kpos, xf[brows])
+                    vy = viswt[brows, :, numpy.newaxis] * ky[:, numpy.newaxis, :]
+                    values = (vy[..., numpy.newaxis] * kx[:, numpy.newaxis, numpy.newaxis, :])
+                else:
+                    kvalues = kernelstack[kpos, yf[brows], xf[brows]].reshape([len(brows), 1, gh * gw])
+                    values = (viswt[brows, :, numpy.newaxis] * kvalues)
+                values = values.reshape([len(brows), npol, gh * gw])
+                index = (base[:, numpy.newaxis] + taps[numpy.newaxis, :]).ravel()
+                if dense:
+                    # Accumulate over the range of the grid touched by this block, one polarisation at a time
+                    index -= low
+                    for pol in range(npol):
+                        pvalues = values[:, pol, :].ravel()
+                        plane = flatgrid[pol * sny * nx + low:pol * sny * nx + high]
+                        plane.real += numpy.bincount(index, weights=pvalues.real, minlength=high - low)
+                        plane.imag += numpy.bincount(index, weights=pvalues.imag, minlength=high - low)
+                else:
+                    # Sum the taps falling on each cell and add the sums to the cells, so that the work is
+                    # proportional to the number of taps rather than the size of the grid
+                    torder = numpy.argsort(index, kind='mergesort')
+                    index = index[torder]
+                    first = numpy.flatnonzero(numpy.concatenate([[True], index[1:] != index[:-1]]))
+                    cells = index[first]
+                    for pol in range(npol):
+                        pvalues = values[:, pol, :].ravel()[torder]
+                        flatgrid[pol * sny * nx + cells] += numpy.add.reduceat(pvalues, first)
+
+    if order is None:
+        order = numpy.arange(nvis)
+
+    if nthreads > 1 and nvis > nthreads:
+        # Split into bands in v with equal numbers of visibilities
+        edges = numpy.sort(y)[(numpy.arange(1, nthreads) * nvis) // nthreads]
+        band = numpy.searchsorted(edges, y, side='right')[order]
+        bands = list()
+        for iband in range(nthreads):
+            rows = order[band == iband]
+            if len(rows) > 0:
+                ylow = numpy.min(y[rows])
+                sny = numpy.max(y[rows]) - ylow + maxgh
+                bands.append((numpy.zeros([inchan, inpol, sny, nx], dtype=uvgrid.dtype), rows, ylow))
+
+        log.debug("convolutional_grid_vectorised: gridding %d bands using %d threads" % (len(bands), nthreads))
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            for future in [executor.submit(grid_rows, *b) for b in bands]:
+                future.result()
+
+        # Reduce the sub-grids into the grid
+        for subgrid, _, ylow in bands:
+            uvgrid[:, :, ylow:ylow + subgrid.shape[2], :] += subgrid
+    else:
+        grid_rows(uvgrid, order, 0)
+
+    return uvgrid, sumwt
+
+
+def density_gridding(shape, visweights, vuvwmap, vfrequencymap, presort=False):
+    """Accumulate the weights of the samples and of their Hermitian conjugates onto a density grid
+
+    Density grids of different parts of the same data can be added to give the density grid of all the data.
+
+    :param shape: Shape of density grid [nchan, npol, ny, nx]
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param presort: Accumulate the density grid in the order given by :py:func:`convolutional_grid_sort`
+    :return: densitygrid
+    """
+    inchan, inpol, ny, nx = shape
+    chan = numpy.array(vfrequencymap, dtype='int')
+    poloffsets = numpy.arange(inpol) * ny * nx
+    wts = visweights[:, :inpol]
+    
+    # All polarisations are done at once
+    densitygrid = numpy.zeros(shape, dtype='float')
+    for flip in [-1.0, 1.0]:
+        y, _ = frac_coord(ny, 1.0, flip * vuvwmap[:, 1])
+        x, _ = frac_coord(nx, 1.0, flip * vuvwmap[:, 0])
+        if presort:
+            order = convolutional_grid_sort(shape, chan, y, x)
+        else:
+            order = numpy.arange(len(chan))
+        index = ((chan[order] * inpol * ny + y[order]) * nx + x[order])[:, numpy.newaxis] + poloffsets
+        densitygrid += numpy.bincount(index.ravel(), weights=wts[order].ravel(),
+                                      minlength=densitygrid.size).reshape(shape)
+    return densitygrid
+
+
+def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform',
+                    presort=False, robustness=0.0, super_uniform_box=3, densitygrid=None):
     """Reweight data using one of a number of algorithms
 
+    The weights of all samples and of their Hermitian conjugates are accumulated onto a density grid using
+    :py:func:`density_gridding`, unless a density grid e.g. summed over many parts of the data, is given. The
+    density seen by each sample is that of its grid cell, or for the super- schemes the
+    sum over a box of super_uniform_box x super_uniform_box cells centred on its cell. The new weights are:
+
+        - natural: unchanged
+        - uniform, super-uniform: weight / density
+        - briggs, super-briggs: weight / (1 + density * f**2) where f**2 = (5 * 10**-robustness)**2 divided by
+          the density weighted mean density, calculated per image channel and polarisation
+
     :param shape:
     :param visweights: Visibility weights
     :param vuvwmap: map uvw to grid fractions
     :param vfrequencymap: map frequency to image channels
     :param vpolarisationmap: map polarisation to image polarisation
-    :param weighting: '' | 'uniform'
+    :param weighting: 'natural' | 'uniform' | 'super-uniform' | 'briggs' | 'super-briggs'
+    :param presort: Accumulate the density grid in the order given by :py:func:`convolutional_grid_sort`
+    :param robustness: Briggs robustness, from -2 (close to uniform) to 2 (close to natural) (0.0)
+    :param super_uniform_box: Size of the box in cells for super-uniform and super-briggs weighting (3)
+    :param densitygrid: Density grid from :py:func:`density_gridding` to use instead of that of visweights
     :return: visweights, density, densitygrid
     """
-    densitygrid = numpy.zeros(shape, dtype='float')
-    if weighting == 'uniform':
-        log.info("weight_gridding: Performing uniform weighting")
-        inchan, inpol, ny, nx = shape
-
-        wts = visweights[...]
-        # uvw -> fraction of grid mapping
-        for flip in [-1.0, 1.0]:
-            y, yf = frac_coord(ny, 1.0, flip * vuvwmap[:, 1])
-            x, xf = frac_coord(nx, 1.0, flip * vuvwmap[:, 0])
-            coords = list(vfrequencymap), x, y
-            for pol in range(inpol):
-                for vwt, chan, x, y in zip(wts, *coords):
-                    densitygrid[chan, pol, y, x] += vwt[..., pol]
-                    
-        # Find the total weight per sample counting redundancies with other samples
-        newvisweights = numpy.zeros_like(visweights)
-        density = numpy.zeros_like(visweights)
-        y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
-        x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
-        coords = list(vfrequencymap), x, y
-        for pol in range(inpol):
-            density[..., pol] += [densitygrid[chan, pol, y, x] for chan, x, y in zip(*coords)]
+    if weighting == 'natural':
+        return visweights, None, None
+    if weighting not in ['uniform', 'super-uniform', 'briggs', 'super-briggs']:
+        raise ValueError("Unknown weighting %s" % weighting)
 
+    log.info("weight_gridding: Performing %s weighting" % weighting)
+    inchan, inpol, ny, nx = shape
+    
+    chan = numpy.array(vfrequencymap, dtype='int')
+    poloffsets = numpy.arange(inpol) * ny * nx
+    wts = visweights[:, :inpol]
+    
+    if densitygrid is None:
+        densitygrid = density_gridding(shape, visweights, vuvwmap, vfrequencymap, presort=presort)
+    assert list(densitygrid.shape) == list(shape), "Density grid has wrong shape %s" % str(densitygrid.shape)
+    
+    if weighting in ['super-uniform', 'super-briggs']:
+        # Sum the density over a box centred on each cell using a summed area table
+        box = super_uniform_box
+        half = box // 2
+        sat = numpy.pad(densitygrid, [(0, 0), (0, 0), (half + 1, box - half - 1), (half + 1, box - half - 1)],
+                        mode='constant').cumsum(axis=2).cumsum(axis=3)
+        densitygrid = sat[..., box:, box:] - sat[..., :-box, box:] - sat[..., box:, :-box] + sat[..., :-box, :-box]
+    
+    # Find the total weight per sample counting redundancies with other samples
+    y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
+    x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
+    index = ((chan * inpol * ny + y) * nx + x)[:, numpy.newaxis] + poloffsets
+    density = numpy.zeros_like(visweights)
+    density[:, :inpol] = densitygrid.reshape(-1)[index]
+    
+    if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
+        log.warning("weight_gridding: Losing samples in weighting")
+    
+    newvisweights = numpy.zeros_like(visweights)
+    if weighting in ['uniform', 'super-uniform']:
         # Normalise each visibility weight to sum to one in a grid cell
-        if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
-            log.warning("weight_gridding: Losing samples in weighting")
-            
         newvisweights[density > 0.0] = visweights[density > 0.0] / density[density > 0.0]
-        return newvisweights, density, densitygrid
     else:
-        return visweights, None, None
+        sumdensity = numpy.sum(densitygrid, axis=(2, 3))
+        sumdensity2 = numpy.sum(densitygrid ** 2, axis=(2, 3))
+        f2 = numpy.zeros([inchan, inpol])
+        f2[sumdensity2 > 0.0] = (5.0 * 10.0 ** (-robustness)) ** 2 / \
+                                (sumdensity2[sumdensity2 > 0.0] / sumdensity[sumdensity2 > 0.0])
+        newvisweights[:, :inpol] = wts / (1.0 + density[:, :inpol] * f2[chan, :])
+    
+    return newvisweights, density, densitygrid
 
 
 def visibility_recentre(uvw, dl, dm):
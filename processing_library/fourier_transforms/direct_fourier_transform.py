@@ -0,0 +1,141 @@
+""" Direct Fourier transform (DFT) of point sources to visibilities:
+
+.. math::
+
+    V(u,v,w) = \\sum_s F_s e^{-2 \\pi j (ul_s+vm_s + w(\\sqrt{1-l_s^2-m_s^2}-1))}
+
+The phasors of a chunk of sources and visibilities are evaluated at once and reduced over the sources by a matrix
+product with the fluxes. The chunks are bounded by block_size phasors and can be predicted by a pool of threads.
+
+For the baselines of a block of times the phasor of baseline (a2, a1) is the phasor of antenna a2 times the
+conjugate of that of antenna a1 (see :py:func:`simulate_point_block`), so only the antenna phasors are evaluated.
+The visibilities of all baselines of one time, channel and polarisation are then the matrix product
+A diag(F) A^H of the antenna phasors A [nants, nsources].
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from astropy import constants as constants
+
+from processing_library.util.coordinate_support import antenna_uvw
+
+log = logging.getLogger(__name__)
+
+
+def dft_directions(l, m):
+    """ Directions of sources for the DFT, including the phase tracking to the phase centre, as simulate_point
+
+    :param l: horizontal direction cosines relative to phase tracking centre [nsources]
+    :param m: orthogonal directon cosines relative to phase tracking centre [nsources]
+    :return: [nsources, 3]
+    """
+    l = numpy.array(l, ndmin=1)
+    m = numpy.array(m, ndmin=1)
+    return numpy.stack([l, m, numpy.sqrt(1 - l ** 2 - m ** 2) - 1.0], axis=1)
+
+
+def dft_map(work, function, nthreads=1):
+    """ Apply function to each item of work, using a pool of nthreads threads if nthreads > 1
+
+    :param work: list of arguments
+    :param function: function of one argument
+    :param nthreads: Number of threads (1)
+    """
+    if nthreads > 1 and len(work) > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            for future in [executor.submit(function, item) for item in work]:
+                future.result()
+    else:
+        for item in work:
+            function(item)
+
+
+def dft_point_sources(uvw, chan, flux, l, m, block_size=2 ** 20, nthreads=1):
+    """ Predict the visibilities of point sources by DFT, row by row
+
+    The rows of each channel are predicted in chunks of rows and sources of at most about block_size phasors.
+
+    :param uvw: :math:`(u,v,w)` of rows (in wavelengths) [nrows, 3]
+    :param chan: Channel of flux for each row [nrows]
+    :param flux: Flux of sources [nsources, nchan, npol]
+    :param l: horizontal direction cosines of sources relative to phase tracking centre [nsources]
+    :param m: orthogonal directon cosines of sources relative to phase tracking centre [nsources]
+    :param block_size: Approximate number of phasors evaluated at a time (1048576)
+    :param nthreads: Number of threads predicting chunks of rows (1)
+    :return: visibilities [nrows, npol]
+    """
+    nsources, _, npol = flux.shape
+    s = dft_directions(l, m)
+    chan = numpy.array(chan, dtype='int')
+    vis = numpy.zeros([len(uvw), npol], dtype='complex')
+    source_step = max(1, min(nsources, block_size))
+    row_step = max(1, block_size // source_step)
+
+    work = list()
+    for ichan in numpy.unique(chan):
+        rows = numpy.where(chan == ichan)[0]
+        work += [(ichan, rows[start:start + row_step]) for start in range(0, len(rows), row_step)]
+    log.debug("dft_point_sources: predicting %d sources in %d chunks of rows" % (nsources, len(work)))
+
+    def predict_rows(item):
+        ichan, rows = item
+        ruvw = uvw[rows]
+        for start in range(0, nsources, source_step):
+            sources = slice(start, start + source_step)
+            phasor = numpy.exp(-2j * numpy.pi * numpy.dot(ruvw, s[sources].T))
+            vis[rows] += numpy.dot(phasor, flux[sources, ichan, :])
+
+    dft_map(work, predict_rows, nthreads)
+    return vis
+
+
+def dft_point_sources_block(uvw, frequency, flux, l, m, block_size=2 ** 20, nthreads=1):
+    """ Predict the visibilities of point sources by DFT, for all baselines of a block of times
+
+    If the uvw of the baselines are antenna differences (see :py:func:`antenna_uvw`) the visibilities of each
+    time and channel are the matrix products of the antenna phasors of chunks of at most about block_size / nants
+    sources. The baselines whose uvw are not antenna differences, e.g. baselines missing from a measurement set,
+    are predicted by :py:func:`dft_point_sources`.
+
+    :param uvw: :math:`(u,v,w)` of baselines (in metres) [ntimes, nants, nants, 3]
+    :param frequency: Frequencies (Hz) [nchan]
+    :param flux: Flux of sources [nsources, nchan, npol]
+    :param l: horizontal direction cosines of sources relative to phase tracking centre [nsources]
+    :param m: orthogonal directon cosines of sources relative to phase tracking centre [nsources]
+    :param block_size: Approximate number of phasors evaluated at a time (1048576)
+    :param nthreads: Number of threads predicting times (1)
+    :return: visibilities [ntimes, nants, nants, nchan, npol]
+    """
+    ntimes, nants, _, _ = uvw.shape
+    nsources, nchan, npol = flux.shape
+    scale = numpy.array(frequency) / constants.c.value
+    vis = numpy.zeros([ntimes, nants, nants, nchan, npol], dtype='complex')
+
+    ant_uvw, mismatch = antenna_uvw(uvw)
+    if not numpy.all(mismatch):
+        s = dft_directions(l, m)
+        source_step = max(1, min(nsources, block_size // nants))
+        log.debug("dft_point_sources_block: predicting %d sources for %d times" % (nsources, ntimes))
+
+        def predict_time(itime):
+            for ichan in range(nchan):
+                for start in range(0, nsources, source_step):
+                    sources = slice(start, start + source_step)
+                    phasor = numpy.exp(-2j * numpy.pi * scale[ichan] * numpy.dot(ant_uvw[itime], s[sources].T))
+                    # [npol, nants, nsources] x [nsources, nants] summed over sources
+                    weighted = phasor[numpy.newaxis, ...] * flux[sources, ichan, :].T[:, numpy.newaxis, :]
+                    vis[itime, :, :, ichan, :] += numpy.matmul(weighted, numpy.conjugate(phasor).T).transpose([1, 2, 0])
+
+        dft_map(list(range(ntimes)), predict_time, nthreads)
+
+    nmismatch = numpy.sum(mismatch)
+    if nmismatch > 0:
+        log.debug("dft_point_sources_block: uvw of %d baselines are not antenna differences, predicting them "
+                  "directly" % nmismatch)
+        ruvw = (uvw[mismatch][:, numpy.newaxis, :] * scale[:, numpy.newaxis]).reshape([-1, 3])
+        chan = numpy.tile(numpy.arange(nchan), nmismatch)
+        vis[mismatch] = dft_point_sources(ruvw, chan, flux, l, m, block_size=block_size,
+                                          nthreads=nthreads).reshape([nmismatch, nchan, npol])
+    return vis
@@ -0,0 +1,226 @@
+"""
+FFT backends used by all Fourier transforms in the processing library and components.
+
+The transforms are done by numpy.fft unless another backend is configured:
+
+    - 'numpy': numpy.fft, with single precision transformed by scipy.fftpack to keep single precision
+    - 'scipy': scipy.fft (scipy >= 1.4), multi-threaded with workers threads
+    - 'pyfftw': pyfftw (if installed), multi-threaded with workers threads. The FFTW plans are kept in the
+      pyfftw interfaces cache and the FFTW wisdom can be loaded from and saved to a file so that plans are
+      reused across processes.
+    - 'auto': the first of pyfftw, scipy and numpy that is available
+
+For example::
+
+    fft_backend.configure(name='scipy', workers=8)
+
+or pass fft_backend, fft_workers and fft_wisdom_file to predict_2d and invert_2d, which also sets the backend in
+Dask workers. If the backend asked for is not available numpy is used.
+"""
+
+import logging
+import os
+import pickle
+import threading
+
+import numpy
+import scipy.fftpack
+
+from data_models.parameters import get_parameter
+
+log = logging.getLogger(__name__)
+
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
+
+try:
+    import pyfftw
+    import pyfftw.interfaces.numpy_fft
+except ImportError:
+    pyfftw = None
+
+
+class FFTBackend:
+    """ Forward and inverse FFTs over selected axes using a configurable library
+    """
+
+    def __init__(self, name='numpy', workers=1, wisdom_file=None, planner_effort='FFTW_MEASURE'):
+        """ Create an FFT backend
+
+        :param name: 'numpy', 'scipy', 'pyfftw' or 'auto' ('numpy')
+        :param workers: Number of threads used by scipy and pyfftw (1)
+        :param wisdom_file: File to load and save FFTW wisdom (pyfftw only) (optional)
+        :param planner_effort: FFTW planner effort (pyfftw only) ('FFTW_MEASURE')
+        """
+        self.name = 'numpy'
+        self.workers = 1
+        self.wisdom_file = None
+        self.planner_effort = planner_effort
+        self.lock = threading.Lock()
+        self.configure(name=name, workers=workers, wisdom_file=wisdom_file)
+
+    @staticmethod
+    def available():
+        """ Names of the backends that can be used
+
+        :return: list of names
+        """
+        names = ['numpy']
+        if scipy_fft is not None:
+            names.append('scipy')
+        if pyfftw is not None:
+            names.append('pyfftw')
+        return names
+
+    def configure(self, name=None, workers=None, wisdom_file=None, planner_effort=None):
+        """ Change the backend, the number of threads and/or the FFTW wisdom file
+
+        :param name: 'numpy', 'scipy', 'pyfftw' or 'auto'
+        :param workers: Number of threads used by scipy and pyfftw
+        :param wisdom_file: File to load and save FFTW wisdom (pyfftw only)
+        :param planner_effort: FFTW planner effort (pyfftw only)
+        """
+        with self.lock:
+            if name is not None:
+                if name == 'auto':
+                    name = self.available()[-1]
+                assert name in ['numpy', 'scipy', 'pyfftw'], "Unknown FFT backend %s" % name
+                if name not in self.available():
+                    log.warning("FFTBackend: %s is not available, using numpy" % name)
+                    name = 'numpy'
+                if name != self.name:
+                    log.debug("FFTBackend: using %s" % name)
+                self.name = name
+                if name == 'pyfftw':
+                    pyfftw.interfaces.cache.enable()
+            if workers is not None:
+                self.workers = workers
+            if planner_effort is not None:
+                self.planner_effort = planner_effort
+            if wisdom_file is not None and wisdom_file != self.wisdom_file:
+                self.wisdom_file = wisdom_file
+                self.load_wisdom()
+
+    def load_wisdom(self):
+        """ Load the FFTW wisdom from the wisdom file, if any
+        """
+        if pyfftw is not None and self.wisdom_file is not None and os.path.exists(self.wisdom_file):
+            with open(self.wisdom_file, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+            log.debug("FFTBackend: loaded FFTW wisdom from %s" % self.wisdom_file)
+
+    def save_wisdom(self):
+        """ Save the FFTW wisdom accumulated by this process to the wisdom file
+        """
+        if pyfftw is not None and self.wisdom_file is not None:
+            with open(self.wisdom_file, 'wb') as f:
+                pickle.dump(pyfftw.export_wisdom(), f)
+            log.debug("FFTBackend: saved FFTW wisdom to %s" % self.wisdom_file)
+
+    def fftn(self, a, axes=(-2, -1), overwrite=False):
+        """ Forward FFT, without normalisation
+
+        Single precision input gives a single precision result.
+
+        :param a: array
+        :param axes: axes to transform
+        :param overwrite: The contents of a may be destroyed (False)
+        :return: transform
+        """
+        if self.name == 'scipy':
+            return scipy_fft.fftn(a, axes=axes, workers=self.workers, overwrite_x=overwrite)
+        elif self.name == 'pyfftw':
+            return pyfftw.interfaces.numpy_fft.fftn(a, axes=axes, threads=self.workers, overwrite_input=overwrite,
+                                                    planner_effort=self.planner_effort)
+        elif a.dtype == numpy.complex64 or a.dtype == numpy.float32:
+            # numpy.fft always works in double precision
+            return scipy.fftpack.fftn(a, axes=axes, overwrite_x=overwrite)
+        else:
+            return numpy.fft.fftn(a, axes=axes)
+
+    def ifftn(self, a, axes=(-2, -1), overwrite=False):
+        """ Inverse FFT, normalised by the number of points transformed
+
+        Single precision input gives a single precision result.
+
+        :param a: array
+        :param axes: axes to transform
+        :param overwrite: The contents of a may be destroyed (False)
+        :return: transform
+        """
+        if self.name == 'scipy':
+            return scipy_fft.ifftn(a, axes=axes, workers=self.workers, overwrite_x=overwrite)
+        elif self.name == 'pyfftw':
+            return pyfftw.interfaces.numpy_fft.ifftn(a, axes=axes, threads=self.workers, overwrite_input=overwrite,
+                                                     planner_effort=self.planner_effort)
+        elif a.dtype == numpy.complex64 or a.dtype == numpy.float32:
+            # numpy.fft always works in double precision
+            return scipy.fftpack.ifftn(a, axes=axes, overwrite_x=overwrite)
+        else:
+            return numpy.fft.ifftn(a, axes=axes)
+
+    def rfftn(self, a, axes=(-2, -1)):
+        """ Forward FFT of a real array, giving the non-negative frequencies of the last axis
+
+        Single precision input gives a single precision result.
+
+        :param a: real array
+        :param axes: axes to transform
+        :return: transform
+        """
+        if self.name == 'scipy':
+            return scipy_fft.rfftn(a, axes=axes, workers=self.workers)
+        elif self.name == 'pyfftw':
+            return pyfftw.interfaces.numpy_fft.rfftn(a, axes=axes, threads=self.workers,
+                                                     planner_effort=self.planner_effort)
+        elif a.dtype == numpy.float32:
+            # scipy.fftpack has no multidimensional real transform
+            return numpy.fft.rfftn(a, axes=axes).astype('complex64')
+        else:
+            return numpy.fft.rfftn(a, axes=axes)
+
+    def irfftn(self, a, s, axes=(-2, -1), overwrite=False):
+        """ Inverse FFT to a real array from the non-negative frequencies of the last axis, normalised by the
+        number of points transformed
+
+        Single precision input gives a single precision result.
+
+        :param a: array
+        :param s: Shape of the result along the axes transformed
+        :param axes: axes to transform
+        :param overwrite: The contents of a may be destroyed (False)
+        :return: real transform
+        """
+        if self.name == 'scipy':
+            return scipy_fft.irfftn(a, s=s, axes=axes, workers=self.workers, overwrite_x=overwrite)
+        elif self.name == 'pyfftw':
+            return pyfftw.interfaces.numpy_fft.irfftn(a, s=s, axes=axes, threads=self.workers,
+                                                      overwrite_input=overwrite, planner_effort=self.planner_effort)
+        elif a.dtype == numpy.complex64:
+            # scipy.fftpack has no multidimensional real transform
+            return numpy.fft.irfftn(a, s=s, axes=axes).astype('float32')
+        else:
+            return numpy.fft.irfftn(a, s=s, axes=axes)
+
+    def __str__(self):
+        return "FFTBackend: %s with %d workers" % (self.name, self.workers)
+
+
+# The FFT backend used by all transforms in this process
+fft_backend = FFTBackend()
+
+
+def configure_fft_backend(**kwargs):
+    """ Configure the FFT backend from processing parameters
+
+    :param fft_backend: 'numpy', 'scipy', 'pyfftw' or 'auto' (unchanged if not given)
+    :param fft_workers: Number of threads (unchanged if not given)
+    :param fft_wisdom_file: File to load and save FFTW wisdom (unchanged if not given)
+    :return: FFTBackend
+    """
+    fft_backend.configure(name=get_parameter(kwargs, "fft_backend", None),
+                          workers=get_parameter(kwargs, "fft_workers", None),
+                          wisdom_file=get_parameter(kwargs, "fft_wisdom_file", None))
+    return fft_backend
@@ -1,9 +1,21 @@
 """ FFT support functions
 
+The transforms are done by the FFT backend configured in :py:mod:`processing_library.fourier_transforms.fft_backend`.
 """
 
 import numpy
 
+from .fft_backend import fft_backend
+
+
+def is_single_precision(a):
+    """ Is the array single precision (float32 or complex64)?
+
+    :param a: array
+    :return: True|False
+    """
+    return a.dtype == numpy.complex64 or a.dtype == numpy.float32
+
 
 def fft(a):
     """ Fourier transformation from image to grid space
@@ -12,13 +24,15 @@ def fft(a):
     
         If there are four axes then the last outer axes are not transformed
 
+        Single precision input is transformed in single precision and gives a complex64 result
+
     :param a: image in `lm` coordinate space
     :return: `uv` grid
     """
     if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
+        return numpy.fft.fftshift(fft_backend.fftn(numpy.fft.ifftshift(a, axes=[2, 3]), axes=[2, 3]), axes=[2, 3])
     else:
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+        return numpy.fft.fftshift(fft_backend.fftn(numpy.fft.ifftshift(a), axes=[-2, -1]))
 
 
 def ifft(a):
@@ -28,13 +42,283 @@ def ifft(a):
     
         If there are four axes then the last outer axes are not transformed
 
+        Single precision input is transformed in single precision and gives a complex64 result
+
     :param a: `uv` grid to transform
     :return: an image in `lm` coordinate space
     """
     if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
+        return numpy.fft.fftshift(fft_backend.ifftn(numpy.fft.ifftshift(a, axes=[2, 3]), axes=[2, 3]), axes=[2, 3])
     else:
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
+        return numpy.fft.fftshift(fft_backend.ifftn(numpy.fft.ifftshift(a), axes=[-2, -1]))
+
+
+def checkerboard(ny, nx, dtype='float'):
+    """ Checkerboard of +1 and -1, +1 at the centre (ny//2, nx//2)
+
+    For even ny and nx, multiplying by the checkerboard before and after an FFT has the same effect as
+    ifftshift before and fftshift after.
+
+    :param ny: Number of rows
+    :param nx: Number of columns
+    :param dtype: Type of result
+    :return: checkerboard [ny, nx]
+    """
+    sy = 1 - 2 * ((numpy.arange(ny) - ny // 2) % 2)
+    sx = 1 - 2 * ((numpy.arange(nx) - nx // 2) % 2)
+    return numpy.outer(sy, sx).astype(dtype)
+
+
+def fft_checkerboard(a, overwrite=False):
+    """ Fourier transformation from image to grid space without shifting the arrays
+
+    The same as :py:func:`fft` for arrays with two or four axes, but the centring is done by multiplying by a
+    :py:func:`checkerboard` instead of by copying the array in ifftshift and again in fftshift. With overwrite
+    the multiplication is done in place. Only the last two axes are transformed. Odd sizes are passed to
+    :py:func:`fft`.
+
+    :param a: image in `lm` coordinate space
+    :param overwrite: The contents of a may be destroyed, otherwise a is left unchanged (False)
+    :return: `uv` grid
+    """
+    ny, nx = a.shape[-2:]
+    if ny % 2 or nx % 2:
+        return fft(a)
+    if not numpy.iscomplexobj(a):
+        a = a.astype(numpy.result_type(a.dtype, numpy.complex64))
+        overwrite = True
+    cb = checkerboard(ny, nx, a.real.dtype)
+    if overwrite:
+        a *= cb
+    else:
+        a = a * cb
+    result = fft_backend.fftn(a, axes=[-2, -1], overwrite=True)
+    result *= cb
+    return result
+
+
+def ifft_checkerboard(a, overwrite=False):
+    """ Fourier transformation from grid to image space without shifting the arrays
+
+    The same as :py:func:`ifft` for arrays with two or four axes, but the centring is done by multiplying by a
+    :py:func:`checkerboard` instead of by copying the array in ifftshift and again in fftshift. With overwrite
+    the multiplication is done in place. Only the last two axes are transformed. Odd sizes are passed to
+    :py:func:`ifft`.
+
+    :param a: `uv` grid to transform
+    :param overwrite: The contents of a may be destroyed, otherwise a is left unchanged (False)
+    :return: an image in `lm` coordinate space
+    """
+    ny, nx = a.shape[-2:]
+    if ny % 2 or nx % 2:
+        return ifft(a)
+    if not numpy.iscomplexobj(a):
+        a = a.astype(numpy.result_type(a.dtype, numpy.complex64))
+        overwrite = True
+    cb = checkerboard(ny, nx, a.real.dtype)
+    if overwrite:
+        a *= cb
+    else:
+        a = a * cb
+    result = fft_backend.ifftn(a, axes=[-2, -1], overwrite=True)
+    result *= cb
+    return result
+
+
+def hermitian_half_width(nx, x0):
+    """ Number of columns of a half uv grid holding the columns x0 to nx of a centred grid of width nx
+
+    The last column, nx, is the same as column 0 of the full grid (the Nyquist frequency in u).
+
+    :param nx: Width of the full grid
+    :param x0: First column of the full grid held in the half grid (1 <= x0 <= nx//2)
+    :return: Number of columns
+    """
+    assert 1 <= x0 <= nx // 2, "First column %d of half grid must be in [1, %d]" % (x0, nx // 2)
+    return nx - x0 + 1
+
+
+def ifft_hermitian(a, nx, nextract=None, block_size=None):
+    """ Real image from the u >= 0 half of a uv grid, by a complex to real FFT
+
+    The real part of the ifft of a grid is the ifft of its Hermitian part (G(u, v) + G*(-u, -v)) / 2. So a real
+    image can be made by gridding every visibility with u < 0 as its conjugate at (-u, -v) and transforming
+    only the columns with u >= 0 of the Hermitian part. The Hermitian part is formed in place from the columns
+    around u = 0, which the gridding kernels spill into.
+
+    If nextract is given only the central nextract x nextract pixels are calculated, as in
+    :py:func:`ifft_extract`.
+
+    :param a: Columns x0 to nx of a centred uv grid of width nx (see :py:func:`hermitian_half_width`). The
+        contents are destroyed.
+    :param nx: Width of the full grid (even)
+    :param nextract: Size of the central section of the image to calculate (even) (optional)
+    :param block_size: Number of columns to transform at once (default is about 4M values per block)
+    :return: real image [..., ny, nx], the same as numpy.real(ifft(full grid)), or its central section
+    """
+    ny = a.shape[-2]
+    assert nx % 2 == 0 and ny % 2 == 0, "Grid must have even sizes"
+    x0 = nx + 1 - a.shape[-1]
+    hermitian_half_width(nx, x0)
+    rows = (ny - numpy.arange(ny)) % ny
+    # Columns nx//2 + k for k = 0 ... nx//2, and the columns nx//2 - k that are their mirror images
+    spectrum = a[..., nx // 2 - x0:]
+    nmirror = nx // 2 - x0 + 1
+    mirror = numpy.conjugate(a[..., rows[:, numpy.newaxis],
+                               nx // 2 - x0 - numpy.arange(nmirror)[numpy.newaxis, :]])
+    nyquist = numpy.conjugate(a[..., rows, -1])
+    spectrum[..., :nmirror] += mirror
+    spectrum[..., -1] += nyquist
+    del mirror, nyquist
+    # Centre the image by modulation with a checkerboard
+    sy = checkerboard(ny, 1, a.real.dtype)
+    sx = 1 - 2 * (numpy.arange(nx // 2 + 1) % 2)
+    spectrum *= 0.5 * sy * sx.astype(a.real.dtype)
+    if nextract is None:
+        result = fft_backend.irfftn(spectrum, s=(ny, nx), axes=[-2, -1], overwrite=True)
+        result *= sy
+        return result
+    # Transform in v only the rows to be extracted, and then in u
+    ey = slice(ny // 2 - nextract // 2, ny // 2 - nextract // 2 + nextract)
+    ex = slice(nx // 2 - nextract // 2, nx // 2 - nextract // 2 + nextract)
+    stage = ifft_extract_axis(spectrum, -2, ey, block_size=block_size)
+    stage *= sy[ey]
+    return fft_backend.irfftn(stage, s=(nx,), axes=[-1], overwrite=True)[..., ex]
+
+
+def fft_hermitian(a, x0, npixel=None):
+    """ u >= 0 half of the uv grid of a real image, by a real to complex FFT
+
+    The grid of a real image is Hermitian, so the columns with u < 0 are the conjugates of those at (-u, -v).
+    Visibilities with u < 0 can be degridded as the conjugates of those at (-u, -v) from the half grid.
+
+    If npixel is given the image is padded to npixel x npixel, as in :py:func:`pad_fft`.
+
+    :param a: real image [..., ny, nx]
+    :param x0: First column of the full grid to include in the result (see :py:func:`hermitian_half_width`)
+    :param npixel: Padded size (even) (optional)
+    :return: Columns x0 to nx of fft(a), or of fft(pad_mid(a, npixel))
+    """
+    ny, nx = a.shape[-2:]
+    assert nx % 2 == 0 and ny % 2 == 0, "Image must have even sizes"
+    pny, pnx = (ny, nx) if npixel is None else (npixel, npixel)
+    dtype = numpy.result_type(a.dtype, numpy.complex64)
+    # Transform in u only the rows holding the image, and then in v
+    rows = numpy.zeros(list(a.shape[:-1]) + [pnx], dtype=a.dtype)
+    rows[..., pnx // 2 - nx // 2:pnx // 2 - nx // 2 + nx] = a
+    spectrum_rows = fft_backend.rfftn(rows, axes=[-1])
+    del rows
+    sx = 1 - 2 * (numpy.arange(pnx // 2 + 1) % 2)
+    sy = checkerboard(pny, 1, a.dtype)
+    spectrum = numpy.zeros(list(a.shape[:-2]) + [pny, pnx // 2 + 1], dtype=dtype)
+    iy = slice(pny // 2 - ny // 2, pny // 2 - ny // 2 + ny)
+    spectrum[..., iy, :] = spectrum_rows * sx.astype(a.dtype) * sy[iy]
+    del spectrum_rows
+    spectrum = fft_backend.fftn(spectrum, axes=[-2], overwrite=True)
+    spectrum *= sy
+    result = numpy.zeros(list(a.shape[:-2]) + [pny, hermitian_half_width(pnx, x0)], dtype=dtype)
+    result[..., pnx // 2 - x0:] = spectrum
+    del spectrum
+    # The columns pnx//2 - k are the mirror images of pnx//2 + k
+    mrows = (pny - numpy.arange(pny)) % pny
+    nmirror = pnx // 2 - x0
+    result[..., :nmirror] = numpy.conjugate(result[..., mrows[:, numpy.newaxis],
+                                                   pnx - 2 * x0 - numpy.arange(nmirror)[numpy.newaxis, :]])
+    return result
+
+
+def pad_fft(a, npixel):
+    """ Pad to npixel and transform from image to grid space
+
+    This gives the same result as fft(pad_mid(a, npixel)) on the two innermost axes but transforms one axis at
+    a time: first in u only the rows holding the unpadded data and then in v. The padded image is never formed.
+
+    :param a: image [..., ny, nx] (even sizes)
+    :param npixel: padded size (even)
+    :return: `uv` grid [..., npixel, npixel]
+    """
+    ny, nx = a.shape[-2:]
+    assert nx % 2 == 0 and ny % 2 == 0 and npixel % 2 == 0, "Sizes must be even"
+    dtype = numpy.result_type(a.dtype, numpy.complex64)
+    rdtype = numpy.zeros(1, dtype=dtype).real.dtype
+    # The centring is done by modulation with a checkerboard along each axis
+    sy = checkerboard(npixel, 1, rdtype)
+    sx = checkerboard(1, npixel, rdtype)
+    ix = slice(npixel // 2 - nx // 2, npixel // 2 - nx // 2 + nx)
+    iy = slice(npixel // 2 - ny // 2, npixel // 2 - ny // 2 + ny)
+    rows = numpy.zeros(list(a.shape[:-1]) + [npixel], dtype=dtype)
+    rows[..., ix] = a * sx[:, ix]
+    rows = fft_backend.fftn(rows, axes=[-1], overwrite=True)
+    result = numpy.zeros(list(a.shape[:-2]) + [npixel, npixel], dtype=dtype)
+    result[..., iy, :] = rows * sx * sy[iy]
+    del rows
+    result = fft_backend.fftn(result, axes=[-2], overwrite=True)
+    result *= sy
+    return result
+
+
+def ifft_extract_axis(a, axis, extract, modulation=None, block_size=None):
+    """ Inverse FFT along one of the two innermost axes, keeping only a section along that axis
+
+    The transform is done a block of columns (or rows) at a time so that only the section of the result is
+    held in memory.
+
+    :param a: array
+    :param axis: Axis to transform (-2 or -1)
+    :param extract: slice along the axis to keep
+    :param modulation: Array broadcastable to a, multiplying each block before the transform (optional)
+    :param block_size: Number of columns (or rows) to transform at once (default is about 4M values per block)
+    :return: transform
+    """
+    assert axis in [-2, -1]
+    other = -1 if axis == -2 else -2
+    n = a.shape[axis]
+    nother = a.shape[other]
+    shape = list(a.shape)
+    shape[axis] = len(range(*extract.indices(n)))
+    result = numpy.zeros(shape, dtype=numpy.result_type(a.dtype, numpy.complex64))
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // (n * max(1, int(numpy.prod(a.shape[:-2])))))
+    index = [slice(None)] * a.ndim
+    section = [slice(None)] * a.ndim
+    section[axis] = extract
+    for start in range(0, nother, block_size):
+        index[other] = slice(start, min(start + block_size, nother))
+        if modulation is None:
+            block = fft_backend.ifftn(a[tuple(index)], axes=[axis])
+        else:
+            mindex = [slice(None)] * numpy.ndim(modulation)
+            if numpy.shape(modulation)[other] > 1:
+                mindex[other] = index[other]
+            block = fft_backend.ifftn(a[tuple(index)] * modulation[tuple(mindex)], axes=[axis], overwrite=True)
+        result[tuple(index)] = block[tuple(section)]
+    return result
+
+
+def ifft_extract(a, nextract, block_size=None):
+    """ Transform from grid to image space and extract the central nextract pixels
+
+    This gives the same result as extract_mid(ifft(a), nextract) on the two innermost axes but transforms one
+    axis at a time: first in v, a block of columns at a time keeping only the rows to be extracted, and then in
+    u only those rows. Apart from the grid itself, the memory used scales with the extracted image.
+
+    :param a: `uv` grid [..., ny, nx] (even sizes)
+    :param nextract: Size of section to extract (even)
+    :param block_size: Number of columns to transform at once (default is about 4M values per block)
+    :return: image [..., nextract, nextract]
+    """
+    ny, nx = a.shape[-2:]
+    assert nx % 2 == 0 and ny % 2 == 0 and nextract % 2 == 0, "Sizes must be even"
+    rdtype = numpy.zeros(1, dtype=numpy.result_type(a.dtype, numpy.complex64)).real.dtype
+    # The centring is done by modulation with a checkerboard along each axis
+    sy = checkerboard(ny, 1, rdtype)
+    sx = checkerboard(1, nx, rdtype)
+    ey = slice(ny // 2 - nextract // 2, ny // 2 - nextract // 2 + nextract)
+    ex = slice(nx // 2 - nextract // 2, nx // 2 - nextract // 2 + nextract)
+    stage = ifft_extract_axis(a, -2, ey, modulation=sy, block_size=block_size)
+    stage *= sy[ey] * sx
+    stage = fft_backend.ifftn(stage, axes=[-1], overwrite=True)
+    return stage[..., ex] * sx[:, ex]
 
 
 def pad_mid(ff, npixel):
@@ -125,3 +409,57 @@ def extract_oversampled(a, xf, yf, kernel_oversampling, kernelwidth):
             mx: mx + kernel_oversampling * kernelwidth: kernel_oversampling]
     # normalise
     return kernel_oversampling * kernel_oversampling * mid
+
+
+def extract_oversampled_kernels(a, kernel_oversampling, kernelwidth):
+    """ Extract all the oversampled kernels from the centre of the transform of an oversampled function
+
+    This gives the same kernels as :py:func:`processing_library.image.operations.convert_image_to_kernel`, with
+    kernel[yf, xf, i, j] = a[ny//2 + kernel_oversampling * (kernelwidth//2 - i) + yf, ...], but uses one
+    strided reshape instead of extracting each offset separately. Leading axes are kept.
+
+    :param a: transform of oversampled function [..., ny, nx]
+    :param kernel_oversampling: oversampling factor
+    :param kernelwidth: size of kernels
+    :return: kernels [..., kernel_oversampling, kernel_oversampling, kernelwidth, kernelwidth]
+    """
+    ny, nx = a.shape[-2:]
+    assert kernel_oversampling * kernelwidth < ny
+    assert kernel_oversampling * kernelwidth < nx
+    ystart = ny // 2 - kernel_oversampling * kernelwidth // 2 + kernel_oversampling
+    xstart = nx // 2 - kernel_oversampling * kernelwidth // 2 + kernel_oversampling
+    mid = a[..., ystart:ystart + kernel_oversampling * kernelwidth, xstart:xstart + kernel_oversampling * kernelwidth]
+    mid = mid.reshape(a.shape[:-2] + (kernelwidth, kernel_oversampling, kernelwidth, kernel_oversampling))
+    # Kernel taps run in the opposite direction to the grid
+    mid = mid[..., ::-1, :, ::-1, :]
+    naxes = len(a.shape) - 2
+    axes = list(range(naxes)) + [naxes + 1, naxes + 3, naxes, naxes + 2]
+    return numpy.ascontiguousarray(mid.transpose(axes))
+
+
+def pad_ifft_extract(a, npixel, nextract):
+    """ Pad to npixel, transform from grid to image space and extract the central nextract pixels
+
+    This gives the same result as extract_mid(ifft(pad_mid(a, npixel)), nextract) on the two innermost axes
+    but transforms one axis at a time: first only the rows holding the unpadded data and then only the columns
+    to be extracted. The cost and memory are about (nx + nextract) / npixel of those of the full transform.
+
+    :param a: array to be padded [..., ny, nx]
+    :param npixel: padded size
+    :param nextract: size of section to extract (even)
+    :return: array [..., nextract, nextract]
+    """
+    result = a
+    for axis in [a.ndim - 1, a.ndim - 2]:
+        n = result.shape[axis]
+        shape = list(result.shape)
+        shape[axis] = npixel
+        padded = numpy.zeros(shape, dtype=numpy.result_type(result.dtype, numpy.complex64))
+        start = npixel // 2 - n // 2
+        index = [slice(None)] * result.ndim
+        index[axis] = slice(start, start + n)
+        padded[tuple(index)] = result
+        padded = numpy.fft.fftshift(fft_backend.ifftn(numpy.fft.ifftshift(padded, axes=axis), axes=[axis]), axes=axis)
+        index[axis] = slice(npixel // 2 - nextract // 2, npixel // 2 + nextract // 2)
+        result = padded[tuple(index)]
+    return result
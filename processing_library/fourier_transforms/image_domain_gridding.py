@@ -0,0 +1,221 @@
+""" Image domain gridding (IDG) grids visibilities without convolution kernels. The visibilities are grouped by
+the small region of the uv grid, the subgrid, that they contribute to. For each subgrid the visibilities are
+transformed directly into a coarse image of the whole field, including the w term of every visibility, and
+multiplied by an anti-aliasing taper. A small FFT of this image gives the subgrid, which is added into the full
+grid. Degridding is the reverse.
+
+The w term is applied exactly so, unlike w projection, the cost per visibility does not grow with abs(w). The
+full grid is convolved by the transform of the taper and so is corrected in the image in the same way as for
+the prolate spheroidal convolution kernel, using the gcf from :py:func:`anti_aliasing_calculate`.
+
+See van der Tol, Veenboer and Offringa, A&A 616, A27 (2018).
+"""
+
+import logging
+
+import numpy
+
+from .convolutional_gridding import grdsf, coordinates
+from .fft_support import fft, ifft
+
+log = logging.getLogger(__name__)
+
+
+def idg_taper(subgrid_size):
+    """ Anti-aliasing taper sampled on the subgrid image
+
+    The taper is the prolate spheroidal function used by :py:func:`anti_aliasing_calculate`, normalised to
+    unity at the centre.
+
+    :param subgrid_size: Size of subgrid
+    :return: taper [subgrid_size, subgrid_size]
+    """
+    taper1d, _ = grdsf(numpy.abs(2.0 * coordinates(subgrid_size)))
+    taper1d /= taper1d[subgrid_size // 2]
+    return numpy.outer(taper1d, taper1d)
+
+
+def idg_subgrids(shape, vuvwmap, vfrequencymap, subgrid_size=32, support=16):
+    """ Assign the visibilities to subgrids
+
+    The grid is divided into tiles of (subgrid_size - support) cells. The subgrid of each tile extends support//2
+    cells beyond the tile on every side so that the transform of the taper of every visibility falls inside it.
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param subgrid_size: Size of subgrids (32)
+    :param support: Number of cells at the edges of each subgrid not used for visibility positions (16)
+    :return: rows in subgrid order, start of each subgrid in rows, [chan, y0, x0] of each subgrid, y and x grid
+        coordinates of each visibility
+    """
+    _, _, ny, nx = shape
+    assert subgrid_size > support, "Subgrid size %d must be larger than support %d" % (subgrid_size, support)
+    assert numpy.array(vuvwmap[:, 0:2] >= -0.5).all() and numpy.array(vuvwmap[:, 0:2] < 0.5).all(), \
+        "Cellsize is too large: uv overflows grid"
+    tile = subgrid_size - support
+    y = ny // 2 + vuvwmap[:, 1] * ny
+    x = nx // 2 + vuvwmap[:, 0] * nx
+    chan = numpy.array(vfrequencymap, dtype='int')
+    ty = numpy.floor(y / tile).astype('int')
+    tx = numpy.floor(x / tile).astype('int')
+    ntx = nx // tile + 1
+    nty = ny // tile + 1
+    key = (chan * nty + ty) * ntx + tx
+    order = numpy.argsort(key, kind='stable')
+    keys, starts = numpy.unique(key[order], return_index=True)
+    corners = numpy.zeros([len(keys), 3], dtype='int')
+    corners[:, 0] = keys // (nty * ntx)
+    corners[:, 1] = ((keys // ntx) % nty) * tile - support // 2
+    corners[:, 2] = (keys % ntx) * tile - support // 2
+    return order, numpy.append(starts, len(order)), corners, y, x
+
+
+def idg_phasor(y, x, w, y0, x0, subgrid_size, field_of_view):
+    """ Phasors taking the visibilities of one subgrid to the subgrid image
+
+    :param y: v grid coordinates of visibilities
+    :param x: u grid coordinates of visibilities
+    :param w: w of visibilities (wavelengths)
+    :param y0: First grid row of subgrid
+    :param x0: First grid column of subgrid
+    :param subgrid_size: Size of subgrid
+    :param field_of_view: Field of view of the (padded) image (radians)
+    :return: phasors [nvis, subgrid_size, subgrid_size]
+    """
+    p = numpy.arange(subgrid_size) - subgrid_size // 2
+    # Offsets from the centre of the subgrid
+    a = y - (y0 + subgrid_size // 2)
+    b = x - (x0 + subgrid_size // 2)
+    scale = field_of_view / subgrid_size
+    r2 = (scale * p[:, numpy.newaxis]) ** 2 + (scale * p[numpy.newaxis, :]) ** 2
+    nm1 = numpy.zeros_like(r2)
+    nm1[r2 < 1.0] = numpy.sqrt(1.0 - r2[r2 < 1.0]) - 1.0
+    phase = -2.0 * numpy.pi * (a[:, numpy.newaxis, numpy.newaxis] * p[numpy.newaxis, :, numpy.newaxis] +
+                               b[:, numpy.newaxis, numpy.newaxis] * p[numpy.newaxis, numpy.newaxis, :]) / \
+        subgrid_size
+    phase += 2.0 * numpy.pi * w[:, numpy.newaxis, numpy.newaxis] * nm1[numpy.newaxis, ...]
+    return numpy.exp(1j * phase)
+
+
+def idg_w_layers(w, field_of_view, support=16, wstep=None):
+    """ Divide the visibilities into layers in w
+
+    Within a subgrid the w term of a visibility spreads it over about abs(w) * field_of_view**2 / 2 cells, which
+    must fit inside the support. The w of each layer is therefore removed in the subgrids and applied to the
+    image of the layer instead, as in w stacking. By default the layers are as far apart as the support allows.
+
+    :param w: w of visibilities (wavelengths)
+    :param field_of_view: Field of view of the (padded) image (radians)
+    :param support: Number of cells at the edges of each subgrid not used for visibility positions (16)
+    :param wstep: Separation of layers in w (wavelengths) (optional)
+    :return: layer of each visibility, w of each layer
+    """
+    if wstep is None:
+        wstep = 2.0 * max(support - 6, 1) / field_of_view ** 2
+    layer = numpy.round(w / wstep).astype('int')
+    layers = numpy.arange(numpy.min(layer), numpy.max(layer) + 1)
+    return layer - layers[0], wstep * layers
+
+
+def idg_subgrid_slices(shape, y0, x0, subgrid_size):
+    """ Overlap of a subgrid with the grid
+
+    :param shape: Shape of grid [nchan, npol, ny, nx]
+    :param y0: First grid row of subgrid
+    :param x0: First grid column of subgrid
+    :param subgrid_size: Size of subgrid
+    :return: slices into grid (y, x), slices into subgrid (y, x)
+    """
+    _, _, ny, nx = shape
+    gy = slice(max(y0, 0), min(y0 + subgrid_size, ny))
+    gx = slice(max(x0, 0), min(x0 + subgrid_size, nx))
+    sy = slice(gy.start - y0, gy.stop - y0)
+    sx = slice(gx.start - x0, gx.stop - x0)
+    return (gy, gx), (sy, sx)
+
+
+def idg_grid(uvgrid, vis, visweights, vuvwmap, vfrequencymap, vw, field_of_view, subgrid_size=32, support=16,
+             w_offset=0.0, block_size=None):
+    """ Grid visibilities using image domain gridding
+
+    Only w - w_offset is applied in the subgrids. The remaining w_offset term must be applied to the image made
+    from uvgrid e.g. by multiplying by w_beam.
+
+    :param uvgrid: Grid to add to [nchan, npol, ny, nx]
+    :param vis: Visibility values
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param vw: w of visibilities (wavelengths)
+    :param field_of_view: Field of view of the image corresponding to uvgrid (radians)
+    :param subgrid_size: Size of subgrids (32)
+    :param support: Number of cells at the edges of each subgrid not used for visibility positions (16)
+    :param w_offset: w removed from all visibilities (wavelengths)
+    :param block_size: Number of visibilities to transform at once (default is about 4M phasors)
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    """
+    inchan, inpol, ny, nx = uvgrid.shape
+    npol = vis.shape[-1]
+    sumwt = numpy.zeros([inchan, inpol])
+    chan = numpy.array(vfrequencymap, dtype='int')
+    for pol in range(npol):
+        sumwt[:, pol] += numpy.bincount(chan, weights=visweights[..., pol], minlength=inchan)
+    viswt = vis * visweights
+
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // subgrid_size ** 2)
+
+    taper = idg_taper(subgrid_size)
+    order, starts, corners, y, x = idg_subgrids(uvgrid.shape, vuvwmap, vfrequencymap, subgrid_size, support)
+    log.debug("idg_grid: gridding %d visibilities onto %d subgrids" % (len(order), len(corners)))
+    for isubgrid, (schan, y0, x0) in enumerate(corners):
+        subimage = numpy.zeros([npol, subgrid_size, subgrid_size], dtype='complex')
+        for start in range(starts[isubgrid], starts[isubgrid + 1], block_size):
+            rows = order[start:min(start + block_size, starts[isubgrid + 1])]
+            phasor = idg_phasor(y[rows], x[rows], vw[rows] - w_offset, y0, x0, subgrid_size, field_of_view)
+            subimage += numpy.einsum('rp,ryx->pyx', viswt[rows], phasor)
+        subgrid = ifft((subimage * taper)[numpy.newaxis, ...])[0]
+        (gy, gx), (sy, sx) = idg_subgrid_slices(uvgrid.shape, y0, x0, subgrid_size)
+        uvgrid[schan, :npol, gy, gx] += subgrid[:, sy, sx].astype(uvgrid.dtype)
+    return uvgrid, sumwt
+
+
+def idg_degrid(vshape, uvgrid, vuvwmap, vfrequencymap, vw, field_of_view, subgrid_size=32, support=16,
+               w_offset=0.0, block_size=None):
+    """ Degrid visibilities using image domain gridding
+
+    Only w - w_offset is applied in the subgrids. The remaining w_offset term must already have been applied to
+    the image from which uvgrid was made.
+
+    :param vshape: Shape of visibility
+    :param uvgrid: The uv plane to de-grid from [nchan, npol, ny, nx]
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param vw: w of visibilities (wavelengths)
+    :param field_of_view: Field of view of the image corresponding to uvgrid (radians)
+    :param subgrid_size: Size of subgrids (32)
+    :param support: Number of cells at the edges of each subgrid not used for visibility positions (16)
+    :param w_offset: w removed from all visibilities (wavelengths)
+    :param block_size: Number of visibilities to transform at once (default is about 4M phasors)
+    :return: Array of visibilities
+    """
+    npol = vshape[1]
+    vis = numpy.zeros(vshape, dtype='complex')
+
+    if block_size is None:
+        block_size = max(1, 2 ** 22 // subgrid_size ** 2)
+
+    taper = idg_taper(subgrid_size)
+    order, starts, corners, y, x = idg_subgrids(uvgrid.shape, vuvwmap, vfrequencymap, subgrid_size, support)
+    log.debug("idg_degrid: degridding %d visibilities from %d subgrids" % (len(order), len(corners)))
+    for isubgrid, (schan, y0, x0) in enumerate(corners):
+        subgrid = numpy.zeros([npol, subgrid_size, subgrid_size], dtype='complex')
+        (gy, gx), (sy, sx) = idg_subgrid_slices(uvgrid.shape, y0, x0, subgrid_size)
+        subgrid[:, sy, sx] = uvgrid[schan, :npol, gy, gx]
+        subimage = fft(subgrid[numpy.newaxis, ...])[0] * taper / float(subgrid_size) ** 2
+        for start in range(starts[isubgrid], starts[isubgrid + 1], block_size):
+            rows = order[start:min(start + block_size, starts[isubgrid + 1])]
+            phasor = idg_phasor(y[rows], x[rows], vw[rows] - w_offset, y0, x0, subgrid_size, field_of_view)
+            vis[rows, :] = numpy.einsum('pyx,ryx->rp', subimage, numpy.conjugate(phasor))
+    return vis
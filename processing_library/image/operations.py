@@ -17,7 +17,7 @@ from data_models.polarisation import PolarisationFrame
 from data_models.memory_data_models import Image
 
 from ..fourier_transforms.convolutional_gridding import w_beam
-from ..fourier_transforms.fft_support import ifft, fft
+from ..fourier_transforms.fft_support import ifft_checkerboard, fft_checkerboard, extract_oversampled_kernels
 
 log = logging.getLogger(__name__)
 
@@ -194,22 +194,8 @@ def convert_image_to_kernel(im: Image, oversampling, kernelwidth):
     
     newdata_shape = [nchan, npol, oversampling, oversampling, kernelwidth, kernelwidth]
 
-    newdata = numpy.zeros(newdata_shape, dtype=im.data.dtype)
-    
-    assert oversampling * kernelwidth < ny
-    assert oversampling * kernelwidth < nx
-    
-    ystart = ny // 2 - oversampling * kernelwidth // 2
-    xstart = nx // 2 - oversampling * kernelwidth // 2
-    yend = ny // 2 + oversampling * kernelwidth // 2
-    xend = nx // 2 + oversampling * kernelwidth // 2
-    for chan in range(nchan):
-        for pol in range(npol):
-            for y in range(oversampling):
-                slicey = slice(yend + y, ystart + y, -oversampling)
-                for x in range(oversampling):
-                    slicex = slice(xend + x, xstart + x, -oversampling)
-                    newdata[chan, pol, y, x, ...] = im.data[chan, pol, slicey, slicex]
+    newdata = extract_oversampled_kernels(im.data, oversampling, kernelwidth)
+    assert list(newdata.shape) == newdata_shape
     
     return create_image_from_array(newdata, newwcs, polarisation_frame=im.polarisation_frame)
 
@@ -284,7 +270,7 @@ def fft_image(im, template_image=None):
         ft_wcs.wcs.ctype[1] = 'VV'
         ft_wcs.wcs.cdelt[0] = 1.0 / (ft_shape[3] * d2r * im.wcs.wcs.cdelt[0])
         ft_wcs.wcs.cdelt[1] = 1.0 / (ft_shape[2] * d2r * im.wcs.wcs.cdelt[1])
-        ft_data = ifft(im.data.astype('complex'))
+        ft_data = ifft_checkerboard(im.data.astype('complex'), overwrite=True)
         return create_image_from_array(ft_data, wcs=ft_wcs, polarisation_frame=im.polarisation_frame)
     elif im.wcs.wcs.ctype[0] == 'UU' and im.wcs.wcs.ctype[1] == 'VV':
         ft_wcs.wcs.crval[0] = template_image.wcs.wcs.crval[0]
@@ -295,7 +281,7 @@ def fft_image(im, template_image=None):
         ft_wcs.wcs.ctype[1] = template_image.wcs.wcs.ctype[1]
         ft_wcs.wcs.cdelt[0] = template_image.wcs.wcs.cdelt[0]
         ft_wcs.wcs.cdelt[1] = template_image.wcs.wcs.cdelt[1]
-        ft_data = fft(im.data.astype('complex'))
+        ft_data = fft_checkerboard(im.data.astype('complex'), overwrite=True)
         return create_image_from_array(ft_data, wcs=ft_wcs, polarisation_frame=im.polarisation_frame)
     else:
         raise NotImplementedError("Cannot FFT specified axes")
@@ -4,6 +4,7 @@ Functions that aid definition of fourier transform processing.
 
 import logging
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from astropy.wcs import FITSFixedWarning
 
@@ -13,9 +14,11 @@ from data_models.memory_data_models import Visibility, Image
 from data_models.parameters import get_parameter
 from data_models.polarisation import PolarisationFrame
 
-from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate
-from ..image.operations import convert_image_to_kernel
-from ..image.operations import copy_image, fft_image, pad_image, create_w_term_like
+from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate, anti_aliasing_calculate_separable, \
+    anti_aliasing_calculate_es, es_kernel_parameters, w_beam
+from ..fourier_transforms.fft_support import pad_ifft_extract, extract_oversampled_kernels
+from ..image.operations import pad_image
+from .kernel_cache import w_kernel_cache
 
 log = logging.getLogger(__name__)
 
@@ -116,6 +119,36 @@ def get_uvw_map(vis: Visibility, im: Image, padding=2):
     return uvw_mode, shape, padding, vuvwmap
 
 
+def get_padding(**kwargs):
+    """ Get the padding of the grid
+
+    This is the padding parameter (default 2). For the exponential of semicircle kernel (kernel='es') without
+    a padding parameter it is the upsampling chosen for the kernel_accuracy by :py:func:`es_kernel_parameters`.
+
+    :return: padding
+    """
+    padding = get_parameter(kwargs, "padding", None)
+    if padding is None:
+        if get_parameter(kwargs, "kernel", "2d") == 'es':
+            padding = es_kernel_parameters(get_parameter(kwargs, "kernel_accuracy", 1e-6))[2]
+        else:
+            padding = 2
+    return padding
+
+
+def get_precision_dtypes(**kwargs):
+    """ Get the data types of the uv grid and of the image
+
+    These are set by the precision parameter, 'double' (default) or 'single'.
+
+    :return: complex data type of the uv grid and visibilities, real data type of the image
+    """
+    if get_parameter(kwargs, "precision", "double") == 'single':
+        return 'complex64', 'float32'
+    else:
+        return 'complex', 'float'
+
+
 def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3):
     """Return a generator to calculate the standard visibility kernel
 
@@ -128,11 +161,137 @@ def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3):
     return numpy.zeros_like(vis.w, dtype='int'), [anti_aliasing_calculate(shape, oversampling, support)[1]]
 
 
+def separable_kernel_list(vis: Visibility, shape, oversampling=8, support=3):
+    """Return a generator to calculate the standard visibility kernel in separable form
+
+    The kernel is applied as the outer product of the same 1D kernel along u and v. This
+    requires one of the vectorised gridders.
+
+    :param vis: visibility
+    :param shape: tuple with 2D shape of grid
+    :param oversampling: Oversampling factor
+    :param support: Support of kernel
+    :return: Function to look up gridding kernel
+    """
+    return numpy.zeros_like(vis.w, dtype='int'), [anti_aliasing_calculate_separable(shape, oversampling, support)[1]]
+
+
+def energy_kernel_support(kernel, energy_threshold=1e-4, minwidth=8):
+    """ Find the smallest support of a kernel holding all but a fraction of its energy
+
+    :param kernel: Kernel [oversampling, oversampling, support, support]
+    :param energy_threshold: Fraction of the energy (sum of squared amplitude) that may be outside the support
+    :param minwidth: Minimum support
+    :return: support (even)
+    """
+    kernelwidth = kernel.shape[-1]
+    energy = numpy.sum(numpy.abs(kernel) ** 2, axis=(0, 1))
+    total = numpy.sum(energy)
+    centre = kernelwidth // 2
+    for width in range(min(minwidth, kernelwidth), kernelwidth, 2):
+        half = width // 2
+        if total - numpy.sum(energy[centre - half:centre + half, centre - half:centre + half]) <= \
+                energy_threshold * total:
+            return width
+    return kernelwidth
+
+
+def trim_kernel(kernel, width):
+    """ Extract the central width x width taps of a kernel
+
+    This is the same as extracting the kernel with kernelwidth=width in convert_image_to_kernel.
+
+    :param kernel: Kernel [oversampling, oversampling, support, support]
+    :param width: New support (even)
+    :return: Kernel [oversampling, oversampling, width, width]
+    """
+    kernelwidth = kernel.shape[-1]
+    if width >= kernelwidth:
+        return kernel
+    start = (kernelwidth - width) // 2
+    return numpy.ascontiguousarray(kernel[..., start:start + width, start:start + width])
+
+
+def w_kernel_stack(npixel, cellsize, w_values, gcf, oversampling=1, kernelwidth=16, wcentre=None,
+                   remove_shift=False, nthreads=1, max_memory=0.5):
+    """ Calculate w convolution kernels for many w values at once
+
+    The w screens for a batch of w values are made as one array and transformed together. Only the centre of
+    the oversampled transform is used, so the padding and transform are done by :py:func:`pad_ifft_extract`,
+    which skips the rows and columns that are zero or not needed. The oversampled kernels are then extracted
+    by strided reshapes (see :py:func:`extract_oversampled_kernels`). The batches are limited to about
+    max_memory GB and, if nthreads > 1, are transformed in parallel by a thread pool.
+
+    This gives the same kernels as making each w screen with create_w_term_like and converting it with
+    pad_image, fft_image and convert_image_to_kernel.
+
+    :param npixel: Number of pixels on each axis of the (padded) image
+    :param cellsize: Cellsize of image (radians)
+    :param w_values: w values
+    :param gcf: Gridding correction function [npixel, npixel] that the w screens are divided by
+    :param oversampling: Oversampling factor
+    :param kernelwidth: Support of kernels
+    :param wcentre: Pixel coordinates of the delay centre [x, y] (default is npixel//2)
+    :param remove_shift: Remove overall phase shift at the centre of the image
+    :param nthreads: Number of threads used for the FFTs
+    :param max_memory: Maximum memory per batch of padded w screens (GB)
+    :return: list of kernels [oversampling, oversampling, kernelwidth, kernelwidth]
+    """
+    if wcentre is None:
+        wcentre = [npixel // 2, npixel // 2]
+    padded_npixel = npixel * oversampling
+    assert oversampling * kernelwidth < padded_npixel, "Kernel width %d too large" % kernelwidth
+    # Only the centre of the transform is needed for the kernels
+    nextract = min(oversampling * (kernelwidth + 2), padded_npixel)
+    plane_bytes = 16 * padded_npixel * (npixel + nextract)
+    batch_size = max(1, int(max_memory * 1024.0 ** 3 / plane_bytes))
+    if nthreads > 1:
+        # Give every thread some work
+        batch_size = min(batch_size, max(1, int(numpy.ceil(len(w_values) / nthreads))))
+
+    def make_kernels(wbatch):
+        """ Make the kernels for a batch of w values
+        """
+        screens = numpy.zeros([len(wbatch), npixel, npixel], dtype='complex')
+        for i, w in enumerate(wbatch):
+            screens[i, ...] = w_beam(npixel, npixel * cellsize, w=w, cx=wcentre[0], cy=wcentre[1],
+                                     remove_shift=remove_shift) / gcf
+        wconv = pad_ifft_extract(screens, padded_npixel, nextract)
+        wconv *= float(oversampling) ** 2
+        return list(extract_oversampled_kernels(wconv, oversampling, kernelwidth))
+
+    batches = [w_values[i:i + batch_size] for i in range(0, len(w_values), batch_size)]
+    if nthreads > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            results = list(executor.map(make_kernels, batches))
+    else:
+        results = [make_kernels(wbatch) for wbatch in batches]
+    return [kernel for result in results for kernel in result]
+
+
 # noinspection PyTypeChecker
-def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, **kwargs):
+def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, cache=None,
+                  kernel_support='fixed', energy_threshold=1e-4, nthreads=1, **kwargs):
     """ Calculate w convolution kernels
     
-    Uses create_w_term_like to calculate the w screen. This is exactly as wstacking does.
+    The w screens are the same as from create_w_term_like, as wstacking uses. The kernels are calculated in
+    batches by :py:func:`w_kernel_stack`.
+
+    The kernels are calculated at multiples of wstep and each row uses the kernel of the nearest multiple.
+
+    If a :py:class:`KernelCache` is given, kernels are looked up there before being calculated. The key is
+    (image shape, cellsize, phasecentre offset, w, oversampling, kernelwidth, remove_shift).
+
+    The support of the kernels is set by kernel_support:
+
+        - fixed: all kernels have support kernelwidth
+        - fresnel: the support grows from 8 at w=0 in proportion to abs(w), as does the Fresnel number, reaching
+          kernelwidth at the maximum abs(w)
+        - energy: the support is the smallest holding all but energy_threshold of the energy of the kernel
+          (see :py:func:`energy_kernel_support`)
+
+    Most samples have small w so adaptive supports greatly reduce the cost of gridding. The kernels are always
+    calculated at kernelwidth and then trimmed.
 
     Returns (indices to the w kernel for each row, kernels)
 
@@ -145,6 +304,10 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     :param vis: visibility
     :param oversampling: Oversampling factor
     :param wstep: Step in w between cached functions
+    :param cache: KernelCache to use (optional)
+    :param kernel_support: 'fixed', 'fresnel' or 'energy'
+    :param energy_threshold: Fraction of energy allowed outside the support for kernel_support='energy'
+    :param nthreads: Number of threads used to calculate the kernels
     :return: (indices to the w kernel for each row, kernels)
     """
 
@@ -157,38 +320,55 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     wmaxabs = numpy.max(numpy.abs(vis.w))
     log.debug("w_kernel_list: Maximum absolute w = %.1f, step is %.1f wavelengths" % (wmaxabs, wstep))
 
-    def digitise(w, wstep):
-        return numpy.ceil((w + wmaxabs) / wstep).astype('int')
+    # The kernels are on a grid of w fixed by wstep alone, so that they are the same for every partition and
+    # can be shared through the cache
+    def digitise(w):
+        return numpy.round(w / wstep).astype('int')
     
     # Find all the unique indices for which we need a kernel
-    nwsteps = digitise(wmaxabs, wstep) + 1
-    w_list = numpy.linspace(-wmaxabs, +wmaxabs, nwsteps)
-    
-    wtemplate = copy_image(im)
-    
-    wtemplate.data = numpy.zeros(wtemplate.shape, dtype=im.data.dtype)
+    wmin_step = digitise(numpy.min(vis.w))
+    w_list = wstep * numpy.arange(wmin_step, digitise(numpy.max(vis.w)) + 1)
     
-    padded_shape = list(wtemplate.shape)
-    padded_shape[3] *= oversampling
-    padded_shape[2] *= oversampling
+    # The WCS loses precision when pickled so round the floating point parts of the key
+    remove_shift = get_parameter(kwargs, "remove_shift", False)
+    cellsize = float(numpy.round(im.wcs.wcs.cdelt[1], 12))
+    offset = tuple(numpy.round(im.wcs.wcs.crpix[0:2] - 1.0 - numpy.array([nx // 2, ny // 2]), 6))
+    keys = [((ny, nx), cellsize, offset, float(numpy.round(w, 6)), oversampling, kernelwidth, remove_shift)
+            for w in w_list]
+
+    full_kernels = [None for w in w_list]
+    if cache is not None:
+        full_kernels = [cache.get(key) for key in keys]
+
+    # Calculate all the missing kernels in batches
+    missing = [i for i, kernel in enumerate(full_kernels) if kernel is None]
+    if len(missing) > 0:
+        wcentre = [im.wcs.wcs.crpix[0] - 1.0, im.wcs.wcs.crpix[1] - 1.0]
+        new_kernels = w_kernel_stack(nx, abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0, w_list[missing], gcf,
+                                     oversampling=oversampling, kernelwidth=kernelwidth, wcentre=wcentre,
+                                     remove_shift=remove_shift, nthreads=nthreads)
+        for i, kernel in zip(missing, new_kernels):
+            full_kernels[i] = kernel
+            if cache is not None:
+                cache.put(keys[i], kernel)
 
-    # For all the unique indices, calculate the corresponding w kernel
     kernels = list()
-    for w in w_list:
-        # Make a w screen
-        wscreen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
-        wscreen.data /= gcf
-        assert numpy.max(numpy.abs(wscreen.data)) > 0.0, 'w screen is empty'
-        wscreen_padded = pad_image(wscreen, padded_shape)
-
-        wconv = fft_image(wscreen_padded)
-        wconv.data *= float(oversampling)**2
-        # For the moment, ignore the polarisation and channel axes
-        kernels.append(convert_image_to_kernel(wconv, oversampling,
-                                               kernelwidth).data[0, 0, ...])
+    for w, kernel in zip(w_list, full_kernels):
+        if kernel_support == 'fresnel':
+            minwidth = min(8, kernelwidth)
+            width = minwidth + 2 * int(numpy.ceil(0.5 * (kernelwidth - minwidth) * numpy.abs(w) / wmaxabs))
+            kernel = trim_kernel(kernel, width)
+        elif kernel_support == 'energy':
+            kernel = trim_kernel(kernel, energy_kernel_support(kernel, energy_threshold))
+        elif kernel_support != 'fixed':
+            raise ValueError("Unknown kernel support %s" % kernel_support)
+        kernels.append(kernel)
     
+    if kernel_support != 'fixed':
+        log.debug("w_kernel_list: kernel supports %s" % str([kernel.shape[-1] for kernel in kernels]))
+
     # Now make a lookup table from row number of vis to the kernel
-    kernel_indices = digitise(vis.w, wstep)
+    kernel_indices = digitise(vis.w) - wmin_step
     assert numpy.max(kernel_indices) < len(kernels), "wabsmax %f wstep %f" % (wmaxabs, wstep)
     assert numpy.min(kernel_indices) >= 0, "wabsmax %f wstep %f" % (wmaxabs, wstep)
     return kernel_indices, kernels
@@ -196,7 +376,18 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
 
 def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     """Get the list of kernels, one per visibility
-    
+
+    Without w projection the anti-aliasing kernel is returned in separable form (kernel name '2d_separable')
+    unless separable=False is given, in which case the full 2D kernel is returned (kernel name '2d').
+    kernel='es' selects the exponential of semicircle kernel (kernel name 'es') instead. It is evaluated
+    directly rather than from an oversampled table, with support chosen for kernel_accuracy (default 1e-6)
+    and the padding (see :py:func:`get_padding`). Both the separable and ES kernels need the vectorised gridders.
+
+    The w projection kernels are held in a cache shared by all calls in this process, unless kernel_cache=False.
+    The cache memory limit (GB) and a directory to spill evicted kernels to can be set by kernel_cache_memory
+    and kernel_cache_directory. The support of each w kernel can be adapted to its w by kernel_support='fresnel'
+    or 'energy' (see :py:func:`w_kernel_list`), with kernel_energy_threshold as the fraction of energy allowed
+    outside the support.
     """
     
     shape = im.data.shape
@@ -205,7 +396,16 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     
     wstep = get_parameter(kwargs, "wstep", 0.0)
     oversampling = get_parameter(kwargs, "oversampling", 8)
-    padding = get_parameter(kwargs, "padding", 2)
+    padding = get_padding(**kwargs)
+    
+    if get_parameter(kwargs, "kernel", "2d") == 'es' and wstep == 0.0:
+        kernelname = 'es'
+        padded_npixel = int(round(padding * npixel))
+        gcf, kernel = anti_aliasing_calculate_es((padded_npixel, padded_npixel),
+                                                 get_parameter(kwargs, "kernel_accuracy", 1e-6), padding)
+        log.debug("get_kernel_list: Using exponential of semicircle kernel, support %d, beta %.3f, padding %.2f" %
+                  (kernel.support, kernel.beta, padding))
+        return kernelname, gcf, (numpy.zeros_like(vis.w, dtype='int'), [kernel])
     
     gcf, _ = anti_aliasing_calculate((padding * npixel, padding * npixel), oversampling)
     
@@ -231,11 +431,120 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
 
         remove_shift = get_parameter(kwargs, "remove_shift", True)
         padded_image = pad_image(im, padded_shape)
+        cache = None
+        if get_parameter(kwargs, "kernel_cache", True):
+            cache = w_kernel_cache
+            cache.configure(max_memory=get_parameter(kwargs, "kernel_cache_memory", None),
+                            spill_directory=get_parameter(kwargs, "kernel_cache_directory", None))
         kernel_list = w_kernel_list(vis, padded_image, oversampling=oversampling, wstep=wstep,
-                                    kernelwidth=kernelwidth, remove_shift=remove_shift)
+                                    kernelwidth=kernelwidth, remove_shift=remove_shift, cache=cache,
+                                    kernel_support=get_parameter(kwargs, "kernel_support", 'fixed'),
+                                    energy_threshold=get_parameter(kwargs, "kernel_energy_threshold", 1e-4),
+                                    nthreads=get_parameter(kwargs, "nthreads", 1))
+        if cache is not None:
+            log.debug("get_kernel_list: %s" % str(cache))
+    elif get_parameter(kwargs, "separable", True):
+        kernelname = '2d_separable'
+        kernel_list = separable_kernel_list(vis, (padding * npixel, padding * npixel),
+                                            oversampling=oversampling)
+        support = kernel_list[1][0].shape[-1]
+        log.debug("get_kernel_list: Using separable kernel, %d kernel values per sample instead of %d, "
+                  "table of %d values instead of %d" % (2 * support, support ** 2, oversampling * support,
+                                                       (oversampling * support) ** 2))
     else:
         kernelname = '2d'
         kernel_list = standard_kernel_list(vis, (padding * npixel, padding * npixel),
                                            oversampling=oversampling)
     
     return kernelname, gcf, kernel_list
+
+
+class GriddingPlan:
+    """ Gridding information precomputed for one visibility set, image geometry and set of kernel parameters
+
+    Holds the frequency map, uvw map, kernels, gridding correction function and the integer and fractional grid
+    coordinates of every visibility. None of these change between major cycles so a plan can be made once and
+    reused by every predict and invert of the same visibility.
+    """
+    
+    def __init__(self, key=None, spectral_mode=None, vfrequencymap=None, uvw_mode=None, shape=None, padding=None,
+                 vuvwmap=None, kernel_name=None, gcf=None, kernel_list=None, coordinates=None, order=None,
+                 hermitian=None):
+        """ Create a gridding plan
+
+        :param key: Key from :py:func:`gridding_plan_key` used to check that the plan applies
+        :param spectral_mode: Spectral mode from get_frequency_map
+        :param vfrequencymap: Map from visibility row to image channel
+        :param uvw_mode: uvw mode from get_uvw_map
+        :param shape: Shape of padded grid from get_uvw_map
+        :param padding: Padding factor
+        :param vuvwmap: Map from uvw to grid fractions
+        :param kernel_name: Kernel name from get_kernel_list
+        :param gcf: Gridding correction function
+        :param kernel_list: (kernel indices, kernels)
+        :param coordinates: Grid coordinates from convolutional_grid_coordinates
+        :param order: Gridding order of the visibilities from convolutional_grid_sort (optional)
+        :param hermitian: Coordinates, visibilities to conjugate, first column and gridding order for the half
+            grid used by real_fft, from convolutional_grid_coordinates_hermitian (optional)
+        """
+        self.key = key
+        self.spectral_mode = spectral_mode
+        self.vfrequencymap = vfrequencymap
+        self.uvw_mode = uvw_mode
+        self.shape = shape
+        self.padding = padding
+        self.vuvwmap = vuvwmap
+        self.kernel_name = kernel_name
+        self.gcf = gcf
+        self.kernel_list = kernel_list
+        self.coordinates = coordinates
+        self.order = order
+        self.hermitian = hermitian
+    
+    def size(self):
+        """ Return size in GB
+        """
+        size = self.vuvwmap.nbytes + self.gcf.nbytes
+        size += sum([numpy.array(kernel).nbytes for kernel in self.kernel_list[1]])
+        size += sum([coordinate.nbytes for coordinate in self.coordinates])
+        if self.order is not None:
+            size += self.order.nbytes
+        if self.hermitian is not None:
+            coordinates, mirrored, _, order = self.hermitian
+            size += sum([coordinate.nbytes for coordinate in coordinates]) + mirrored.nbytes
+            if order is not None:
+                size += order.nbytes
+        return size / 1024.0 / 1024.0 / 1024.0
+    
+    def __str__(self):
+        s = "GriddingPlan:\n"
+        s += "\tKernel name: %s\n" % self.kernel_name
+        s += "\tNumber of kernels: %d\n" % len(self.kernel_list[1])
+        s += "\tGrid shape: %s\n" % str(self.shape)
+        s += "\tPadding: %s\n" % str(self.padding)
+        s += "\tNumber of visibilities: %d\n" % len(self.vuvwmap)
+        s += "\tPresorted: %s\n" % str(self.order is not None)
+        s += "\tHalf grid: %s\n" % str(self.hermitian is not None)
+        return s
+
+
+def gridding_plan_key(vis: Visibility, im: Image, **kwargs):
+    """ Key identifying the visibility sampling, image geometry and kernel parameters that a gridding plan depends on
+
+    The visibility is identified by a cheap checksum of the uvw and frequency columns. The image pixel
+    coordinates are rounded since they do not survive a round trip through the WCS header exactly.
+
+    :param vis: Visibility
+    :param im: Image
+    :return: tuple
+    """
+    return (vis.nvis, float(numpy.sum(vis.uvw)), float(numpy.sum(numpy.abs(vis.uvw))),
+            float(numpy.sum(vis.frequency)), tuple(im.shape), tuple(numpy.round(im.wcs.wcs.cdelt, 12)),
+            tuple(numpy.round(im.wcs.wcs.crpix, 6)),
+            get_padding(**kwargs), get_parameter(kwargs, "oversampling", 8),
+            get_parameter(kwargs, "wstep", 0.0), get_parameter(kwargs, "kernelwidth", None),
+            get_parameter(kwargs, "remove_shift", True), get_parameter(kwargs, "separable", True),
+            get_parameter(kwargs, "presort", True), get_parameter(kwargs, "presort_tile_size", 32),
+            get_parameter(kwargs, "precision", "double"), get_parameter(kwargs, "kernel_support", 'fixed'),
+            get_parameter(kwargs, "kernel_energy_threshold", 1e-4), get_parameter(kwargs, "kernel", "2d"),
+            get_parameter(kwargs, "kernel_accuracy", 1e-6), get_parameter(kwargs, "real_fft", False))
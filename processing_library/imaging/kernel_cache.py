@@ -0,0 +1,157 @@
+"""
+Cache for convolution kernels, used for the w projection kernels.
+
+Each w kernel needs an FFT of an oversampled w screen, but depends only on the image geometry, the value of w and
+the kernel parameters. The kernels are therefore cached and shared by all calls within a process e.g. by all
+partitions and major cycles of a facet handled by a Dask worker. The w screen depends on the offset of the facet
+from the phase centre, so different facets do not share kernels.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+class KernelCache:
+    """ Least recently used cache of kernels with bounded memory and optional spill to disk
+
+    When the kernels held exceed max_memory the least recently used are evicted. If a spill directory is given
+    evicted kernels are saved there as .npy files and are read back if needed again.
+    """
+
+    def __init__(self, max_memory=1.0, spill_directory=None):
+        """ Create a kernel cache
+
+        :param max_memory: Maximum memory held by cached kernels (GB)
+        :param spill_directory: Directory to save evicted kernels to (optional)
+        """
+        self.max_memory = max_memory
+        self.spill_directory = spill_directory
+        self.kernels = OrderedDict()
+        self.memory = 0
+        self.spilled = set()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def configure(self, max_memory=None, spill_directory=None):
+        """ Change the memory limit and/or spill directory
+
+        Kernels already spilled are moved to the new spill directory.
+
+        :param max_memory: Maximum memory held by cached kernels (GB)
+        :param spill_directory: Directory to save evicted kernels to
+        """
+        with self.lock:
+            if max_memory is not None:
+                self.max_memory = max_memory
+            if spill_directory is not None and spill_directory != self.spill_directory:
+                old_files = {key: self.spill_file(key) for key in self.spilled}
+                self.spill_directory = spill_directory
+                if len(old_files) > 0:
+                    os.makedirs(self.spill_directory, exist_ok=True)
+                for key, old_file in old_files.items():
+                    if os.path.exists(old_file):
+                        shutil.move(old_file, self.spill_file(key))
+                    else:
+                        self.spilled.discard(key)
+            self.evict()
+
+    def spill_file(self, key):
+        """ Name of the file a kernel is spilled to
+
+        :param key: Kernel key
+        :return: file name
+        """
+        return os.path.join(self.spill_directory, "kernel_%s.npy" % hashlib.md5(repr(key).encode()).hexdigest())
+
+    def evict(self):
+        """ Evict least recently used kernels until the memory limit is met
+        """
+        while self.memory > self.max_memory * 1024.0 ** 3 and len(self.kernels) > 0:
+            key, kernel = self.kernels.popitem(last=False)
+            self.memory -= kernel.nbytes
+            if self.spill_directory is not None:
+                os.makedirs(self.spill_directory, exist_ok=True)
+                numpy.save(self.spill_file(key), kernel)
+                self.spilled.add(key)
+
+    def get(self, key):
+        """ Get a kernel
+
+        :param key: Kernel key
+        :return: kernel or None if not cached
+        """
+        with self.lock:
+            if key in self.kernels:
+                self.kernels.move_to_end(key)
+                self.hits += 1
+                return self.kernels[key]
+            if key in self.spilled:
+                kernel = numpy.load(self.spill_file(key))
+                self.hits += 1
+                self.disk_hits += 1
+                self.insert(key, kernel)
+                return kernel
+            self.misses += 1
+            return None
+
+    def insert(self, key, kernel):
+        """ Insert a kernel, the lock must be held
+
+        :param key: Kernel key
+        :param kernel: numpy array
+        """
+        self.kernels[key] = kernel
+        self.memory += kernel.nbytes
+        self.evict()
+
+    def put(self, key, kernel):
+        """ Add a kernel
+
+        :param key: Kernel key
+        :param kernel: numpy array
+        """
+        with self.lock:
+            if key not in self.kernels:
+                self.insert(key, kernel)
+
+    def clear(self):
+        """ Remove all kernels, including spilled kernels, and reset the counts
+        """
+        with self.lock:
+            for key in self.spilled:
+                if os.path.exists(self.spill_file(key)):
+                    os.remove(self.spill_file(key))
+            self.kernels = OrderedDict()
+            self.memory = 0
+            self.spilled = set()
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+    def statistics(self):
+        """ Hit and miss counts and memory use
+
+        :return: dict
+        """
+        return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'kernels': len(self.kernels), 'spilled': len(self.spilled),
+                'memory': self.memory / 1024.0 / 1024.0 / 1024.0}
+
+    def __str__(self):
+        return "KernelCache: %d hits (%d from disk), %d misses, %d kernels (%.3f GB) in memory, %d spilled" % \
+               (self.hits, self.disk_hits, self.misses, len(self.kernels), self.memory / 1024.0 ** 3,
+                len(self.spilled))
+
+
+# The w kernel cache shared by all calls in this process
+w_kernel_cache = KernelCache()
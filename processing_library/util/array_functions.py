@@ -113,10 +113,19 @@ def tukey_filter(x, r):
     
     See e.g. https://uk.mathworks.com/help/signal/ref/tukeywin.html
 
-    :param x: x coordinate (float)
+    :param x: x coordinate (float or array)
     :param r: transition point of filter (float)
     :returns: Value of filter for x
     """
+    if numpy.ndim(x) > 0:
+        x = numpy.asarray(x)
+        result = numpy.ones(x.shape)
+        high = (1 - r / 2.0 <= x) & (x <= 1.0)
+        result[high] = 0.5 * (1.0 + numpy.cos(2.0 * numpy.pi * (x[high] - 1 + r / 2.0) / r))
+        low = (0.0 <= x) & (x < r / 2.0)
+        result[low] = 0.5 * (1.0 + numpy.cos(2.0 * numpy.pi * (x[low] - r / 2.0) / r))
+        return result
+    
     if 0.0 <= x < r / 2.0:
         return 0.5 * (1.0 + numpy.cos(2.0 * numpy.pi * (x - r / 2.0) / r))
     elif 1 - r / 2.0 <= x <= 1.0:
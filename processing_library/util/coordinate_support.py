@@ -31,6 +31,8 @@ from Bottom to Top.
 """
 
 import numpy
+from astropy import constants as constants
+from astropy import units as u
 from astropy.coordinates import SkyCoord, CartesianRepresentation
 
 
@@ -169,6 +171,28 @@ def skycoord_to_lmn(pos: SkyCoord, phasecentre: SkyCoord):
     return dc.y.value, dc.z.value, dc.x.value - 1
 
 
+def skycoords_to_lmn(directions, phasecentre: SkyCoord):
+    """
+    Convert a list of astropy sky coordinates into the l,m,n coordinate system relative to a phase centre, as
+    skycoord_to_lmn.
+
+    The directions in the ICRS are converted together in one call. Any others are converted one at a time.
+
+    :param directions: list of SkyCoord
+    :param phasecentre: SkyCoord
+    :return: l, m, n arrays
+    """
+    lmn = numpy.zeros([3, len(directions)])
+    icrs = [i for i, d in enumerate(directions) if d.frame.name == 'icrs' and hasattr(d.data, 'lon')]
+    if len(icrs) > 0:
+        lon = numpy.array([directions[i].data.lon.to_value(u.rad) for i in icrs])
+        lat = numpy.array([directions[i].data.lat.to_value(u.rad) for i in icrs])
+        lmn[:, icrs] = skycoord_to_lmn(SkyCoord(lon * u.rad, lat * u.rad, frame='icrs'), phasecentre)
+    for i in sorted(set(range(len(directions))) - set(icrs)):
+        lmn[:, i] = skycoord_to_lmn(directions[i], phasecentre)
+    return lmn[0], lmn[1], lmn[2]
+
+
 def lmn_to_skycoord(lmn, phasecentre: SkyCoord):
     """
     Convert l,m,n coordinate system + phascentre to astropy sky coordinate
@@ -212,6 +236,49 @@ def simulate_point(dist_uvw, l, m):
     return numpy.exp(-2j * numpy.pi * numpy.dot(dist_uvw, s))
 
 
+def simulate_point_block(uvw, frequency, l, m):
+    """
+    Simulate visibilities for unit amplitude point source at direction cosines (l,m) relative to the phase
+    centre, as simulate_point, for all baselines and channels of a block of times.
+
+    The uvw of baseline (a2, a1) is the difference of the uvw of antennas a2 and a1, so its phasor is the phasor
+    of antenna a2 times the conjugate of the phasor of antenna a1. Only ntimes * nants * nchan exponentials are
+    evaluated, rather than one per baseline. The phasors of baselines whose uvw are not antenna differences
+    (see :py:func:`antenna_uvw`), e.g. baselines missing from a measurement set, are evaluated directly.
+
+    :param uvw: :math:`(u,v,w)` of baselines (in metres) [ntimes, nants, nants, 3]
+    :param frequency: Frequencies (Hz) [nchan]
+    :param l: horizontal direction cosine relative to phase tracking centre
+    :param m: orthogonal directon cosine relative to phase tracking centre
+    :return: phasors [ntimes, nants, nants, nchan]
+    """
+    scale = numpy.array(frequency) / constants.c.value
+    ant_uvw, mismatch = antenna_uvw(uvw)
+
+    ant_phasor = simulate_point(ant_uvw[..., numpy.newaxis, :] * scale[:, numpy.newaxis], l, m)
+    phasor = ant_phasor[:, :, numpy.newaxis, :] * numpy.conjugate(ant_phasor[:, numpy.newaxis, :, :])
+    if numpy.any(mismatch):
+        phasor[mismatch] = simulate_point(uvw[mismatch][:, numpy.newaxis, :] * scale[:, numpy.newaxis], l, m)
+    return phasor
+
+
+def antenna_uvw(uvw):
+    """
+    uvw of the antennas, relative to antenna 0, from the uvw of the baselines of a block of times
+
+    Every baseline (a2, a1), including a2 < a1 and the autocorrelations, is checked against the difference of the
+    uvw of antennas a2 and a1.
+
+    :param uvw: :math:`(u,v,w)` of baselines [ntimes, nants, nants, 3]
+    :return: :math:`(u,v,w)` of antennas [ntimes, nants, 3], and a boolean array [ntimes, nants, nants] that is
+        True for the baselines whose uvw are not the differences of those of the antennas
+    """
+    ant_uvw = uvw[:, :, 0, :]
+    residual = ant_uvw[:, :, numpy.newaxis, :] - ant_uvw[:, numpy.newaxis, :, :] - uvw
+    tolerance = 1e-9 * numpy.max(numpy.abs(uvw), initial=0.0)
+    return ant_uvw, numpy.max(numpy.abs(residual), axis=-1, initial=0.0) > tolerance
+
+
 def visibility_shift(uvw, vis, dl, dm):
     """
     Shift visibilities by the given image-space distance. This is
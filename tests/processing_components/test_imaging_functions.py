@@ -12,8 +12,11 @@ from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 
-from processing_components.imaging.base import create_image_from_visibility
+from processing_components.imaging.base import create_image_from_visibility, advise_wide_field, \
+    advise_wstack_wprojection
 from processing_components.imaging.weighting import weight_visibility
+from processing_library.fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from processing_library.imaging.imaging_params import w_kernel_stack, energy_kernel_support
 from processing_components.simulation.testing_support import create_named_configuration, ingest_unittest_visibility, create_unittest_model
 
 log = logging.getLogger(__name__)
@@ -82,6 +85,30 @@ class TestImagingFunctions(unittest.TestCase):
         im = create_image_from_visibility(self.vis, frequency=self.frequency, npixel=128,
                                           nchan=1)
         assert im.data.shape == (1, 1, 128, 128)
+    
+    def test_advise_wstack_wprojection(self):
+        self.actualSetUp(dospectral=False)
+        advice = advise_wide_field(self.vis, guard_band_image=3.0, delA=0.02)
+        hybrid = advise_wstack_wprojection(advice, npixel=self.npixel, cellsize=0.001)
+        assert 1 <= hybrid['vis_slices'] <= advice['vis_slices']
+        assert hybrid['kernelwidth'] >= 8 and hybrid['kernelwidth'] % 2 == 0
+        # Reusing the w kernels many times makes w projection relatively cheaper
+        reused = advise_wstack_wprojection(advice, npixel=self.npixel, cellsize=0.001, kernel_reuse=1000)
+        assert reused['vis_slices'] <= hybrid['vis_slices']
+        assert reused['wstep'] > 0.0
+    
+    def test_advise_wstack_wprojection_kernelwidth(self):
+        self.actualSetUp(dospectral=False)
+        advice = advise_wide_field(self.vis, guard_band_image=3.0, delA=0.02)
+        hybrid = advise_wstack_wprojection(advice, npixel=self.npixel, cellsize=0.001, kernel_reuse=1000)
+        assert hybrid['wstep'] > 0.0
+        # The w kernel at the edge of a stack must fit within the advised kernel width
+        half_width = numpy.max(numpy.abs(advice['svis'].w)) / max(hybrid['vis_slices'] - 1, 1)
+        padded_npixel = 2 * self.npixel
+        gcf, _ = anti_aliasing_calculate((padded_npixel, padded_npixel))
+        kernel = w_kernel_stack(padded_npixel, 0.001, [half_width], gcf, oversampling=2, kernelwidth=64)[0]
+        assert hybrid['kernelwidth'] >= energy_kernel_support(kernel, 1e-3), \
+            "Kernel width %d is too small for w %.1f" % (hybrid['kernelwidth'], half_width)
 
 
 if __name__ == '__main__':
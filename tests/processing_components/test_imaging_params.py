@@ -11,11 +11,16 @@ from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 
-from processing_library.imaging.imaging_params import get_frequency_map, w_kernel_list
+from processing_library.fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from processing_library.image.operations import create_w_term_like, pad_image, fft_image, convert_image_to_kernel
+from processing_library.imaging.imaging_params import get_frequency_map, w_kernel_list, w_kernel_stack, \
+    get_kernel_list, get_padding, get_precision_dtypes
 
 from processing_components.simulation.testing_support import create_named_configuration, create_low_test_image_from_gleam
-from processing_components.visibility.base import create_visibility
-from processing_components.imaging.base import create_image_from_visibility
+from processing_components.visibility.base import create_visibility, copy_visibility, create_blockvisibility
+from processing_components.imaging.base import create_image_from_visibility, create_gridding_plan, invert_2d, \
+    predict_2d, invert_2d_dirty_psf, residual_2d, residual_image, shift_vis_to_image, predict_2d_blockvisibility, \
+    invert_2d_blockvisibility
 from processing_components.image.operations import export_image_to_fits, create_image_from_array
 
 log = logging.getLogger(__name__)
@@ -93,6 +98,133 @@ class TestImagingParams(unittest.TestCase):
                                                     wstep=50, oversampling=3,
                                                     maxsupport=128)
 
+    def test_w_kernel_stack(self):
+        oversampling = 4
+        kernelwidth = 16
+        model = create_image_from_visibility(self.vis, npixel=128, cellsize=0.001, nchan=1,
+                                             frequency=self.startfrequency)
+        im = pad_image(model, [1, 1, 256, 256])
+        gcf, _ = anti_aliasing_calculate((256, 256))
+        w_values = numpy.array([-100.0, 0.0, 37.0])
+        cellsize = abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+        wcentre = [im.wcs.wcs.crpix[0] - 1.0, im.wcs.wcs.crpix[1] - 1.0]
+        for nthreads in [1, 2]:
+            kernels = w_kernel_stack(256, cellsize, w_values, gcf, oversampling=oversampling,
+                                     kernelwidth=kernelwidth, wcentre=wcentre, remove_shift=True, nthreads=nthreads)
+            for w, kernel in zip(w_values, kernels):
+                wscreen = create_w_term_like(im, w, self.phasecentre, remove_shift=True)
+                wscreen.data /= gcf
+                wconv = fft_image(pad_image(wscreen, [1, 1, 256 * oversampling, 256 * oversampling]))
+                wconv.data *= float(oversampling) ** 2
+                expected = convert_image_to_kernel(wconv, oversampling, kernelwidth).data[0, 0, ...]
+                numpy.testing.assert_allclose(kernel, expected, atol=1e-12 * numpy.max(numpy.abs(expected)))
+
+    def test_gridding_plan(self):
+        plan = create_gridding_plan(self.vis, self.model)
+        assert len(plan.coordinates[0]) == self.vis.nvis
+        dirty, sumwt = invert_2d(self.vis, self.model, dopsf=True)
+        dirty_plan, sumwt_plan = invert_2d(self.vis, self.model, dopsf=True, gridding_plan=plan)
+        numpy.testing.assert_array_almost_equal(dirty.data, dirty_plan.data, 12)
+        numpy.testing.assert_array_almost_equal(sumwt, sumwt_plan, 12)
+        self.model.data[:, 0, 64, 64] = 1.0
+        vis = predict_2d(copy_visibility(self.vis), self.model)
+        vis_plan = predict_2d(copy_visibility(self.vis), self.model, gridding_plan=plan)
+        numpy.testing.assert_array_almost_equal(vis.vis, vis_plan.vis, 12)
+
+    def test_gridding_plan_mismatch(self):
+        plan = create_gridding_plan(self.vis, self.model, oversampling=4)
+        dirty, _ = invert_2d(self.vis, self.model, dopsf=True)
+        dirty_plan, _ = invert_2d(self.vis, self.model, dopsf=True, gridding_plan=plan)
+        numpy.testing.assert_array_almost_equal(dirty.data, dirty_plan.data, 12)
+
+    def test_real_fft(self):
+        self.model.data[:, 0, 64, 64] = 1.0
+        self.model.data[:, 0, 40, 90] = 0.5
+        for kernel in ['2d', 'es']:
+            plan = create_gridding_plan(self.vis, self.model, kernel=kernel, real_fft=True)
+            assert plan.hermitian is not None
+            dirty, sumwt = invert_2d(self.vis, self.model, kernel=kernel)
+            dirty_real, sumwt_real = invert_2d(self.vis, self.model, kernel=kernel, real_fft=True, gridding_plan=plan)
+            numpy.testing.assert_array_almost_equal(dirty.data, dirty_real.data, 12)
+            numpy.testing.assert_array_almost_equal(sumwt, sumwt_real, 12)
+            vis = predict_2d(copy_visibility(self.vis), self.model, kernel=kernel)
+            vis_real = predict_2d(copy_visibility(self.vis), self.model, kernel=kernel, real_fft=True,
+                                  gridding_plan=plan)
+            numpy.testing.assert_array_almost_equal(vis.vis, vis_real.vis, 12)
+
+    def test_invert_2d_dirty_psf(self):
+        self.model.data[:, 0, 64, 64] = 1.0
+        vis = predict_2d(copy_visibility(self.vis), self.model)
+        for kwargs in [{}, {'real_fft': True}]:
+            (dirty, sumwt), (psf, psf_sumwt) = invert_2d_dirty_psf(vis, self.model, **kwargs)
+            dirty_separate, sumwt_separate = invert_2d(vis, self.model, **kwargs)
+            psf_separate, psf_sumwt_separate = invert_2d(vis, self.model, dopsf=True, **kwargs)
+            numpy.testing.assert_array_almost_equal(dirty.data, dirty_separate.data, 12)
+            numpy.testing.assert_array_almost_equal(sumwt, sumwt_separate, 12)
+            numpy.testing.assert_array_almost_equal(psf.data, psf_separate.data, 12)
+            numpy.testing.assert_array_almost_equal(psf_sumwt, psf_sumwt_separate, 12)
+
+    def test_invert_2d_shift(self):
+        self.model.data[:, 0, 64, 64] = 1.0
+        vis = predict_2d(copy_visibility(self.vis), self.model)
+        self.model.wcs.wcs.crval[0] += 1.0
+        original = copy_visibility(vis)
+        dirty, sumwt = invert_2d(vis, self.model, gridding_block_size=1000)
+        numpy.testing.assert_array_equal(vis.data, original.data)
+        assert vis.phasecentre.separation(original.phasecentre).rad == 0.0
+        svis = shift_vis_to_image(copy_visibility(vis), self.model)
+        dirty_shifted, sumwt_shifted = invert_2d(svis, self.model)
+        numpy.testing.assert_array_almost_equal(dirty.data, dirty_shifted.data, 12)
+        numpy.testing.assert_array_almost_equal(sumwt, sumwt_shifted, 12)
+
+    def test_residual_2d(self):
+        self.model.data[:, 0, 64, 64] = 1.0
+        vis = predict_2d(copy_visibility(self.vis), self.model)
+        self.model.data[:, 0, 64, 64] = 0.9
+        for kwargs in [{}, {'real_fft': True}, {'gridding_block_size': 1000}]:
+            _, residual, sumwt = residual_image(vis, self.model, **kwargs)
+            residual_fused, sumwt_fused = residual_2d(vis, self.model, **kwargs)
+            numpy.testing.assert_array_almost_equal(residual.data, residual_fused.data, 12)
+            numpy.testing.assert_array_almost_equal(sumwt, sumwt_fused, 12)
+
+    def test_blockvisibility(self):
+        blockvis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                          weight=1.0, polarisation_frame=PolarisationFrame('stokesI'),
+                                          channel_bandwidth=self.channel_bandwidth)
+        self.model.data[:, 0, 64, 64] = 1.0
+        self.model.data[:, 0, 40, 90] = 0.5
+        predicted = predict_2d(copy_visibility(blockvis), self.model)
+        predicted_block = predict_2d_blockvisibility(copy_visibility(blockvis), self.model, gridding_block_size=1000)
+        antenna2, antenna1 = numpy.tril_indices(blockvis.nants, -1)
+        numpy.testing.assert_array_almost_equal(predicted.vis[:, antenna2, antenna1],
+                                                predicted_block.vis[:, antenna2, antenna1], 12)
+        for dopsf in [False, True]:
+            dirty, sumwt = invert_2d(predicted_block, self.model, dopsf=dopsf)
+            dirty_block, sumwt_block = invert_2d_blockvisibility(predicted_block, self.model, dopsf=dopsf,
+                                                                 gridding_block_size=1000)
+            numpy.testing.assert_array_almost_equal(dirty.data, dirty_block.data, 12)
+            numpy.testing.assert_array_almost_equal(sumwt, sumwt_block, 12)
+
+    def test_get_precision_dtypes(self):
+        assert get_precision_dtypes() == ('complex', 'float')
+        assert get_precision_dtypes(precision='single') == ('complex64', 'float32')
+        blockvis = create_blockvisibility(self.lowcore, self.times, self.frequency, phasecentre=self.phasecentre,
+                                          weight=1.0, polarisation_frame=PolarisationFrame('stokesI'),
+                                          channel_bandwidth=self.channel_bandwidth, precision='single')
+        assert blockvis.vis.dtype.itemsize == numpy.dtype(numpy.complex64).itemsize
+
+    def test_get_kernel_list_es(self):
+        kernelname, gcf, kernel_list = get_kernel_list(self.vis, self.model, kernel='es', kernel_accuracy=1e-6)
+        assert kernelname == 'es'
+        padding = get_padding(kernel='es', kernel_accuracy=1e-6)
+        assert gcf.shape == (int(round(padding * 128)), int(round(padding * 128)))
+        assert kernel_list[1][0].support == 8
+        # The plan picks up the padding chosen for the accuracy
+        plan = create_gridding_plan(self.vis, self.model, kernel='es')
+        assert plan.padding == padding
+        dirty, sumwt = invert_2d(self.vis, self.model, dopsf=True, kernel='es')
+        self.assertAlmostEqual(numpy.max(dirty.data[0]), 1.0, 6)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -21,7 +21,7 @@ from processing_components.visibility.coalesce import convert_blockvisibility_to
 from processing_components.visibility.operations import append_visibility, qa_visibility, \
     sum_visibility, subtract_visibility
 from processing_components.visibility.base import copy_visibility, create_visibility, create_blockvisibility, create_visibility_from_rows,\
-    phaserotate_visibility
+    phaserotate_visibility, phaserotate_blockvisibility
 
 
 class TestVisibilityOperations(unittest.TestCase):
@@ -168,6 +168,30 @@ class TestVisibilityOperations(unittest.TestCase):
         assert_allclose(rotatedvis.vis, vismodel2.vis, rtol=1e-7)
         assert_allclose(rotatedvis.uvw, vismodel2.uvw, rtol=1e-7)
 
+    def test_phase_rotation_block(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre, weight=1.0,
+                                          polarisation_frame=PolarisationFrame("stokesIQUV"))
+        self.vismodel = predict_skycomponent_visibility(self.vis, self.comp)
+        # Predict visibilities with new phase centre independently
+        ha_diff = -(self.compabsdirection.ra - self.phasecentre.ra).to(u.rad).value
+        vispred = create_blockvisibility(self.lowcore, self.times + ha_diff, self.frequency,
+                                         channel_bandwidth=self.channel_bandwidth,
+                                         phasecentre=self.compabsdirection, weight=1.0,
+                                         polarisation_frame=PolarisationFrame("stokesIQUV"))
+        vismodel2 = predict_skycomponent_visibility(vispred, self.comp)
+        
+        # Should yield the same results as rotation
+        rotatedvis = phaserotate_blockvisibility(self.vismodel, newphasecentre=self.compabsdirection, tangent=False)
+        assert_allclose(rotatedvis.vis, vismodel2.vis, rtol=1e-7)
+        assert_allclose(rotatedvis.uvw, vismodel2.uvw, rtol=1e-7)
+        
+        # Phase rotating back should not make a difference
+        rotatedvis = phaserotate_blockvisibility(rotatedvis, self.phasecentre, tangent=False)
+        assert_allclose(rotatedvis.uvw, self.vismodel.uvw, rtol=1e-7)
+        assert_allclose(rotatedvis.vis, self.vismodel.vis, rtol=1e-7)
+    
     def test_phase_rotation_inverse(self):
         self.vis = create_visibility(self.lowcore, self.times, self.frequency,
                                      channel_bandwidth=self.channel_bandwidth,
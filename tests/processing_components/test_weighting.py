@@ -86,6 +86,15 @@ class TestWeighting(unittest.TestCase):
         assert density is None
         assert densitygrid is None
 
+    def test_weighting_briggs(self):
+        self.actualSetUp()
+        for weighting in ['super-uniform', 'briggs', 'super-briggs']:
+            vis, density, densitygrid = weight_visibility(self.componentvis, self.model, weighting=weighting,
+                                                          robustness=0.5, super_uniform_box=5)
+            assert len(density) == vis.nvis
+            assert numpy.std(vis.imaging_weight) > 0.0
+            assert densitygrid.data.shape == self.model.data.shape
+
     def test_tapering_Gaussian(self):
         self.actualSetUp()
         size_required = 0.01
@@ -7,7 +7,7 @@ import numpy
 import logging
 
 from processing_library.util.array_functions import average_chunks_jit as average_chunks
-from processing_library.util.array_functions import average_chunks2, average_chunks_jit
+from processing_library.util.array_functions import average_chunks2, average_chunks_jit, tukey_filter
 
 log = logging.getLogger(__name__)
 
@@ -90,5 +90,11 @@ class TestArray_functions(unittest.TestCase):
         numpy.testing.assert_array_equal(cwts, cwts_jit)
 
 
+    def test_tukey_filter_array(self):
+        x = numpy.linspace(-0.2, 1.2, 141)
+        for r in [0.1, 0.5, 1.0]:
+            numpy.testing.assert_array_almost_equal(tukey_filter(x, r), [tukey_filter(xx, r) for xx in x], 15)
+
+
 if __name__ == '__main__':
     unittest.main()
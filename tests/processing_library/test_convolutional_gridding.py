@@ -3,14 +3,18 @@
 
 """
 import random
+import tracemalloc
 import unittest
 
 import numpy
 from numpy.testing import assert_allclose
 
 from processing_library.fourier_transforms.convolutional_gridding import w_beam, coordinates, \
-    coordinates2, coordinateBounds, anti_aliasing_calculate, \
-    convolutional_degrid, convolutional_grid
+    coordinates2, coordinateBounds, anti_aliasing_calculate, anti_aliasing_calculate_separable, \
+    convolutional_degrid, convolutional_grid, convolutional_grid_vectorised, convolutional_degrid_vectorised, \
+    convolutional_grid_coordinates, convolutional_grid_sort, weight_gridding, density_gridding, \
+    anti_aliasing_calculate_es, es_kernel_parameters, convolutional_grid_coordinates_hermitian
+from processing_library.fourier_transforms.fft_support import fft, ifft, ifft_hermitian, hermitian_half_width
 
 
 class TestConvolutionalGridding(unittest.TestCase):
@@ -43,6 +47,26 @@ class TestConvolutionalGridding(unittest.TestCase):
             _, aaf = anti_aliasing_calculate(shape, 8)
             self.assertAlmostEqual(numpy.max(aaf[..., aaf.shape[1] // 2, aaf.shape[0] // 2]), 0.18712109669890534)
 
+    def test_anti_aliasing_calculate_separable(self):
+        gcf, aaf = anti_aliasing_calculate((64, 64), 8)
+        sgcf, saaf = anti_aliasing_calculate_separable((64, 64), 8)
+        assert saaf.shape == (8, 8)
+        assert_allclose(sgcf, gcf)
+        for yf in range(8):
+            for xf in range(8):
+                assert_allclose(numpy.outer(saaf[yf], saaf[xf]), aaf[yf, xf], atol=1e-15)
+
+    def test_anti_aliasing_calculate_es(self):
+        for accuracy in [1e-3, 1e-6, 1e-9]:
+            support, beta, upsampling = es_kernel_parameters(accuracy)
+            assert support % 2 == 0 and 1.0 < upsampling <= 2.0
+            gcf, kernel = anti_aliasing_calculate_es((192, 256), accuracy, upsampling)
+            assert gcf.shape == (192, 256)
+            self.assertAlmostEqual(gcf[96, 128], 1.0, 7)
+            # The taps of any sample sum to unity
+            taps = kernel.evaluate(numpy.linspace(0.0, 1.0, 11, endpoint=False))
+            assert_allclose(numpy.sum(taps, axis=1), 1.0, rtol=accuracy)
+
     def test_w_kernel_beam(self):
         assert_allclose(numpy.real(w_beam(5, 0.1, 0))[0, 0], 1.0)
         self.assertAlmostEqualScalar(w_beam(5, 0.1, 100)[2, 2], 1)
@@ -73,6 +97,290 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert uvgrid.shape[2] == npixel
         assert uvgrid.shape[3] == npixel
 
+    @staticmethod
+    def _grid_data(npixel, nvis, nchan, npol):
+        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        vis = numpy.random.normal(size=[nvis, npol]) + 1j * numpy.random.normal(size=[nvis, npol])
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        frequencymap = numpy.random.randint(0, nchan, [nvis])
+        return uvcoords, vis, visweights, frequencymap
+
+    def test_convolutional_grid_vectorised(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        vuvgrid, vsumwt = convolutional_grid_vectorised(kernels,
+                                                        numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                                        vis, visweights, uvcoords, frequencymap, block_size=999)
+        assert_allclose(vsumwt, sumwt)
+        assert_allclose(vuvgrid, uvgrid, atol=1e-12)
+
+    def test_convolutional_grid_vectorised_sparse(self):
+        # A few visibilities over a large grid, so the taps of a block are sparse in the grid
+        npixel = 1024
+        nvis = 500
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        vuvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
+        tracemalloc.start()
+        vuvgrid, vsumwt = convolutional_grid_vectorised(kernels, vuvgrid, vis, visweights, uvcoords, frequencymap)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        assert_allclose(vsumwt, sumwt)
+        assert_allclose(vuvgrid, uvgrid, atol=1e-12)
+        # The memory used depends on the number of visibilities, not on the size of the grid
+        assert peak < vuvgrid.nbytes / 16, "Peak memory %d bytes for grid of %d bytes" % (peak, vuvgrid.nbytes)
+
+    def test_convolutional_grid_vectorised_wkernels(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 1
+        npol = 1
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        kernels = (numpy.random.randint(0, 3, [nvis]), [kernel, (1.0 + 1.0j) * kernel, numpy.conjugate(kernel)])
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        vuvgrid, vsumwt = convolutional_grid_vectorised(kernels,
+                                                        numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                                        vis, visweights, uvcoords, frequencymap)
+        assert_allclose(vsumwt, sumwt)
+        assert_allclose(vuvgrid, uvgrid, atol=1e-12)
+
+    def test_convolutional_grid_vectorised_mixed_support(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 1
+        npol = 2
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        # The same kernel padded with zeros to a larger support
+        wide_kernel = numpy.pad(kernel, [(0, 0), (0, 0), (2, 2), (2, 2)], mode='constant')
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        kernel_indices = numpy.random.randint(0, 3, [nvis])
+        mixed = (kernel_indices, [kernel, (1.0 + 1.0j) * wide_kernel, (1.0 - 1.0j) * kernel])
+        fixed = (kernel_indices, [wide_kernel, (1.0 + 1.0j) * wide_kernel, (1.0 - 1.0j) * wide_kernel])
+        shape = [nchan, npol, npixel, npixel]
+        uvgrid, sumwt = convolutional_grid_vectorised(fixed, numpy.zeros(shape, dtype='complex'),
+                                                      vis, visweights, uvcoords, frequencymap)
+        luvgrid, lsumwt = convolutional_grid(mixed, numpy.zeros(shape, dtype='complex'),
+                                             vis, visweights, uvcoords, frequencymap)
+        assert_allclose(lsumwt, sumwt)
+        assert_allclose(luvgrid, uvgrid, atol=1e-12)
+        for nthreads in [1, 3]:
+            muvgrid, msumwt = convolutional_grid_vectorised(mixed, numpy.zeros(shape, dtype='complex'),
+                                                            vis, visweights, uvcoords, frequencymap,
+                                                            nthreads=nthreads)
+            assert_allclose(msumwt, sumwt)
+            assert_allclose(muvgrid, uvgrid, atol=1e-12)
+        dvis = convolutional_degrid_vectorised(fixed, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        mvis = convolutional_degrid_vectorised(mixed, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        assert_allclose(mvis, dvis, atol=1e-12)
+        lvis = convolutional_degrid(mixed, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        assert_allclose(lvis, dvis, atol=1e-12)
+
+    def test_convolutional_grid_threaded(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        _, skernel = anti_aliasing_calculate_separable((npixel, npixel), 8)
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        kernels = (numpy.zeros([nvis], dtype='int'), [skernel])
+        uvgrid, sumwt = convolutional_grid_vectorised(kernels,
+                                                      numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                                      vis, visweights, uvcoords, frequencymap)
+        for nthreads in [2, 3, 8]:
+            tuvgrid, tsumwt = convolutional_grid_vectorised(kernels,
+                                                            numpy.zeros([nchan, npol, npixel, npixel],
+                                                                        dtype='complex'),
+                                                            vis, visweights, uvcoords, frequencymap,
+                                                            nthreads=nthreads, block_size=999)
+            assert_allclose(tsumwt, sumwt)
+            assert_allclose(tuvgrid, uvgrid, atol=1e-12)
+
+    def test_convolutional_grid_separable(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        _, skernel = anti_aliasing_calculate_separable((npixel, npixel), 8)
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        uvgrid, sumwt = convolutional_grid((numpy.zeros([nvis], dtype='int'), [kernel]),
+                                           numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                           vis, visweights, uvcoords, frequencymap)
+        suvgrid, ssumwt = convolutional_grid_vectorised((numpy.zeros([nvis], dtype='int'), [skernel]),
+                                                        numpy.zeros([nchan, npol, npixel, npixel], dtype='complex'),
+                                                        vis, visweights, uvcoords, frequencymap)
+        assert_allclose(ssumwt, sumwt)
+        assert_allclose(suvgrid, uvgrid, atol=1e-12)
+        svis = convolutional_degrid_vectorised((numpy.zeros([nvis], dtype='int'), [skernel]), [nvis, npol],
+                                               uvgrid, uvcoords, frequencymap)
+        dvis = convolutional_degrid((numpy.zeros([nvis], dtype='int'), [kernel]), [nvis, npol],
+                                    uvgrid, uvcoords, frequencymap)
+        assert_allclose(svis, dvis, atol=1e-12)
+
+    def test_convolutional_grid_es(self):
+        npixel = 256
+        nvis = 1000
+        nchan = 2
+        npol = 2
+        gcf, kernel = anti_aliasing_calculate_es((npixel, npixel), 1e-6, 2.0)
+        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        uvgrid, sumwt = convolutional_grid_vectorised(kernels, numpy.zeros([nchan, npol, npixel, npixel],
+                                                                           dtype='complex'),
+                                                      vis, visweights, uvcoords, frequencymap, block_size=99)
+        # Grid directly by evaluating the kernel at every tap
+        duvgrid = numpy.zeros_like(uvgrid)
+        taps = numpy.arange(kernel.support) - kernel.support // 2 + 1
+        for ivis in range(nvis):
+            y = npixel // 2 + uvcoords[ivis, 1] * npixel
+            x = npixel // 2 + uvcoords[ivis, 0] * npixel
+            ky = kernel((numpy.floor(y) + taps - y) / (0.5 * kernel.support))
+            kx = kernel((numpy.floor(x) + taps - x) / (0.5 * kernel.support))
+            ys = slice(int(numpy.floor(y)) + taps[0], int(numpy.floor(y)) + taps[-1] + 1)
+            xs = slice(int(numpy.floor(x)) + taps[0], int(numpy.floor(x)) + taps[-1] + 1)
+            for pol in range(npol):
+                duvgrid[frequencymap[ivis], pol, ys, xs] += numpy.outer(ky, kx) * vis[ivis, pol] * \
+                                                             visweights[ivis, pol]
+        assert_allclose(uvgrid, duvgrid, atol=1e-12)
+        # Degridding is the adjoint of gridding
+        uvgrid = numpy.random.normal(size=uvgrid.shape) + 1j * numpy.random.normal(size=uvgrid.shape)
+        dvis = convolutional_degrid_vectorised(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        assert_allclose(numpy.vdot(uvgrid, duvgrid), numpy.vdot(dvis, vis * visweights), rtol=1e-10)
+
+    def test_convolutional_grid_hermitian(self):
+        npixel = 256
+        nvis = 1000
+        nchan = 2
+        npol = 2
+        for gcf, kernel in [anti_aliasing_calculate((npixel, npixel), 8), anti_aliasing_calculate_es((npixel, npixel))]:
+            kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
+            uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+            shape = [nchan, npol, npixel, npixel]
+            uvgrid, sumwt = convolutional_grid_vectorised(kernels, numpy.zeros(shape, dtype='complex'), vis,
+                                                          visweights, uvcoords, frequencymap)
+            coords, mirrored, x0 = convolutional_grid_coordinates_hermitian(kernels, shape, uvcoords, frequencymap)
+            assert (mirrored == (uvcoords[:, 0] < 0.0)).all()
+            hvis = numpy.where(mirrored[:, numpy.newaxis], numpy.conjugate(vis), vis)
+            halfshape = shape[:3] + [hermitian_half_width(npixel, x0)]
+            halfgrid, halfsumwt = convolutional_grid_vectorised(kernels, numpy.zeros(halfshape, dtype='complex'),
+                                                                hvis, visweights, None, frequencymap,
+                                                                coordinates=coords)
+            assert_allclose(sumwt, halfsumwt)
+            # The real image is the same
+            assert_allclose(ifft_hermitian(halfgrid, npixel), numpy.real(ifft(uvgrid)), atol=1e-12)
+            # Degridding the half grid of a real image gives the conjugates of the mirrored visibilities
+            image = numpy.random.random(shape)
+            grid = fft(image.astype('complex'))
+            dvis = convolutional_degrid_vectorised(kernels, [nvis, npol], grid, uvcoords, frequencymap)
+            hgrid = numpy.concatenate([grid[..., x0:], grid[..., 0:1]], axis=-1)
+            hdvis = convolutional_degrid_vectorised(kernels, [nvis, npol], hgrid, None, frequencymap,
+                                                    coordinates=coords)
+            hdvis[mirrored] = numpy.conjugate(hdvis[mirrored])
+            assert_allclose(hdvis, dvis, atol=1e-10)
+
+    def test_convolutional_degrid_es_accuracy(self):
+        npixel = 256
+        nvis = 1000
+        uvcoords, _, _, frequencymap = self._grid_data(npixel, nvis, 1, 1)
+        frequencymap[...] = 0
+        # A point source in the inner half of the grid, as for the default padding of 2
+        dy, dx = 37, -51
+        model = numpy.zeros([1, 1, npixel, npixel])
+        model[0, 0, npixel // 2 + dy, npixel // 2 + dx] = 1.0
+        expected = numpy.exp(-2j * numpy.pi * (uvcoords[:, 1] * dy + uvcoords[:, 0] * dx))
+        for accuracy in [1e-3, 1e-6, 1e-9]:
+            gcf, kernel = anti_aliasing_calculate_es((npixel, npixel), accuracy, 2.0)
+            uvgrid = fft((model * gcf).astype('complex'))
+            vis = convolutional_degrid_vectorised((numpy.zeros([nvis], dtype='int'), [kernel]), [nvis, 1], uvgrid,
+                                                  uvcoords, frequencymap)
+            assert numpy.max(numpy.abs(vis[:, 0] - expected)) < 10.0 * accuracy
+
+    def test_convolutional_grid_sort(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        _, skernel = anti_aliasing_calculate_separable((npixel, npixel), 8)
+        uvcoords, vis, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        kernels = (numpy.zeros([nvis], dtype='int'), [skernel])
+        shape = [nchan, npol, npixel, npixel]
+        chan, kind, y, yf, x, xf = convolutional_grid_coordinates(kernels, shape, uvcoords, frequencymap)
+        order = convolutional_grid_sort(shape, chan, y, x, kind, tile_size=16)
+        assert numpy.all(numpy.sort(order) == numpy.arange(nvis))
+        tile = (chan[order] * 1000 + y[order] // 16) * 1000 + x[order] // 16
+        assert numpy.all(numpy.diff(tile) >= 0)
+        uvgrid, sumwt = convolutional_grid_vectorised(kernels, numpy.zeros(shape, dtype='complex'),
+                                                      vis, visweights, uvcoords, frequencymap)
+        for nthreads in [1, 3]:
+            suvgrid, ssumwt = convolutional_grid_vectorised(kernels, numpy.zeros(shape, dtype='complex'),
+                                                            vis, visweights, uvcoords, frequencymap,
+                                                            nthreads=nthreads, order=order)
+            assert_allclose(ssumwt, sumwt)
+            assert_allclose(suvgrid, uvgrid, atol=1e-12)
+        dvis = convolutional_degrid_vectorised(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        svis = convolutional_degrid_vectorised(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap,
+                                               order=order, block_size=999)
+        assert_allclose(svis, dvis, atol=1e-12)
+
+    def test_weight_gridding(self):
+        npixel = 64
+        nvis = 10000
+        nchan = 2
+        npol = 2
+        uvcoords, _, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        shape = [nchan, npol, npixel, npixel]
+        natural, density, densitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='natural')
+        assert density is None and densitygrid is None
+        uniform, density, densitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap)
+        assert_allclose(numpy.sum(densitygrid), 2.0 * numpy.sum(visweights))
+        assert_allclose(uniform * density, visweights)
+        superuniform, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='super-uniform',
+                                             super_uniform_box=1, presort=True)
+        assert_allclose(superuniform, uniform)
+        superuniform, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='super-uniform')
+        assert numpy.all(superuniform <= uniform)
+        # Briggs weighting tends to uniform and natural weighting at the extremes of robustness
+        for robustness, expected in [(-5.0, uniform), (5.0, natural)]:
+            briggs, _, _ = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='briggs',
+                                           robustness=robustness)
+            for chan in range(nchan):
+                for pol in range(npol):
+                    rows = frequencymap == chan
+                    ratio = briggs[rows, pol] / expected[rows, pol]
+                    assert_allclose(ratio, ratio[0], rtol=1e-6)
+
+    def test_weight_gridding_partitioned(self):
+        npixel = 64
+        nvis = 10000
+        nchan = 2
+        npol = 2
+        uvcoords, _, visweights, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        shape = [nchan, npol, npixel, npixel]
+        briggs, _, densitygrid = weight_gridding(shape, visweights, uvcoords, frequencymap, weighting='briggs')
+        parts = [slice(0, nvis // 3), slice(nvis // 3, nvis)]
+        partdensitygrid = numpy.zeros(shape)
+        for part in parts:
+            partdensitygrid += density_gridding(shape, visweights[part], uvcoords[part], frequencymap[part])
+        assert_allclose(partdensitygrid, densitygrid)
+        for part in parts:
+            partbriggs, _, _ = weight_gridding(shape, visweights[part], uvcoords[part], frequencymap[part],
+                                               weighting='briggs', densitygrid=partdensitygrid)
+            assert_allclose(partbriggs, briggs[part])
+
     def test_convolutional_degrid(self):
         npixel = 256
         nvis = 100000
@@ -92,6 +400,22 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert vis.shape[0] == nvis
         assert vis.shape[1] == npol
 
+    def test_convolutional_degrid_vectorised(self):
+        npixel = 256
+        nvis = 10000
+        nchan = 2
+        npol = 4
+        uvgrid = numpy.random.normal(size=[nchan, npol, npixel, npixel]) + \
+                 1j * numpy.random.normal(size=[nchan, npol, npixel, npixel])
+        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
+        uvcoords, _, _, frequencymap = self._grid_data(npixel, nvis, nchan, npol)
+        vshape = [nvis, npol]
+        for kernels in [(numpy.zeros([nvis], dtype='int'), [kernel]),
+                        (numpy.random.randint(0, 2, [nvis]), [kernel, (1.0 - 1.0j) * kernel])]:
+            vis = convolutional_degrid(kernels, vshape, uvgrid, uvcoords, frequencymap)
+            vvis = convolutional_degrid_vectorised(kernels, vshape, uvgrid, uvcoords, frequencymap, block_size=999)
+            assert_allclose(vvis, vis, atol=1e-12)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -10,7 +10,7 @@ from astropy.coordinates import SkyCoord
 from numpy.testing import assert_allclose
 
 from processing_library.util.coordinate_support import xyz_to_uvw, xyz_at_latitude, simulate_point, baselines, uvw_to_xyz, \
-    skycoord_to_lmn
+    skycoord_to_lmn, simulate_point_block, skycoords_to_lmn
 
 
 class TestCoordinates(unittest.TestCase):
@@ -122,6 +122,28 @@ class TestCoordinates(unittest.TestCase):
         vis = simulate_point(bls, -0.5, -0.5)
         assert_allclose(vis, bl_even)
     
+    def test_simulate_point_block(self):
+        # Antenna differenced uvw of two times, and three frequencies
+        ants_uvw = numpy.random.RandomState(1).uniform(-1000.0, 1000.0, [2, 10, 3])
+        uvw = ants_uvw[:, :, numpy.newaxis, :] - ants_uvw[:, numpy.newaxis, :, :]
+        frequency = numpy.array([1e8, 1.1e8, 1.2e8])
+        scale = frequency / 299792458.0
+        vis = simulate_point(uvw[..., numpy.newaxis, :] * scale[:, numpy.newaxis], 0.01, -0.02)
+        assert_allclose(simulate_point_block(uvw, frequency, 0.01, -0.02), vis, atol=1e-10)
+        
+        # Baselines that are not antenna differences, in the lower triangle, the upper triangle and the diagonal
+        for baseline in [(1, 3, 2), (0, 2, 7), (1, 4, 4)]:
+            bad_uvw = uvw.copy()
+            bad_uvw[baseline] += 100.0
+            vis = simulate_point(bad_uvw[..., numpy.newaxis, :] * scale[:, numpy.newaxis], 0.01, -0.02)
+            assert_allclose(simulate_point_block(bad_uvw, frequency, 0.01, -0.02), vis, atol=1e-10)
+        
+        # Only the lower triangle filled, as by create_blockvisibility_from_ms
+        antenna1, antenna2 = numpy.triu_indices(10)
+        uvw[:, antenna1, antenna2, :] = 0.0
+        vis = simulate_point(uvw[..., numpy.newaxis, :] * scale[:, numpy.newaxis], 0.01, -0.02)
+        assert_allclose(simulate_point_block(uvw, frequency, 0.01, -0.02), vis, atol=1e-10)
+    
     def test_skycoord_to_lmn(self):
         center = SkyCoord(ra=0, dec=0, unit=u.deg)
         north = SkyCoord(ra=0, dec=90, unit=u.deg)
@@ -140,6 +162,15 @@ class TestCoordinates(unittest.TestCase):
         assert_allclose(skycoord_to_lmn(north, east), (0, 1, -1), atol=1e-14)
         assert_allclose(skycoord_to_lmn(south, east), (0, -1, -1), atol=1e-14)
     
+    def test_skycoords_to_lmn(self):
+        phasecentre = SkyCoord(17, 35, unit=u.deg)
+        directions = [SkyCoord(17.5, 35.2, unit=u.deg), SkyCoord(16.2, 34.1, unit=u.deg),
+                      SkyCoord(17.1, 35.3, unit=u.deg).transform_to(phasecentre.skyoffset_frame()),
+                      SkyCoord(18.0, 36.0, unit=u.deg, frame='fk5')]
+        l, m, n = skycoords_to_lmn(directions, phasecentre)
+        for i, direction in enumerate(directions):
+            assert_allclose([l[i], m[i], n[i]], skycoord_to_lmn(direction, phasecentre), atol=1e-12)
+    
     def test_phase_rotate(self):
         
         uvw = numpy.array([(1, 0, 0), (0, 1, 0), (0, 0, 1)])
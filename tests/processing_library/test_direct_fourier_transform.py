@@ -0,0 +1,69 @@
+""" Unit processing_library for direct Fourier transform
+
+
+"""
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from processing_library.fourier_transforms.direct_fourier_transform import dft_point_sources, \
+    dft_point_sources_block
+from processing_library.util.coordinate_support import simulate_point
+
+
+class TestDirectFourierTransform(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(180555)
+        self.nsources = 20
+        self.l = 0.02 * (numpy.random.random(self.nsources) - 0.5)
+        self.m = 0.02 * (numpy.random.random(self.nsources) - 0.5)
+        self.frequency = numpy.array([1e8, 1.1e8, 1.2e8])
+        self.flux = numpy.random.random([self.nsources, len(self.frequency), 2])
+        # Antenna differenced uvw of three times
+        ants_uvw = numpy.random.uniform(-1000.0, 1000.0, [3, 8, 3])
+        self.uvw = ants_uvw[:, :, numpy.newaxis, :] - ants_uvw[:, numpy.newaxis, :, :]
+        self.scale = self.frequency / 299792458.0
+
+    def reference(self, uvw):
+        # Sum of the point sources one at a time, for every time, baseline and channel
+        vis = numpy.zeros(list(uvw.shape[:-1]) + [len(self.frequency), 2], dtype='complex')
+        for i in range(self.nsources):
+            phasor = simulate_point(uvw[..., numpy.newaxis, :] * self.scale[:, numpy.newaxis], self.l[i], self.m[i])
+            vis += phasor[..., numpy.newaxis] * self.flux[i]
+        return vis
+
+    def test_dft_point_sources(self):
+        reference = self.reference(self.uvw).reshape([-1, 2])
+        uvw = (self.uvw[..., numpy.newaxis, :] * self.scale[:, numpy.newaxis]).reshape([-1, 3])
+        chan = numpy.tile(numpy.arange(len(self.frequency)), len(uvw) // len(self.frequency))
+        for block_size, nthreads in [(2 ** 20, 1), (50, 1), (50, 4)]:
+            vis = dft_point_sources(uvw, chan, self.flux, self.l, self.m, block_size=block_size, nthreads=nthreads)
+            assert_allclose(vis, reference, atol=1e-10)
+
+    def test_dft_point_sources_block(self):
+        reference = self.reference(self.uvw)
+        for block_size, nthreads in [(2 ** 20, 1), (50, 1), (50, 4)]:
+            vis = dft_point_sources_block(self.uvw, self.frequency, self.flux, self.l, self.m, block_size=block_size,
+                                          nthreads=nthreads)
+            assert_allclose(vis, reference, atol=1e-10)
+
+    def test_dft_point_sources_block_not_antenna_differenced(self):
+        # In the lower triangle, the upper triangle and the diagonal
+        for baseline in [(1, 3, 2), (0, 2, 6), (2, 4, 4)]:
+            uvw = self.uvw.copy()
+            uvw[baseline] += 100.0
+            vis = dft_point_sources_block(uvw, self.frequency, self.flux, self.l, self.m)
+            assert_allclose(vis, self.reference(uvw), atol=1e-10)
+    
+    def test_dft_point_sources_block_lower_triangle(self):
+        # Only the lower triangle filled, as by create_blockvisibility_from_ms
+        antenna1, antenna2 = numpy.triu_indices(8)
+        self.uvw[:, antenna1, antenna2, :] = 0.0
+        vis = dft_point_sources_block(self.uvw, self.frequency, self.flux, self.l, self.m, block_size=50, nthreads=2)
+        assert_allclose(vis, self.reference(self.uvw), atol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
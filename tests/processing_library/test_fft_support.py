@@ -7,8 +7,11 @@ import unittest
 
 from numpy.testing import assert_allclose
 
-from processing_library.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled
+from processing_library.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled, fft, ifft, \
+    extract_oversampled_kernels, pad_ifft_extract, fft_checkerboard, ifft_checkerboard, fft_hermitian, \
+    ifft_hermitian, hermitian_half_width, pad_fft, ifft_extract
 from processing_library.fourier_transforms.convolutional_gridding import coordinates2
+from processing_library.fourier_transforms.fft_backend import FFTBackend
 
 
 class TestFFTSupport(unittest.TestCase):
@@ -33,12 +36,132 @@ class TestFFTSupport(unittest.TestCase):
             # And extracting the middle should recover the original data_models
             assert_allclose(extract_mid(cs_pad, npixel), cs)
     
+    def test_extract_oversampled_kernels(self):
+        for npixel, kernel_oversampling, kernelwidth in [(64, 4, 8), (32, 1, 6), (64, 2, 10)]:
+            a = self._pattern(npixel)
+            kernels = extract_oversampled_kernels(a, kernel_oversampling, kernelwidth)
+            assert kernels.shape == (kernel_oversampling, kernel_oversampling, kernelwidth, kernelwidth)
+            for yf in range(kernel_oversampling):
+                for xf in range(kernel_oversampling):
+                    for i in range(kernelwidth):
+                        for j in range(kernelwidth):
+                            y = npixel // 2 + kernel_oversampling * (kernelwidth // 2 - i) + yf
+                            x = npixel // 2 + kernel_oversampling * (kernelwidth // 2 - j) + xf
+                            assert kernels[yf, xf, i, j] == a[y, x]
+
+    def test_pad_ifft_extract(self):
+        for npixel, N2, nextract in [(32, 128, 40), (64, 512, 64)]:
+            cs = 1 + self._pattern(npixel)
+            expected = extract_mid(ifft(pad_mid(cs, N2)), nextract)
+            assert_allclose(pad_ifft_extract(cs, N2, nextract), expected, atol=1e-12)
+            # Leading axes are not transformed
+            stack = numpy.array([cs, 2.0 * cs])
+            result = pad_ifft_extract(stack, N2, nextract)
+            assert_allclose(result[1], 2.0 * expected, atol=1e-12)
+
     def test_extract_oversampled(self):
         for npixel, kernel_oversampling in [(1, 2), (2, 3), (3, 2), (4, 2), (5, 3)]:
             a = 1 + self._pattern(npixel * kernel_oversampling)
             ex = extract_oversampled(a, 0, 0, kernel_oversampling, npixel) / kernel_oversampling ** 2
             assert_allclose(ex, 1 + self._pattern(npixel))
 
+    
+    def test_fft_single_precision(self):
+        a = 1 + self._pattern(128).reshape([1, 1, 128, 128])
+        for transform in [fft, ifft]:
+            single = transform(a.astype('complex64'))
+            assert single.dtype == numpy.complex64
+            double = transform(a)
+            assert double.dtype == numpy.complex128
+            assert_allclose(single, double, atol=1e-5 * numpy.max(numpy.abs(double)))
+
+    def test_fft_checkerboard(self):
+        for shape in [[64, 32], [2, 3, 64, 64], [1, 1, 65, 64]]:
+            a = numpy.random.random(shape) + 1j * numpy.random.random(shape)
+            original = a.copy()
+            a.flags.writeable = False
+            for transform, checkerboard_transform in [(fft, fft_checkerboard), (ifft, ifft_checkerboard)]:
+                expected = transform(a)
+                assert_allclose(checkerboard_transform(a), expected, atol=1e-12)
+                # The input is not written to unless it may be overwritten
+                assert (a == original).all()
+                assert_allclose(checkerboard_transform(a.real), transform(a.real), atol=1e-12)
+                assert_allclose(checkerboard_transform(a.copy(), overwrite=True), expected, atol=1e-12)
+                single = checkerboard_transform(a.astype('complex64'))
+                assert single.dtype == numpy.complex64
+                assert_allclose(single, expected, atol=1e-5 * numpy.max(numpy.abs(expected)))
+
+    def test_pad_fft(self):
+        image = numpy.random.random([2, 3, 32, 32])
+        expected = fft(pad_mid(image, 128).astype('complex'))
+        assert_allclose(pad_fft(image, 128), expected, atol=1e-12)
+        single = pad_fft(image.astype('float32'), 128)
+        assert single.dtype == numpy.complex64
+        assert_allclose(single, expected, atol=1e-5 * numpy.max(numpy.abs(expected)))
+
+    def test_ifft_extract(self):
+        grid = numpy.random.random([2, 3, 128, 128]) + 1j * numpy.random.random([2, 3, 128, 128])
+        original = grid.copy()
+        expected = extract_mid(ifft(grid), 32)
+        for block_size in [None, 7]:
+            assert_allclose(ifft_extract(grid, 32, block_size=block_size), expected, atol=1e-14)
+        assert (grid == original).all()
+        single = ifft_extract(grid.astype('complex64'), 32)
+        assert single.dtype == numpy.complex64
+        assert_allclose(single, expected, atol=1e-6)
+
+    def test_fft_hermitian(self):
+        ny, nx, x0 = 32, 64, 20
+        image = numpy.random.random([2, 1, ny, nx])
+        grid = fft(image.astype('complex'))
+        half = fft_hermitian(image, x0)
+        assert half.shape[-1] == hermitian_half_width(nx, x0)
+        # The last column of the half grid is column 0 of the full grid
+        assert_allclose(half[..., :-1], grid[..., x0:], atol=1e-12)
+        assert_allclose(half[..., -1], grid[..., 0], atol=1e-12)
+        single = fft_hermitian(image.astype('float32'), x0)
+        assert single.dtype == numpy.complex64
+        assert_allclose(single, half, atol=1e-5 * numpy.max(numpy.abs(half)))
+        # Padded
+        grid = fft(pad_mid(image, 128).astype('complex'))
+        half = fft_hermitian(image, x0, 128)
+        assert_allclose(half[..., :-1], grid[..., x0:], atol=1e-12)
+        assert_allclose(half[..., -1], grid[..., 0], atol=1e-12)
+
+    def test_ifft_hermitian(self):
+        ny, nx, x0 = 32, 64, 20
+        grid = numpy.zeros([2, 1, ny, nx], dtype='complex')
+        grid[..., x0:] = numpy.random.random([2, 1, ny, nx - x0]) + 1j * numpy.random.random([2, 1, ny, nx - x0])
+        grid[..., 0] = numpy.random.random([2, 1, ny])
+        half = numpy.zeros([2, 1, ny, hermitian_half_width(nx, x0)], dtype='complex')
+        half[..., :-1] = grid[..., x0:]
+        half[..., -1] = grid[..., 0]
+        assert_allclose(ifft_hermitian(half.astype('complex64'), nx), numpy.real(ifft(grid)), atol=1e-6)
+        image = ifft_hermitian(half.copy(), nx)
+        assert image.dtype == numpy.float64
+        assert_allclose(image, numpy.real(ifft(grid)), atol=1e-14)
+        assert_allclose(ifft_hermitian(half.copy(), nx, nextract=16, block_size=5),
+                        numpy.real(ifft(grid))[..., 8:24, 24:40], atol=1e-14)
+
+    def test_fft_backends(self):
+        a = 1 + self._pattern(64).reshape([1, 2, 32, 64])
+        for name in FFTBackend.available():
+            backend = FFTBackend(name, workers=2)
+            assert backend.name == name
+            assert_allclose(backend.fftn(a, axes=[2, 3]), numpy.fft.fftn(a, axes=[2, 3]), atol=1e-10)
+            assert_allclose(backend.ifftn(a, axes=[3]), numpy.fft.ifftn(a, axes=[3]), atol=1e-12)
+            single = backend.fftn(a.astype('complex64'))
+            assert single.dtype == numpy.complex64
+            assert_allclose(single, numpy.fft.fftn(a, axes=[-2, -1]), atol=1e-3)
+
+    def test_fft_backend_fallback(self):
+        backend = FFTBackend('auto')
+        assert backend.name == FFTBackend.available()[-1]
+        for name in ['scipy', 'pyfftw']:
+            backend.configure(name=name, workers=4)
+            assert backend.name == (name if name in FFTBackend.available() else 'numpy')
+            assert backend.workers == 4
+
 
 if __name__ == '__main__':
     unittest.main()
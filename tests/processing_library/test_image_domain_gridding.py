@@ -0,0 +1,74 @@
+""" Unit processing_library for image domain gridding
+
+
+"""
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from processing_library.fourier_transforms.convolutional_gridding import anti_aliasing_calculate
+from processing_library.fourier_transforms.fft_support import fft
+from processing_library.fourier_transforms.image_domain_gridding import idg_grid, idg_degrid, idg_subgrids, \
+    idg_w_layers
+
+
+class TestImageDomainGridding(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(180555)
+        self.npixel = 128
+        self.nvis = 500
+        self.field_of_view = 0.1
+        self.vuvwmap = numpy.zeros([self.nvis, 3])
+        self.vuvwmap[:, 0:2] = 0.4 * (numpy.random.random([self.nvis, 2]) - 0.5)
+        self.vfrequencymap = numpy.zeros([self.nvis], dtype='int')
+        self.w = 500.0 * (numpy.random.random(self.nvis) - 0.5)
+
+    def test_subgrids(self):
+        order, starts, corners, y, x = idg_subgrids([1, 1, self.npixel, self.npixel], self.vuvwmap,
+                                                    self.vfrequencymap, subgrid_size=32, support=8)
+        assert len(starts) == len(corners) + 1
+        assert sorted(order) == list(range(self.nvis))
+        # Every visibility is at least support//2 cells inside its subgrid
+        for isubgrid, (_, y0, x0) in enumerate(corners):
+            rows = order[starts[isubgrid]:starts[isubgrid + 1]]
+            assert (y[rows] >= y0 + 4).all() and (y[rows] < y0 + 28).all()
+            assert (x[rows] >= x0 + 4).all() and (x[rows] < x0 + 28).all()
+
+    def test_grid_degrid_adjoint(self):
+        vis = numpy.random.random([self.nvis, 1]) + 1j * numpy.random.random([self.nvis, 1])
+        uvgrid = numpy.random.random([1, 1, self.npixel, self.npixel]) + \
+                 1j * numpy.random.random([1, 1, self.npixel, self.npixel])
+        gridded, sumwt = idg_grid(numpy.zeros_like(uvgrid), vis, numpy.ones([self.nvis, 1]), self.vuvwmap,
+                                  self.vfrequencymap, self.w, self.field_of_view, block_size=64)
+        assert_allclose(sumwt, self.nvis)
+        degridded = idg_degrid(vis.shape, uvgrid, self.vuvwmap, self.vfrequencymap, self.w, self.field_of_view,
+                               block_size=64)
+        assert_allclose(numpy.vdot(uvgrid, gridded), numpy.vdot(degridded, vis), rtol=1e-10)
+
+    def test_degrid_point_source(self):
+        # Point source offset from the phase centre, gridded with the prolate spheroidal gcf
+        dy, dx = 13, -21
+        gcf, _ = anti_aliasing_calculate((self.npixel, self.npixel))
+        model = numpy.zeros([1, 1, self.npixel, self.npixel])
+        model[0, 0, self.npixel // 2 + dy, self.npixel // 2 + dx] = 1.0
+        uvgrid = fft((model * gcf).astype('complex'))
+        vis = idg_degrid([self.nvis, 1], uvgrid, self.vuvwmap, self.vfrequencymap, self.w, self.field_of_view,
+                         support=16)
+        cellsize = self.field_of_view / self.npixel
+        l, m = dx * cellsize, dy * cellsize
+        u, v = self.vuvwmap[:, 0] * self.npixel, self.vuvwmap[:, 1] * self.npixel
+        expected = numpy.exp(-2j * numpy.pi * ((u * dx + v * dy) / self.npixel +
+                                               self.w * (numpy.sqrt(1.0 - l ** 2 - m ** 2) - 1.0)))
+        assert_allclose(vis[:, 0], expected, atol=1e-3)
+
+    def test_w_layers(self):
+        layer, layer_w = idg_w_layers(self.w, 1.0, support=16)
+        assert numpy.min(layer) == 0 and numpy.max(layer) == len(layer_w) - 1
+        wstep = layer_w[1] - layer_w[0]
+        assert (numpy.abs(self.w - layer_w[layer]) <= wstep / 2.0 + 1e-9).all()
+
+
+if __name__ == '__main__':
+    unittest.main()
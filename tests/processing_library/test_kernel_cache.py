@@ -0,0 +1,71 @@
+""" Unit processing_library for kernel cache
+
+
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from processing_library.imaging.kernel_cache import KernelCache
+
+
+class TestKernelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        # Each kernel is 8*8*16*16 complex = 256kB
+        self.kernels = [(1.0 + i) * numpy.ones([8, 8, 16, 16], dtype='complex') for i in range(4)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_hit_miss(self):
+        cache = KernelCache()
+        assert cache.get(('k', 0)) is None
+        cache.put(('k', 0), self.kernels[0])
+        assert_allclose(cache.get(('k', 0)), self.kernels[0])
+        stats = cache.statistics()
+        assert stats['hits'] == 1 and stats['misses'] == 1 and stats['kernels'] == 1, str(cache)
+
+    def test_eviction(self):
+        cache = KernelCache(max_memory=self.kernels[0].nbytes * 2.5 / 1024.0 ** 3)
+        for i in range(3):
+            cache.put(('k', i), self.kernels[i])
+        # The least recently used kernel has gone
+        assert cache.statistics()['kernels'] == 2
+        assert cache.get(('k', 0)) is None
+        assert cache.get(('k', 1)) is not None
+        cache.put(('k', 3), self.kernels[3])
+        assert cache.get(('k', 2)) is None
+        assert cache.get(('k', 1)) is not None
+
+    def test_spill(self):
+        cache = KernelCache(max_memory=self.kernels[0].nbytes * 2.5 / 1024.0 ** 3, spill_directory=self.dir)
+        for i in range(4):
+            cache.put(('k', i), self.kernels[i])
+        assert cache.statistics()['spilled'] == 2
+        for i in [3, 2, 0, 1]:
+            assert_allclose(cache.get(('k', i)), self.kernels[i])
+        stats = cache.statistics()
+        assert stats['hits'] == 4 and stats['disk_hits'] == 2 and stats['misses'] == 0, str(cache)
+        cache.clear()
+        assert cache.get(('k', 0)) is None
+
+    def test_spill_directory_change(self):
+        cache = KernelCache(max_memory=self.kernels[0].nbytes * 2.5 / 1024.0 ** 3, spill_directory=self.dir)
+        for i in range(4):
+            cache.put(('k', i), self.kernels[i])
+        new_dir = "%s/moved" % self.dir
+        cache.configure(spill_directory=new_dir)
+        assert len(os.listdir(new_dir)) == 2
+        for i in [0, 1]:
+            assert_allclose(cache.get(('k', i)), self.kernels[i])
+        assert cache.statistics()['disk_hits'] == 2, str(cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,9 +14,10 @@ from astropy.coordinates import SkyCoord
 from data_models.polarisation import PolarisationFrame
 from wrappers.arlexecute.execution_support.arlexecute import arlexecute
 from wrappers.arlexecute.image.operations import export_image_to_fits, smooth_image
-from wrappers.arlexecute.imaging.base import predict_skycomponent_visibility
+from wrappers.arlexecute.imaging.base import predict_skycomponent_visibility, advise_wide_field, \
+    advise_wstack_wprojection
 from workflows.arlexecute.imaging.imaging_arlexecute import zero_list_arlexecute_workflow, predict_list_arlexecute_workflow, \
-    invert_list_arlexecute_workflow, subtract_list_arlexecute_workflow
+    invert_list_arlexecute_workflow, subtract_list_arlexecute_workflow, invert_dirty_psf_list_arlexecute_workflow
 from wrappers.arlexecute.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
     insert_skycomponent
 from wrappers.arlexecute.simulation.testing_support import create_named_configuration, ingest_unittest_visibility, \
@@ -219,10 +220,34 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(dospectral=True, dopol=True)
         self._predict_base(context='wstack', extra='_spectral', fluxthreshold=4.0, vis_slices=41)
     
+    def test_predict_idg(self):
+        self.actualSetUp()
+        self._predict_base(context='idg', fluxthreshold=2.0)
+    
+    def test_predict_wstack_wprojection_hybrid(self):
+        self.actualSetUp()
+        advice = advise_wide_field(self.vis_list[0], guard_band_image=2.0, delA=0.02,
+                                   oversampling_synthesised_beam=4.0)
+        hybrid = advise_wstack_wprojection(advice, npixel=self.npixel)
+        self._predict_base(context='wstack_wprojection', fluxthreshold=3.0, oversampling=2, **hybrid)
+    
     def test_invert_2d(self):
         self.actualSetUp(zerow=True)
         self._invert_base(context='2d', positionthreshold=2.0, check_components=False)
     
+    def test_invert_dirty_psf_2d(self):
+        self.actualSetUp(zerow=True)
+        dirty_list, psf_list = invert_dirty_psf_list_arlexecute_workflow(self.vis_list, self.model_list,
+                                                                         context='2d')
+        dirty_list, psf_list = arlexecute.compute((dirty_list, psf_list), sync=True)
+        dirty = invert_list_arlexecute_workflow(self.vis_list, self.model_list, context='2d')
+        psf = invert_list_arlexecute_workflow(self.vis_list, self.model_list, context='2d', dopsf=True)
+        dirty, psf = arlexecute.compute((dirty, psf), sync=True)
+        for freqwin in range(len(self.vis_list)):
+            numpy.testing.assert_array_almost_equal(dirty_list[freqwin][0].data, dirty[freqwin][0].data, 12)
+            numpy.testing.assert_array_almost_equal(psf_list[freqwin][0].data, psf[freqwin][0].data, 12)
+            numpy.testing.assert_array_almost_equal(psf_list[freqwin][1], psf[freqwin][1], 12)
+    
     def test_invert_facets(self):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
@@ -267,6 +292,17 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='wstack', positionthreshold=1.0, vis_slices=41)
     
+    def test_invert_wstack_wprojection_hybrid(self):
+        self.actualSetUp()
+        advice = advise_wide_field(self.vis_list[0], guard_band_image=2.0, delA=0.02,
+                                   oversampling_synthesised_beam=4.0)
+        hybrid = advise_wstack_wprojection(advice, npixel=self.npixel)
+        self._invert_base(context='wstack_wprojection', positionthreshold=1.0, oversampling=2, **hybrid)
+    
+    def test_invert_idg(self):
+        self.actualSetUp()
+        self._invert_base(context='idg', positionthreshold=1.0)
+    
     def test_invert_wstack_spectral(self):
         self.actualSetUp(dospectral=True)
         self._invert_base(context='wstack', extra='_spectral', positionthreshold=2.0,
@@ -13,13 +13,14 @@ from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 from wrappers.serial.image.operations import export_image_to_fits, smooth_image
-from wrappers.serial.imaging.base import predict_skycomponent_visibility
+from wrappers.serial.imaging.base import predict_skycomponent_visibility, advise_wide_field, \
+    advise_wstack_wprojection
 from wrappers.serial.simulation.testing_support import create_named_configuration, ingest_unittest_visibility, \
     create_unittest_model, insert_unittest_errors, create_unittest_components
 from wrappers.serial.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
     insert_skycomponent
 from workflows.serial.imaging.imaging_serial import predict_list_serial_workflow, invert_list_serial_workflow, \
-    subtract_list_serial_workflow, zero_list_serial_workflow
+    subtract_list_serial_workflow, zero_list_serial_workflow, invert_dirty_psf_list_serial_workflow
 
 log = logging.getLogger(__name__)
 
@@ -210,10 +211,31 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(dospectral=True, dopol=True)
         self._predict_base(context='wstack', extra='_spectral', fluxthreshold=4.0, vis_slices=41)
     
+    def test_predict_idg(self):
+        self.actualSetUp()
+        self._predict_base(context='idg', fluxthreshold=2.0)
+    
+    def test_predict_wstack_wprojection_hybrid(self):
+        self.actualSetUp()
+        advice = advise_wide_field(self.vis_list[0], guard_band_image=2.0, delA=0.02,
+                                   oversampling_synthesised_beam=4.0)
+        hybrid = advise_wstack_wprojection(advice, npixel=self.npixel)
+        self._predict_base(context='wstack_wprojection', fluxthreshold=3.0, oversampling=2, **hybrid)
+    
     def test_invert_2d(self):
         self.actualSetUp(zerow=True)
         self._invert_base(context='2d', positionthreshold=2.0, check_components=False)
     
+    def test_invert_dirty_psf_2d(self):
+        self.actualSetUp(zerow=True)
+        dirty_list, psf_list = invert_dirty_psf_list_serial_workflow(self.vis_list, self.model_list, context='2d')
+        dirty = invert_list_serial_workflow(self.vis_list, self.model_list, context='2d')
+        psf = invert_list_serial_workflow(self.vis_list, self.model_list, context='2d', dopsf=True)
+        for freqwin in range(len(self.vis_list)):
+            numpy.testing.assert_array_almost_equal(dirty_list[freqwin][0].data, dirty[freqwin][0].data, 12)
+            numpy.testing.assert_array_almost_equal(psf_list[freqwin][0].data, psf[freqwin][0].data, 12)
+            numpy.testing.assert_array_almost_equal(psf_list[freqwin][1], psf[freqwin][1], 12)
+    
     def test_invert_facets(self):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
@@ -258,6 +280,17 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='wstack', positionthreshold=1.0, vis_slices=41)
     
+    def test_invert_wstack_wprojection_hybrid(self):
+        self.actualSetUp()
+        advice = advise_wide_field(self.vis_list[0], guard_band_image=2.0, delA=0.02,
+                                   oversampling_synthesised_beam=4.0)
+        hybrid = advise_wstack_wprojection(advice, npixel=self.npixel)
+        self._invert_base(context='wstack_wprojection', positionthreshold=1.0, oversampling=2, **hybrid)
+    
+    def test_invert_idg(self):
+        self.actualSetUp()
+        self._invert_base(context='idg', positionthreshold=1.0)
+    
     def test_invert_wstack_spectral(self):
         self.actualSetUp(dospectral=True)
         self._invert_base(context='wstack', extra='_spectral', positionthreshold=2.0,
@@ -21,18 +21,44 @@ from workflows.shared.imaging.imaging_shared import imaging_context
 from workflows.shared.imaging.imaging_shared import sum_invert_results, remove_sumwt, sum_predict_results, \
     threshold_list
 from wrappers.arlexecute.execution_support.arlexecute import arlexecute
+from wrappers.arlexecute.imaging.base import create_gridding_plan, invert_2d_dirty_psf, residual_2d
 from wrappers.arlexecute.image.deconvolution import deconvolve_cube, restore_cube
 from wrappers.arlexecute.image.gather_scatter import image_scatter_facets, image_gather_facets, \
     image_scatter_channels, image_gather_channels
 from wrappers.arlexecute.image.operations import calculate_image_frequency_moments
-from wrappers.arlexecute.imaging.weighting import weight_visibility
+from wrappers.arlexecute.imaging.weighting import weight_visibility, weight_density_grid
 from wrappers.arlexecute.visibility.base import copy_visibility
 from wrappers.arlexecute.visibility.gather_scatter import visibility_scatter, visibility_gather
 
 log = logging.getLogger(__name__)
 
 
-def predict_list_arlexecute_workflow(vis_list, model_imagelist, vis_slices=1, facets=1, context='2d', **kwargs):
+def gridding_plan_list_arlexecute_workflow(vis_list, model_imagelist, vis_slices=1, facets=1, context='2d',
+                                           **kwargs):
+    """ Create graph for the gridding plans of a list of visibilities
+    
+    One plan is made per visibility partition. The same graph node is then used by every predict and invert of
+    that partition so the plan is calculated once and held on the worker. Plans only apply when the visibility
+    and image are not scattered i.e. for the 2d context with one facet and one vis slice, otherwise a list of
+    None is returned.
+
+    :param vis_list:
+    :param model_imagelist: Model used to determine image parameters
+    :param vis_slices: Number of vis slices (w stack or timeslice)
+    :param facets: Number of facets (per axis)
+    :param context: Imaging context
+    :param kwargs: Parameters for functions in components
+    :return: List of gridding plans
+    """
+    if context != '2d' or facets != 1 or vis_slices != 1:
+        return [None for _ in vis_list]
+    
+    return [arlexecute.execute(create_gridding_plan, pure=True, nout=1)(vis, model_imagelist[freqwin], **kwargs)
+            for freqwin, vis in enumerate(vis_list)]
+
+
+def predict_list_arlexecute_workflow(vis_list, model_imagelist, vis_slices=1, facets=1, context='2d',
+                                     gridding_plan_list=None, **kwargs):
     """Predict, iterating over both the scattered vis_list and image
     
     The visibility and image are scattered, the visibility is predicted on each part, and then the
@@ -43,6 +69,7 @@ def predict_list_arlexecute_workflow(vis_list, model_imagelist, vis_slices=1, fa
     :param vis_slices: Number of vis slices (w stack or timeslice)
     :param facets: Number of facets (per axis)
     :param context:
+    :param gridding_plan_list: List of gridding plans from gridding_plan_list_arlexecute_workflow (optional)
     :param kwargs: Parameters for functions in components
     :return: List of vis_lists
    """
@@ -58,12 +85,16 @@ def predict_list_arlexecute_workflow(vis_list, model_imagelist, vis_slices=1, fa
     else:
         actual_number_facets = facets - 1
     
-    def predict_ignore_none(vis, model):
+    def predict_ignore_none(vis, model, gridding_plan=None):
         if vis is not None:
-            return predict(vis, model, context=context, facets=facets, vis_slices=vis_slices, **kwargs)
+            return predict(vis, model, context=context, facets=facets, vis_slices=vis_slices,
+                           gridding_plan=gridding_plan, **kwargs)
         else:
             return None
     
+    if gridding_plan_list is None:
+        gridding_plan_list = [None for _ in vis_list]
+    
     image_results_list_list = list()
     # Loop over all frequency windows
     for freqwin, vis_list in enumerate(vis_list):
@@ -81,7 +112,8 @@ def predict_list_arlexecute_workflow(vis_list, model_imagelist, vis_slices=1, fa
             for facet_list in facet_lists:
                 # Predict visibility for this subvisibility from this facet
                 facet_vis_list = arlexecute.execute(predict_ignore_none, pure=True, nout=1)(sub_vis_list,
-                                                                                            facet_list)
+                                                                                            facet_list,
+                                                                                            gridding_plan_list[freqwin])
                 facet_vis_results.append(facet_vis_list)
             # Sum the current sub-visibility over all facets
             facet_vis_lists.append(arlexecute.execute(sum_predict_results)(facet_vis_results))
@@ -93,7 +125,7 @@ def predict_list_arlexecute_workflow(vis_list, model_imagelist, vis_slices=1, fa
 
 
 def invert_list_arlexecute_workflow(vis_list, template_model_imagelist, dopsf=False, normalize=True,
-                                    facets=1, vis_slices=1, context='2d', **kwargs):
+                                    facets=1, vis_slices=1, context='2d', gridding_plan_list=None, **kwargs):
     """ Sum results from invert, iterating over the scattered image and vis_list
 
     :param vis_list:
@@ -103,6 +135,7 @@ def invert_list_arlexecute_workflow(vis_list, template_model_imagelist, dopsf=Fa
     :param normalize: Normalize by sumwt
     :param vis_slices: Number of slices
     :param context: Imaging context
+    :param gridding_plan_list: List of gridding plans from gridding_plan_list_arlexecute_workflow (optional)
     :param kwargs: Parameters for functions in components
     :return: List of (image, sumwt) tuple
    """
@@ -132,13 +165,16 @@ def invert_list_arlexecute_workflow(vis_list, template_model_imagelist, dopsf=Fa
                 i += 1
         return result, sumwt
     
-    def invert_ignore_none(vis, model):
+    def invert_ignore_none(vis, model, gridding_plan=None):
         if vis is not None:
             return invert(vis, model, context=context, dopsf=dopsf, normalize=normalize, facets=facets,
-                          vis_slices=vis_slices, **kwargs)
+                          vis_slices=vis_slices, gridding_plan=gridding_plan, **kwargs)
         else:
             return create_empty_image_like(model), 0.0
     
+    if gridding_plan_list is None:
+        gridding_plan_list = [None for _ in vis_list]
+    
     # Loop over all vis_lists independently
     results_vislist = list()
     for freqwin, vis_list in enumerate(vis_list):
@@ -156,7 +192,8 @@ def invert_list_arlexecute_workflow(vis_list, template_model_imagelist, dopsf=Fa
             facet_vis_results = list()
             for facet_list in facet_lists:
                 facet_vis_results.append(
-                    arlexecute.execute(invert_ignore_none, pure=True)(sub_vis_list, facet_list))
+                    arlexecute.execute(invert_ignore_none, pure=True)(sub_vis_list, facet_list,
+                                                                      gridding_plan_list[freqwin]))
             vis_results.append(arlexecute.execute(gather_image_iteration_results, nout=1)(facet_vis_results,
                                                                                           template_model_imagelist[
                                                                                               freqwin]))
@@ -165,22 +202,94 @@ def invert_list_arlexecute_workflow(vis_list, template_model_imagelist, dopsf=Fa
     return results_vislist
 
 
-def residual_list_arlexecute_workflow(vis, model_imagelist, context='2d', **kwargs):
+def invert_dirty_psf_list_arlexecute_workflow(vis_list, template_model_imagelist, normalize=True, facets=1,
+                                              vis_slices=1, context='2d', gridding_plan_list=None, **kwargs):
+    """ Create graphs for both the dirty images and the PSFs
+    
+    For the 2d context with one facet and one vis slice, the dirty image and PSF of each visibility are made in
+    one pass over the visibility by invert_2d_dirty_psf. Otherwise this is the same as calling
+    invert_list_arlexecute_workflow with dopsf False and True.
+
+    :param vis_list:
+    :param template_model_imagelist: Model used to determine image parameters
+    :param normalize: Normalize by sumwt
+    :param facets: Number of facets
+    :param vis_slices: Number of slices
+    :param context: Imaging context
+    :param gridding_plan_list: List of gridding plans from gridding_plan_list_arlexecute_workflow (optional)
+    :param kwargs: Parameters for functions in components
+    :return: List of (image, sumwt) tuples for the dirty images, list of (image, sumwt) tuples for the PSFs
+    """
+    if context != '2d' or facets != 1 or vis_slices != 1:
+        dirty_imagelist = invert_list_arlexecute_workflow(vis_list, template_model_imagelist, dopsf=False,
+                                                          normalize=normalize, facets=facets, vis_slices=vis_slices,
+                                                          context=context, gridding_plan_list=gridding_plan_list,
+                                                          **kwargs)
+        psf_imagelist = invert_list_arlexecute_workflow(vis_list, template_model_imagelist, dopsf=True,
+                                                        normalize=normalize, facets=facets, vis_slices=vis_slices,
+                                                        context=context, gridding_plan_list=gridding_plan_list,
+                                                        **kwargs)
+        return dirty_imagelist, psf_imagelist
+    
+    if not isinstance(template_model_imagelist, collections.Iterable):
+        template_model_imagelist = [template_model_imagelist]
+    
+    def invert_ignore_none(vis, model, gridding_plan=None):
+        if vis is not None:
+            return invert_2d_dirty_psf(vis, model, normalize=normalize, gridding_plan=gridding_plan, **kwargs)
+        else:
+            return (create_empty_image_like(model), 0.0), (create_empty_image_like(model), 0.0)
+    
+    if gridding_plan_list is None:
+        gridding_plan_list = [None for _ in vis_list]
+    
+    dirty_imagelist = list()
+    psf_imagelist = list()
+    for freqwin, vis in enumerate(vis_list):
+        dirty, psf = arlexecute.execute(invert_ignore_none, pure=True, nout=2)(vis,
+                                                                                template_model_imagelist[freqwin],
+                                                                                gridding_plan_list[freqwin])
+        dirty_imagelist.append(dirty)
+        psf_imagelist.append(psf)
+    
+    return dirty_imagelist, psf_imagelist
+
+
+def residual_list_arlexecute_workflow(vis, model_imagelist, context='2d', gridding_plan_list=None, **kwargs):
     """ Create a graph to calculate residual image using w stacking and faceting
+    
+    For the 2d context with one facet and one vis slice, the residual image is made by residual_2d, which
+    degrids, subtracts and grids a block of visibilities at a time without making the model visibility.
 
     :param context: 
     :param vis:
     :param model_imagelist: Model used to determine image parameters
     :param vis:
     :param model_imagelist: Model used to determine image parameters
+    :param gridding_plan_list: List of gridding plans from gridding_plan_list_arlexecute_workflow (optional)
     :param kwargs: Parameters for functions in components
     :return:
     """
+    if context == '2d' and get_parameter(kwargs, "facets", 1) == 1 and get_parameter(kwargs, "vis_slices", 1) == 1:
+        if gridding_plan_list is None:
+            gridding_plan_list = [None for _ in vis]
+        
+        def residual_ignore_none(v, model, gridding_plan=None):
+            if v is not None:
+                return residual_2d(v, model, gridding_plan=gridding_plan, **kwargs)
+            else:
+                return create_empty_image_like(model), 0.0
+        
+        return [arlexecute.execute(residual_ignore_none, pure=True, nout=1)(v, model_imagelist[freqwin],
+                                                                            gridding_plan_list[freqwin])
+                for freqwin, v in enumerate(vis)]
+    
     model_vis = zero_list_arlexecute_workflow(vis)
-    model_vis = predict_list_arlexecute_workflow(model_vis, model_imagelist, context=context, **kwargs)
+    model_vis = predict_list_arlexecute_workflow(model_vis, model_imagelist, context=context,
+                                                 gridding_plan_list=gridding_plan_list, **kwargs)
     residual_vis = subtract_list_arlexecute_workflow(vis, model_vis)
     return invert_list_arlexecute_workflow(residual_vis, model_imagelist, dopsf=False, normalize=True, context=context,
-                                           **kwargs)
+                                           gridding_plan_list=gridding_plan_list, **kwargs)
 
 
 def restore_list_arlexecute_workflow(model_imagelist, psf_imagelist, residual_imagelist, **kwargs):
@@ -350,6 +459,11 @@ def deconvolve_list_channel_arlexecute_workflow(dirty_list, psf_list, model_imag
 
 def weight_list_arlexecute_workflow(vis_list, model_imagelist, weighting='uniform', **kwargs):
     """ Weight the visibility data
+    
+    Weighting that depends on the sample density is done in two phases so that the weights do not depend on
+    how the data are partitioned. First each partition grids its weights onto a density grid, and the
+    density grids are summed in a binary tree on the workers. The summed density grid is then sent to every
+    partition, which reweights its visibilities in place. Only density grids move between workers.
 
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
@@ -358,17 +472,43 @@ def weight_list_arlexecute_workflow(vis_list, model_imagelist, weighting='unifor
     :return: List of vis_graphs
    """
     
-    def weight_vis(vis, model):
+    def density_vis(vis, model):
+        if vis is not None and model is not None:
+            return weight_density_grid(vis, model, **kwargs)
+        else:
+            return None
+    
+    def sum_density(*densitygrids):
+        densitygrids = [densitygrid for densitygrid in densitygrids if densitygrid is not None]
+        if len(densitygrids) == 0:
+            return None
+        result = numpy.zeros_like(densitygrids[0])
+        for densitygrid in densitygrids:
+            assert densitygrid.shape == result.shape, "Density grids must all have the same shape"
+            result += densitygrid
+        return result
+    
+    def weight_vis(vis, model, densitygrid):
         if vis is not None:
             if model is not None:
-                vis, _, _ = weight_visibility(vis, model, weighting=weighting, **kwargs)
+                vis, _, _ = weight_visibility(vis, model, weighting=weighting, densitygrid=densitygrid, **kwargs)
                 return vis
             else:
                 return None
         else:
             return None
     
-    return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+    if weighting == 'natural':
+        densitygrid = None
+    else:
+        density_list = [arlexecute.execute(density_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+                        for i in range(len(vis_list))]
+        while len(density_list) > 1:
+            density_list = [arlexecute.execute(sum_density, pure=True, nout=1)(*density_list[i:i + 2])
+                            for i in range(0, len(density_list), 2)]
+        densitygrid = density_list[0]
+    
+    return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i], densitygrid)
             for i in range(len(vis_list))]
 
 
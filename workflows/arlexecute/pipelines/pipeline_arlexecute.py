@@ -8,7 +8,8 @@ from wrappers.arlexecute.execution_support.arlexecute import arlexecute
 from ..calibration.calibration_arlexecute import calibrate_list_arlexecute_workflow
 from ..imaging.imaging_arlexecute import invert_list_arlexecute_workflow, residual_list_arlexecute_workflow, \
     predict_list_arlexecute_workflow, zero_list_arlexecute_workflow, subtract_list_arlexecute_workflow, \
-    restore_list_arlexecute_workflow, deconvolve_list_arlexecute_workflow
+    restore_list_arlexecute_workflow, deconvolve_list_arlexecute_workflow, gridding_plan_list_arlexecute_workflow, \
+    invert_dirty_psf_list_arlexecute_workflow
 
 
 def ical_list_arlexecute_workflow(vis_list, model_imagelist, context='2d', calibration_context='TG', do_selfcal=True, **kwargs):
@@ -22,22 +23,39 @@ def ical_list_arlexecute_workflow(vis_list, model_imagelist, context='2d', calib
     :param kwargs: Parameters for functions in components
     :return:
     """
-    psf_imagelist = invert_list_arlexecute_workflow(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
+    # The gridding plans depend only on the uvw sampling and image geometry so they are made once per
+    # visibility partition and shared by all major cycles
+    gridding_plan_list = gridding_plan_list_arlexecute_workflow(vis_list, model_imagelist, context=context, **kwargs)
+    
+    # The residual image and the PSF can be made in one invert only for 2d imaging without facets or slices
+    fused = context == '2d' and get_parameter(kwargs, "facets", 1) == 1 and get_parameter(kwargs, "vis_slices", 1) == 1
+    
+    if not (do_selfcal and fused):
+        psf_imagelist = invert_list_arlexecute_workflow(vis_list, model_imagelist, dopsf=True, context=context,
+                                                        gridding_plan_list=gridding_plan_list, **kwargs)
     
-    model_vislist = zero_list_arlexecute_workflow(vis_list)
-    model_vislist = predict_list_arlexecute_workflow(model_vislist, model_imagelist, context=context, **kwargs)
     if do_selfcal:
         # Make the predicted visibilities, selfcalibrate against it correcting the gains, then
         # form the residual visibility, then make the residual image
+        model_vislist = zero_list_arlexecute_workflow(vis_list)
+        model_vislist = predict_list_arlexecute_workflow(model_vislist, model_imagelist, context=context,
+                                                         gridding_plan_list=gridding_plan_list, **kwargs)
         vis_list = calibrate_list_arlexecute_workflow(vis_list, model_vislist,
                                                       calibration_context=calibration_context, **kwargs)
         residual_vislist = subtract_list_arlexecute_workflow(vis_list, model_vislist)
-        residual_imagelist = invert_list_arlexecute_workflow(residual_vislist, model_imagelist, dopsf=True, context=context,
-                                                             iteration=0, **kwargs)
+        if fused:
+            residual_imagelist, psf_imagelist = \
+                invert_dirty_psf_list_arlexecute_workflow(residual_vislist, model_imagelist, context=context,
+                                                          gridding_plan_list=gridding_plan_list, **kwargs)
+        else:
+            residual_imagelist = invert_list_arlexecute_workflow(residual_vislist, model_imagelist, dopsf=False,
+                                                                 context=context, iteration=0,
+                                                                 gridding_plan_list=gridding_plan_list, **kwargs)
     else:
         # If we are not selfcalibrating it's much easier and we can avoid an unnecessary round of gather/scatter
         # for visibility partitioning such as timeslices and wstack.
-        residual_imagelist = residual_list_arlexecute_workflow(vis_list, model_imagelist, context=context, **kwargs)
+        residual_imagelist = residual_list_arlexecute_workflow(vis_list, model_imagelist, context=context,
+                                                               gridding_plan_list=gridding_plan_list, **kwargs)
     
     deconvolve_model_imagelist, _ = deconvolve_list_arlexecute_workflow(residual_imagelist, psf_imagelist, model_imagelist,
                                                                         prefix='cycle 0', **kwargs)
@@ -48,23 +66,28 @@ def ical_list_arlexecute_workflow(vis_list, model_imagelist, context='2d', calib
             if do_selfcal:
                 model_vislist = zero_list_arlexecute_workflow(vis_list)
                 model_vislist = predict_list_arlexecute_workflow(model_vislist, deconvolve_model_imagelist,
-                                                                 context=context, **kwargs)
+                                                                 context=context,
+                                                                 gridding_plan_list=gridding_plan_list, **kwargs)
                 vis_list = calibrate_list_arlexecute_workflow(vis_list, model_vislist,
                                                               calibration_context=calibration_context,
                                                               iteration=cycle, **kwargs)
                 residual_vislist = subtract_list_arlexecute_workflow(vis_list, model_vislist)
                 residual_imagelist = invert_list_arlexecute_workflow(residual_vislist, model_imagelist, dopsf=False,
-                                                                     context=context, **kwargs)
+                                                                     context=context,
+                                                                     gridding_plan_list=gridding_plan_list, **kwargs)
             else:
                 residual_imagelist = residual_list_arlexecute_workflow(vis_list, deconvolve_model_imagelist,
-                                                                       context=context, **kwargs)
+                                                                       context=context,
+                                                                       gridding_plan_list=gridding_plan_list,
+                                                                       **kwargs)
             
             prefix = "cycle %d" % (cycle+1)
             deconvolve_model_imagelist, _ = deconvolve_list_arlexecute_workflow(residual_imagelist, psf_imagelist,
                                                                                 deconvolve_model_imagelist,
                                                                                 prefix=prefix,
                                                                                 **kwargs)
-    residual_imagelist = residual_list_arlexecute_workflow(vis_list, deconvolve_model_imagelist, context=context, **kwargs)
+    residual_imagelist = residual_list_arlexecute_workflow(vis_list, deconvolve_model_imagelist, context=context,
+                                                           gridding_plan_list=gridding_plan_list, **kwargs)
     restore_imagelist = restore_list_arlexecute_workflow(deconvolve_model_imagelist, psf_imagelist, residual_imagelist)
     
     return arlexecute.execute((deconvolve_model_imagelist, residual_imagelist, restore_imagelist))
@@ -81,9 +104,15 @@ def continuum_imaging_list_arlexecute_workflow(vis_list, model_imagelist, contex
     :param kwargs: Parameters for functions in components
     :return:
     """
-    psf_imagelist = invert_list_arlexecute_workflow(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
+    # The gridding plans depend only on the uvw sampling and image geometry so they are made once per
+    # visibility partition and shared by all major cycles
+    gridding_plan_list = gridding_plan_list_arlexecute_workflow(vis_list, model_imagelist, context=context, **kwargs)
+    
+    psf_imagelist = invert_list_arlexecute_workflow(vis_list, model_imagelist, dopsf=True, context=context,
+                                                    gridding_plan_list=gridding_plan_list, **kwargs)
     
-    residual_imagelist = residual_list_arlexecute_workflow(vis_list, model_imagelist, context=context, **kwargs)
+    residual_imagelist = residual_list_arlexecute_workflow(vis_list, model_imagelist, context=context,
+                                                           gridding_plan_list=gridding_plan_list, **kwargs)
     deconvolve_model_imagelist, _ = deconvolve_list_arlexecute_workflow(residual_imagelist, psf_imagelist, model_imagelist,
                                                                         prefix='cycle 0',
                                                                         **kwargs)
@@ -92,13 +121,15 @@ def continuum_imaging_list_arlexecute_workflow(vis_list, model_imagelist, contex
     if nmajor > 1:
         for cycle in range(nmajor):
             prefix = "cycle %d" % (cycle+1)
-            residual_imagelist = residual_list_arlexecute_workflow(vis_list, deconvolve_model_imagelist, context=context, **kwargs)
+            residual_imagelist = residual_list_arlexecute_workflow(vis_list, deconvolve_model_imagelist, context=context,
+                                                                   gridding_plan_list=gridding_plan_list, **kwargs)
             deconvolve_model_imagelist, _ = deconvolve_list_arlexecute_workflow(residual_imagelist, psf_imagelist,
                                                                                 deconvolve_model_imagelist,
                                                                                 prefix=prefix,
                                                                                 **kwargs)
     
-    residual_imagelist = residual_list_arlexecute_workflow(vis_list, deconvolve_model_imagelist, context=context, **kwargs)
+    residual_imagelist = residual_list_arlexecute_workflow(vis_list, deconvolve_model_imagelist, context=context,
+                                                           gridding_plan_list=gridding_plan_list, **kwargs)
     restore_imagelist = restore_list_arlexecute_workflow(deconvolve_model_imagelist, psf_imagelist, residual_imagelist)
     return arlexecute.execute((deconvolve_model_imagelist, residual_imagelist, restore_imagelist))
 
@@ -18,7 +18,8 @@ from processing_components.image.deconvolution import deconvolve_cube, restore_c
 from processing_components.image.gather_scatter import image_scatter_facets, image_gather_facets, \
     image_scatter_channels, image_gather_channels
 from processing_components.image.operations import calculate_image_frequency_moments
-from processing_components.imaging.weighting import weight_visibility
+from processing_components.imaging.base import invert_2d_dirty_psf, residual_2d
+from processing_components.imaging.weighting import weight_visibility, weight_density_grid
 from processing_components.visibility.base import copy_visibility
 from processing_components.visibility.gather_scatter import visibility_scatter, visibility_gather
 from workflows.shared.imaging.imaging_shared import imaging_context
@@ -146,8 +147,54 @@ def invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
     return results_vislist
 
 
+def invert_dirty_psf_list_serial_workflow(vis_list, template_model_imagelist, normalize=True, facets=1,
+                                          vis_slices=1, context='2d', **kwargs):
+    """ Make both the dirty images and the PSFs
+    
+    For the 2d context with one facet and one vis slice, the dirty image and PSF of each visibility are made in
+    one pass over the visibility by invert_2d_dirty_psf. Otherwise this is the same as calling
+    invert_list_serial_workflow with dopsf False and True.
+
+    :param vis_list:
+    :param template_model_imagelist: Model used to determine image parameters
+    :param normalize: Normalize by sumwt
+    :param facets: Number of facets
+    :param vis_slices: Number of slices
+    :param context: Imaging context
+    :param kwargs: Parameters for functions in components
+    :return: List of (image, sumwt) tuples for the dirty images, list of (image, sumwt) tuples for the PSFs
+    """
+    if context != '2d' or facets != 1 or vis_slices != 1:
+        dirty_imagelist = invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
+                                                      normalize=normalize, facets=facets, vis_slices=vis_slices,
+                                                      context=context, **kwargs)
+        psf_imagelist = invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=True,
+                                                    normalize=normalize, facets=facets, vis_slices=vis_slices,
+                                                    context=context, **kwargs)
+        return dirty_imagelist, psf_imagelist
+    
+    if not isinstance(template_model_imagelist, collections.Iterable):
+        template_model_imagelist = [template_model_imagelist]
+    
+    dirty_imagelist = list()
+    psf_imagelist = list()
+    for freqwin, vis in enumerate(vis_list):
+        if vis is not None:
+            dirty, psf = invert_2d_dirty_psf(vis, template_model_imagelist[freqwin], normalize=normalize, **kwargs)
+        else:
+            dirty = create_empty_image_like(template_model_imagelist[freqwin]), 0.0
+            psf = create_empty_image_like(template_model_imagelist[freqwin]), 0.0
+        dirty_imagelist.append(dirty)
+        psf_imagelist.append(psf)
+    
+    return dirty_imagelist, psf_imagelist
+
+
 def residual_list_serial_workflow(vis, model_imagelist, context='2d', **kwargs):
     """ Create a graph to calculate residual image using w stacking and faceting
+    
+    For the 2d context with one facet and one vis slice, the residual image is made by residual_2d, which
+    degrids, subtracts and grids a block of visibilities at a time without making the model visibility.
 
     :param context:
     :param vis:
@@ -157,6 +204,11 @@ def residual_list_serial_workflow(vis, model_imagelist, context='2d', **kwargs):
     :param kwargs: Parameters for functions in components
     :return:
     """
+    if context == '2d' and get_parameter(kwargs, "facets", 1) == 1 and get_parameter(kwargs, "vis_slices", 1) == 1:
+        return [residual_2d(v, model_imagelist[freqwin], **kwargs) if v is not None
+                else (create_empty_image_like(model_imagelist[freqwin]), 0.0)
+                for freqwin, v in enumerate(vis)]
+    
     model_vis = zero_list_serial_workflow(vis)
     model_vis = predict_list_serial_workflow(model_vis, model_imagelist, context=context, **kwargs)
     residual_vis = subtract_list_serial_workflow(vis, model_vis)
@@ -330,6 +382,9 @@ def deconvolve_channel_list_serial_workflow(dirty_list, psf_list, model_imagelis
 
 def weight_list_serial_workflow(vis_list, model_imagelist, weighting='uniform', **kwargs):
     """ Weight the visibility data
+    
+    Weighting that depends on the sample density uses the density grid summed over all of vis_list so that the
+    weights do not depend on how the data are partitioned.
 
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
@@ -338,17 +393,28 @@ def weight_list_serial_workflow(vis_list, model_imagelist, weighting='uniform',
     :return: List of vis_graphs
    """
     
-    def weight_vis(vis, model):
+    def weight_vis(vis, model, densitygrid):
         if vis is not None:
             if model is not None:
-                vis, _, _ = weight_visibility(vis, model, weighting=weighting, **kwargs)
+                vis, _, _ = weight_visibility(vis, model, weighting=weighting, densitygrid=densitygrid, **kwargs)
                 return vis
             else:
                 return None
         else:
             return None
     
-    return [weight_vis(vis_list[i], model_imagelist[i])
+    densitygrid = None
+    if weighting != 'natural':
+        for i in range(len(vis_list)):
+            if vis_list[i] is not None and model_imagelist[i] is not None:
+                partial = weight_density_grid(vis_list[i], model_imagelist[i], **kwargs)
+                if densitygrid is None:
+                    densitygrid = partial
+                else:
+                    assert densitygrid.shape == partial.shape, "Density grids must all have the same shape"
+                    densitygrid += partial
+    
+    return [weight_vis(vis_list[i], model_imagelist[i], densitygrid)
             for i in range(len(vis_list))]
 
 
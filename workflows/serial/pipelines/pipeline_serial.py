@@ -8,7 +8,7 @@ from ..calibration.calibration_serial import calibrate_list_serial_workflow
 from ..imaging.imaging_serial import invert_list_serial_workflow, residual_list_serial_workflow, \
     predict_list_serial_workflow, zero_list_serial_workflow, subtract_list_serial_workflow, \
     restore_list_serial_workflow, \
-    deconvolve_list_serial_workflow
+    deconvolve_list_serial_workflow, invert_dirty_psf_list_serial_workflow
 
 
 def ical_list_serial_workflow(vis_list, model_imagelist, context='2d', calibration_context='TG', do_selfcal=True,
@@ -23,19 +23,27 @@ def ical_list_serial_workflow(vis_list, model_imagelist, context='2d', calibrati
     :param kwargs: Parameters for functions in components
     :return:
     """
-    psf_imagelist = invert_list_serial_workflow(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
+    # The residual image and the PSF can be made in one invert only for 2d imaging without facets or slices
+    fused = context == '2d' and get_parameter(kwargs, "facets", 1) == 1 and get_parameter(kwargs, "vis_slices", 1) == 1
+    
+    if not (do_selfcal and fused):
+        psf_imagelist = invert_list_serial_workflow(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
     
-    model_vislist = zero_list_serial_workflow(vis_list)
-    model_vislist = predict_list_serial_workflow(model_vislist, model_imagelist, context=context, **kwargs)
     if do_selfcal:
         # Make the predicted visibilities, selfcalibrate against it correcting the gains, then
         # form the residual visibility, then make the residual image
+        model_vislist = zero_list_serial_workflow(vis_list)
+        model_vislist = predict_list_serial_workflow(model_vislist, model_imagelist, context=context, **kwargs)
         vis_list = calibrate_list_serial_workflow(vis_list, model_vislist,
-                                                      calibration_context=calibration_context, **kwargs)
+                                                  calibration_context=calibration_context, **kwargs)
         residual_vislist = subtract_list_serial_workflow(vis_list, model_vislist)
-        residual_imagelist = invert_list_serial_workflow(residual_vislist, model_imagelist, dopsf=True,
-                                                             context=context,
-                                                             iteration=0, **kwargs)
+        if fused:
+            residual_imagelist, psf_imagelist = invert_dirty_psf_list_serial_workflow(residual_vislist,
+                                                                                      model_imagelist,
+                                                                                      context=context, **kwargs)
+        else:
+            residual_imagelist = invert_list_serial_workflow(residual_vislist, model_imagelist, dopsf=False,
+                                                             context=context, iteration=0, **kwargs)
     else:
         # If we are not selfcalibrating it's much easier and we can avoid an unnecessary round of gather/scatter
         # for visibility partitioning such as timeslices and wstack.
@@ -15,6 +15,7 @@ from processing_components.imaging.base import predict_2d, invert_2d
 from processing_components.visibility.iterators import vis_null_iter, vis_timeslice_iter, vis_wslice_iter
 from processing_components.imaging.timeslice_single import predict_timeslice_single, invert_timeslice_single
 from processing_components.imaging.wstack_single import predict_wstack_single, invert_wstack_single
+from processing_components.imaging.idg import predict_idg, invert_idg
 
 
 def imaging_contexts():
@@ -46,7 +47,13 @@ def imaging_contexts():
                               'vis_iterator': vis_timeslice_iter},
                 'wstack': {'predict': predict_wstack_single,
                            'invert': invert_wstack_single,
-                           'vis_iterator': vis_wslice_iter}}
+                           'vis_iterator': vis_wslice_iter},
+                'wstack_wprojection': {'predict': predict_wstack_single,
+                                       'invert': invert_wstack_single,
+                                       'vis_iterator': vis_wslice_iter},
+                'idg': {'predict': predict_idg,
+                        'invert': invert_idg,
+                        'vis_iterator': vis_null_iter}}
     
     return contexts
 
@@ -6,7 +6,13 @@ from processing_components.imaging.base import shift_vis_to_image
 from processing_components.imaging.base import normalize_sumwt
 from processing_components.imaging.base import predict_2d
 from processing_components.imaging.base import invert_2d
+from processing_components.imaging.base import invert_2d_dirty_psf
+from processing_components.imaging.base import create_gridding_plan
 from processing_components.imaging.base import predict_skycomponent_visibility
 from processing_components.imaging.base import create_image_from_visibility
 from processing_components.imaging.base import residual_image
-from processing_components.imaging.base import advise_wide_field
\ No newline at end of file
+from processing_components.imaging.base import residual_2d
+from processing_components.imaging.base import predict_2d_blockvisibility
+from processing_components.imaging.base import invert_2d_blockvisibility
+from processing_components.imaging.base import advise_wide_field
+from processing_components.imaging.base import advise_wstack_wprojection
@@ -0,0 +1,5 @@
+"""
+Image domain gridding processing"""
+
+from processing_components.imaging.idg import predict_idg
+from processing_components.imaging.idg import invert_idg
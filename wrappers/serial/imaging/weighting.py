@@ -3,5 +3,6 @@ Functions that aid weighting the visibility data prior to imaging.
 """
 
 from processing_components.imaging.weighting import weight_visibility
+from processing_components.imaging.weighting import weight_density_grid
 from processing_components.imaging.weighting import taper_visibility_gaussian
 from processing_components.imaging.weighting import taper_visibility_tukey
\ No newline at end of file